@@ -0,0 +1,162 @@
+"""
+    Baseline and command line shared by the benchmarks (ParserBenchmark, BundlePageBenchmark,
+    JsonCodecBenchmark and StartupTiming)
+
+    The medians of a run can be saved as a baseline (-s) and later runs compared against it: if any
+    case is more than the threshold (-t, in percent) slower than the baseline the benchmark exits with
+    code 1. A difference smaller than MIN_REGRESSION seconds is noise, whatever its percent (a case
+    that takes a fraction of a millisecond easily changes 20%). Every benchmark accepts:
+
+        -h | -r "repeats" | -t "threshold" | -b "baseline file" | -s
+
+    and its own options (BenchmarkOption)
+
+"""
+import getopt
+import json
+import os
+import sys
+
+DEFAULT_REPEATS = 5
+DEFAULT_THRESHOLD = 20
+MIN_REGRESSION = 0.0005
+BENCHMARK_OPTIONS = 'hr:t:b:s'
+BENCHMARK_LONG_OPTIONS = ['help', 'repeats=', 'threshold=', 'baseline=', 'save']
+
+
+def load_baseline(baseline_file):
+    if not os.path.isfile(baseline_file):
+        return {}
+    with open(baseline_file, 'r', encoding='utf-8') as baseline:
+        return json.load(baseline)
+
+
+def save_baseline(baseline_file, medians):
+    with open(baseline_file, 'w', encoding='utf-8') as baseline:
+        json.dump(medians, baseline, indent=2)
+
+
+class BaselineComparison:
+    """
+        The medians of a run compared with the ones of the baseline file
+    """
+
+    def __init__(self, baseline_file, threshold=DEFAULT_THRESHOLD, min_regression=MIN_REGRESSION):
+        self.__baseline_file = baseline_file
+        self.__baseline = load_baseline(baseline_file)
+        self.__medians = {}
+        self.threshold = threshold
+        self.min_regression = min_regression
+        self.regressions = []
+
+    def compare(self, name, median):
+        """
+            A case slower than the baseline by more than threshold percent and min_regression seconds is
+            a regression
+        :return: the change against the baseline, to be printed. '' if the case isn't in the baseline
+        """
+        self.__medians[name] = median
+        baseline_median = self.__baseline.get(name, 0)
+        if baseline_median <= 0:
+            return ''
+        change_percent = 100 * (median - baseline_median) / baseline_median
+        if (change_percent > self.threshold) and (median - baseline_median > self.min_regression):
+            self.regressions.append(name)
+        return f'{change_percent:+.1f}%'
+
+    def add_failure(self, name):
+        """
+            A case that fails for another reason than its time (a wrong result...)
+        """
+        self.regressions.append(name)
+
+    def finish(self, update_baseline=False, problem=None):
+        """
+        :param problem: what the failing cases have, printed with them
+        :return: True if no case has failed
+        """
+        if update_baseline:
+            save_baseline(self.__baseline_file, self.__medians)
+            print(f'Baseline saved to {self.__baseline_file}')
+        if self.regressions:
+            problem = problem or \
+                f'more than {self.threshold}% and {1000 * self.min_regression:g} ms slower than the baseline'
+            print(f'{len(self.regressions)} cases {problem}: {", ".join(self.regressions)}', file=sys.stderr)
+            return False
+        return True
+
+
+class BenchmarkOption:
+    """
+        An option of a benchmark besides the common ones, given to its run function as name
+
+        convert turns the value of the command line into the argument, with repeated the option can be
+        given several times and the argument is the list of values
+    """
+
+    def __init__(self, short_option, long_option, name, help_text, default=None, convert=str, repeated=False):
+        self.short_option = short_option
+        self.long_option = long_option
+        self.name = name
+        self.help_text = help_text
+        self.default = default
+        self.convert = convert
+        self.repeated = repeated
+
+    def get_default(self):
+        return [] if self.repeated else self.default
+
+
+def display_help(title, extra_options=()):
+    extra_parameters = ''.join(f' | -{option.short_option} "{option.long_option}"' for option in extra_options)
+    extra_long_parameters = ''.join(f' | {option.long_option}=""' for option in extra_options)
+    print(f'{title}\n'
+          f'\tParameters: -h | -r "repeats" | -t "threshold" | -b "baseline file" | -s{extra_parameters}\n'
+          f'\tLong parameters: help | repeats="" | threshold="" | baseline="" | save{extra_long_parameters}\n'
+          '-r Times each case is run, the median is compared\n'
+          '-t Maximum slowdown allowed against the baseline, in percent\n'
+          '-b File with the baseline medians\n'
+          '-s Save the results as the new baseline' +
+          ''.join(f'\n-{option.short_option} {option.help_text}' for option in extra_options))
+
+
+def benchmark_main(title, run, baseline_file, threshold=DEFAULT_THRESHOLD, extra_options=()):
+    """
+        Parses the command line and calls run(repeats, threshold, baseline_file, update_baseline, **extra)
+    :param run: returns True if no case has failed
+    :return: the exit code: 0 if no case has failed, 1 if any has, 2 for wrong arguments
+    """
+    options = BENCHMARK_OPTIONS + ''.join(f'{option.short_option}:' for option in extra_options)
+    long_options = BENCHMARK_LONG_OPTIONS + [f'{option.long_option}=' for option in extra_options]
+    arguments = {'repeats': DEFAULT_REPEATS, 'threshold': threshold, 'baseline_file': baseline_file,
+                 'update_baseline': False}
+    arguments.update({option.name: option.get_default() for option in extra_options})
+    extra_arguments = {f'-{option.short_option}': option for option in extra_options}
+    extra_arguments.update({f'--{option.long_option}': option for option in extra_options})
+    try:
+        command_arguments, values = getopt.getopt(sys.argv[1:], options, long_options)
+        for current_argument, current_value in command_arguments:
+            if current_argument in ('-h', '--help'):
+                display_help(title, extra_options)
+                return 0
+            elif current_argument in ('-r', '--repeats'):
+                arguments['repeats'] = max(1, int(current_value))
+            elif current_argument in ('-t', '--threshold'):
+                arguments['threshold'] = float(current_value)
+            elif current_argument in ('-b', '--baseline'):
+                arguments['baseline_file'] = current_value
+            elif current_argument in ('-s', '--save'):
+                arguments['update_baseline'] = True
+            elif current_argument in extra_arguments:
+                option = extra_arguments[current_argument]
+                if option.repeated:
+                    arguments[option.name].append(option.convert(current_value))
+                else:
+                    arguments[option.name] = option.convert(current_value)
+    except getopt.error as err:
+        print(str(err))
+        return 2
+    except ValueError:
+        print(f'{current_argument} must be a number: {current_value}')
+        return 2
+    return 0 if run(**arguments) else 1
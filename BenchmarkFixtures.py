@@ -0,0 +1,231 @@
+"""
+    HTML fixtures for the parser benchmarks (ParserBenchmark)
+
+    The pages reproduce the layout of each mirror: the libgen.rs search, fiction and md5 pages, the
+    libgen.li search and md5 pages, the Anna's Archive search page and a Humble Bundle page (for
+    BundlePageBenchmark). Each page comes in three sizes:
+     - small: a few results
+     - 100: a full page of results
+     - pathological: 1000 results with long, noisy titles and a big inline script, like the pages
+       full of ads that some mirrors serve
+
+    The fixtures are written to benchmark_fixtures/<page>_<size>.html. A page saved from a real
+    mirror can replace any of them, the benchmark only reads the files
+
+    Usage: python BenchmarkFixtures.py
+
+"""
+import json
+import os
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+FIXTURE_SIZES = {'small': 5, '100': 100, 'pathological': 1000}
+
+
+def fake_md5(i):
+    return f'{i:032X}'
+
+
+def noise(i, size):
+    """
+        Extra markup inside the cells, only in the pathological pages
+    """
+    if size != 'pathological':
+        return ''
+    return ''.join(f'<font color=grey><i>[{i}.{j}]</i></font>' for j in range(5))
+
+
+def big_script(size):
+    if size != 'pathological':
+        return ''
+    return '<script type="text/javascript">var ads = "' + 'x' * 500000 + '";</script>'
+
+
+def libgen_rs_search(num_rows, size):
+    rows = ''.join(
+        f'<tr valign=top bgcolor="#C6DEFF"><td>{i}</td>'
+        f'<td><a href="search.php?req=author{i}&column=author">Author {i}</a></td>'
+        f'<td width=500><a href="search.php?req=series{i}&column=series"><font face=Times color=green>'
+        f'<i>Series {i}</i></font></a><br><a href="book/index.php?md5={fake_md5(i)}" title="" id={i}>'
+        f'Title of the book number {i} {noise(i, size)}<font face=Times color=green><i>978{i:010d}</i></font>'
+        f'</a></td><td>Publisher {i}</td><td nowrap>2001</td><td>300</td><td>English</td><td nowrap>2 Mb</td>'
+        f'<td nowrap>{("pdf", "epub", "djvu")[i % 3]}</td>'
+        f'<td><a href="http://library.lol/main/{fake_md5(i)}" title="Libgen &amp; IPFS &amp; Tor">[1]</a></td>'
+        f'<td><a href="http://libgen.li/ads.php?md5={fake_md5(i)}" title="Libgen.li">[2]</a></td></tr>\n'
+        for i in range(num_rows))
+    return (f'<html><head><title>Library Genesis</title>'
+            f'<script type="text/javascript" src="paginator3000.js"></script>{big_script(size)}</head><body>\n'
+            f'<table width=100%><tr><td><a href="/">Library Genesis</a></td></tr></table>\n'
+            f'<table width=100%><tr><td><font color=grey size=1>{num_rows} files found</font></td><td></td>'
+            f'<td><a href="fiction/?q=title+of+the+book">fiction</a></td></tr></table>\n'
+            f'<table width=100% cellspacing=1 cellpadding=1 rules=rows class=c align=center>'
+            f'<tr valign=top bgcolor=#C0C0C0><td>ID</td><td>Author(s)</td><td>Title</td><td>Publisher</td>'
+            f'<td>Year</td><td>Pages</td><td>Language</td><td>Size</td><td>Extension</td>'
+            f'<td colspan=2>Mirrors</td></tr>\n{rows}</table>\n'
+            f'<script type="text/javascript">\n'
+            f'paginator_example_top = new Paginator(\n'
+            f'"paginator_example_top",\n'
+            f'    {max(1, num_rows // 25)}, // total pages\n'
+            f'    25, // pages to show\n'
+            f'    1, // current page\n'
+            f'    "search.php?req=title+of+the+book&page=" // url\n'
+            f');</script></body></html>')
+
+
+def libgen_rs_fiction(num_rows, size):
+    rows = ''.join(
+        f'<tr><td><ul class="catalog_authors"><li><a href="/fiction/?q=author{i}">Author {i}</a></li></ul></td>'
+        f'<td>Series {i}</td><td><p><a href="/fiction/{fake_md5(i)}">Fiction title {i} {noise(i, size)}</a></p>'
+        f'<p class="catalog_identifier">ISBN: 978{i:010d}</p></td><td>English</td>'
+        f'<td title="Uploaded at 2020-01-01">{("EPUB", "MOBI", "PDF")[i % 3]} / 1.2 Mb</td>'
+        f'<td><ul class="record_mirrors_compact"><li><a href="http://library.lol/fiction/{fake_md5(i)}">[1]</a>'
+        f'</li></ul></td></tr>\n'
+        for i in range(num_rows))
+    return (f'<html><head><title>Library Genesis: Fiction</title>{big_script(size)}</head><body>\n'
+            f'<div class="catalog_paginator"><select class="page_selector">'
+            f'<option>page 1 / {max(1, num_rows // 25)}</option></select></div>\n'
+            f'<table class="catalog"><thead><tr><td>Author(s)</td><td>Series</td><td>Title</td><td>Language</td>'
+            f'<td>File</td><td>Mirrors</td></tr></thead><tbody>\n{rows}</tbody></table></body></html>')
+
+
+def libgen_li_search(num_rows, size):
+    rows = ''.join(
+        f'<tr><td><a href="edition.php?id={i + 1:X}">Title {i} {noise(i, size)}</a><br>'
+        f'<a href="series.php?id={i}">Series {i}</a></td><td>Author {i}</td><td>Publisher {i}</td>'
+        f'<td>2001</td><td>English</td><td>300</td><td><a href="file.php?id={i}">2 Mb</a></td>'
+        f'<td>{("pdf", "epub", "mobi")[i % 3]}</td><td><a href="ads.php?md5={fake_md5(i)}">[1]</a>'
+        f'<a href="http://library.lol/main/{fake_md5(i)}">[2]</a></td></tr>\n'
+        for i in range(num_rows))
+    return (f'<html><head><title>Library Genesis</title>{big_script(size)}'
+            f'<script>$(function(){{ new Paginator("paginator_example_top", {max(1, num_rows // 25)}, 10, 1, '
+            f'"index.php?req=title&page="); }});</script></head><body>\n'
+            f'<table id="tablelibgen" class="table table-striped"><thead><tr><th>Title</th><th>Author(s)</th>'
+            f'<th>Publisher</th><th>Year</th><th>Language</th><th>Pages</th><th>Size</th><th>Ext.</th>'
+            f'<th>Mirrors</th></tr></thead><tbody>\n{rows}</tbody></table></body></html>')
+
+
+def annas_archive_search(num_rows, size):
+    rows = ''.join(
+        f'<div class="h-[110px] flex flex-col justify-center"><a href="/md5/{fake_md5(i).lower()}" '
+        f'class="flex items-center"><div class="relative"><img src="cover{i}.jpg"></div>'
+        f'<div class="relative"><div class="text-xs">English [en], {(".pdf", ".epub", ".mobi")[i % 3]}, '
+        f'2.1MB, title_{i}.pdf</div><h3 class="text-xl">Title {i} {noise(i, size)}</h3>'
+        f'<div class="truncate">Publisher {i}, 2001</div><div class="italic">Author {i}</div></div></a></div>\n'
+        for i in range(num_rows))
+    return (f'<html><head><title>Search - Anna\'s Archive</title>{big_script(size)}</head><body>'
+            f'<main><div class="mb-4">{rows}</div></main></body></html>')
+
+
+def libgen_rs_md5(num_links, size):
+    rows = ''.join(f'<tr><td>Field {i}</td><td>Value {i} {noise(i, size)}</td></tr>\n' for i in range(16))
+    mirrors = ''.join(f'<a href="http://mirror{i}.example.org/main/{fake_md5(0)}">Mirror {i}</a> '
+                      for i in range(num_links))
+    return (f'<html><head>{big_script(size)}</head><body><table rules=cols width=100% border=1>\n'
+            f'<tr><td colspan=2>Title of the book</td></tr>\n{rows}'
+            f'<tr><td>{mirrors}<a href="/book/bibtex.php?md5={fake_md5(0)}">bibtex</a></td></tr>\n'
+            f'</table></body></html>')
+
+
+def libgen_rs_fiction_md5(num_links, size):
+    mirrors = ''.join(f'<li><a href="http://mirror{i}.example.org/fiction/{fake_md5(0)}">Mirror {i}</a></li>'
+                      for i in range(num_links))
+    return (f'<html><head>{big_script(size)}</head><body><div class="record_side">'
+            f'<ul class="record_mirrors">{mirrors}<li><a href="magnet:?xt=urn:btih:x">torrent</a></li></ul>'
+            f'</div><table class="record">{noise(0, size) * 100}</table></body></html>')
+
+
+def libgen_li_md5(num_links, size):
+    mirrors = ''.join(f'<tr><td><a href="get.php?md5={fake_md5(0)}&key={i}">GET {i}</a>{noise(i, size)}</td></tr>'
+                      for i in range(num_links))
+    return (f'<html><head>{big_script(size)}</head><body>'
+            f'<table id="tablelibgen"><tbody>{mirrors}</tbody></table></body></html>')
+
+
+def humble_item(i, size):
+    """
+        An item of tier_item_data with the fields of the real pages, most of them unused by BundleInfo
+    """
+    return {
+        'human_name': f'Title of the book number {i}',
+        'machine_name': f'bookbundle_item_{i}',
+        'developers': [{'developer-name': f'Author {i}', 'developer-url': f'https://example.org/author{i}'}],
+        'publishers': [{'publisher-name': f'Publisher {i}', 'publisher-url': f'https://example.org/pub{i}'}],
+        'description_text': f'<p>Description of the book number {i}. {noise(i, size)}</p>' * 5,
+        'resolved_paths': {f'{kind}_preview': f'https://hb.imgix.net/{fake_md5(i)}.{kind}.jpg'
+                           for kind in ('front_page', 'featured', 'square', 'large')},
+        'msrp_price': {'amount': 19.99 + i, 'currency': 'USD'},
+        'platforms': ['ebook'],
+        'availability_icons': {'delivery_to_platform': {'ebook': ['download']}},
+        'youtube_link': None,
+        'translations': {lang: f'Title {i} ({lang})' for lang in ('de', 'es', 'fr', 'it', 'ja', 'pt', 'ru', 'zh')},
+    }
+
+
+def humble_bundle(num_items, size):
+    items = {f'bookbundle_item_{i}': humble_item(i, size) for i in range(num_items)}
+    tier_names = ['tier_1', 'tier_2', 'tier_3']
+    tiers = {tier: {'tier_item_machine_names': list(items)[:max(1, (idx + 1) * num_items // len(tier_names))],
+                    'header': f'Pay at least ${idx + 1}', 'price': {'amount': idx + 1, 'currency': 'USD'}}
+             for idx, tier in enumerate(tier_names)}
+    page_data = {
+        'bundleData': {
+            'machine_name': 'benchmark_bookbundle',
+            'basic_data': {'human_name': 'Humble Book Bundle: Benchmark', 'start_time|datetime': '2023-01-01',
+                           'media_type': 'ebook', 'msrp|money': {'amount': 500, 'currency': 'USD'}},
+            'tier_item_data': items,
+            'tier_order': tier_names,
+            'tier_display_data': tiers,
+            'charity_data': {'charity_item_data': {f'charity_{i}': {'name': f'Charity {i}'} for i in range(10)}},
+            'page_content': {'faq': [f'<p>Question {i}</p>' for i in range(50)]},
+        },
+        'bundleVars': {'product_urls': [f'https://example.org/{i}' for i in range(200)]},
+        'userOptions': {},
+    }
+    scripts = ''.join(f'<script src="https://humblebundle-a.akamaihd.net/static/hashed/{fake_md5(i)}.js"></script>'
+                      for i in range(30))
+    return (f'<!DOCTYPE html><html><head><title>Humble Book Bundle: Benchmark</title>{scripts}'
+            f'<script>window.models = {json.dumps({"request": {"country": "ES"}})};'
+            f'var data = document.getElementById("webpack-bundle-page-data");</script>{big_script(size)}</head>'
+            f'<body><div class="page-wrap">{"<div class=nav><a href=/store>Store</a></div>" * 200}</div>'
+            f'<script id="webpack-json-data" type="application/json">{json.dumps({"locale": "en"})}</script>'
+            f'<script id="webpack-bundle-page-data" type="application/json">{json.dumps(page_data)}</script>'
+            f'</body></html>')
+
+
+FIXTURE_BUILDERS = {
+    'libgen_rs_search': libgen_rs_search,
+    'libgen_rs_fiction': libgen_rs_fiction,
+    'libgen_li_search': libgen_li_search,
+    'annas_archive_search': annas_archive_search,
+    'libgen_rs_md5': libgen_rs_md5,
+    'libgen_rs_fiction_md5': libgen_rs_fiction_md5,
+    'libgen_li_md5': libgen_li_md5,
+    'humble_bundle': humble_bundle,
+}
+
+
+def get_fixture_filename(page, size):
+    return os.path.join(FIXTURES_FOLDER, f'{page}_{size}.html')
+
+
+def write_fixtures(overwrite=False):
+    os.makedirs(FIXTURES_FOLDER, exist_ok=True)
+    for page, builder in FIXTURE_BUILDERS.items():
+        for size, num_rows in FIXTURE_SIZES.items():
+            filename = get_fixture_filename(page, size)
+            if overwrite or not os.path.isfile(filename):
+                with open(filename, 'w', encoding='utf-8') as fixture:
+                    fixture.write(builder(num_rows, size))
+
+
+def load_fixture(page, size):
+    filename = get_fixture_filename(page, size)
+    if not os.path.isfile(filename):
+        write_fixtures()
+    with open(filename, 'rb') as fixture:
+        return fixture.read()
+
+
+if __name__ == '__main__':
+    write_fixtures(overwrite=True)
+    print(f'Fixtures written to {FIXTURES_FOLDER}')
@@ -1,12 +1,41 @@
 """
     Definition of class BundleInfo, that encapsulates the information from a Humble Bundle
+
+    The changes are persisted through a BundleJournal: each change is appended to a journal next to
+    the backup file, and the whole dictionary is only rewritten when the journal is compacted
+
+    With run_parameters['bundle_storage'] == 'sqlite' the storage is the LibraryCatalog instead, and a
+    JSON backup read with from_file is migrated into it
 """
+import os
 import sys
 from threading import Lock
 
-import json
+from BundleJournal import BundleJournal, set_operation, del_operation
+from JsonCodec import read_json_file, json_file_exists, strip_compressed_extension
+from utils import get_backup_file, run_parameters
+
+
+def get_bundle_catalog():
+    """
+    :return: the LibraryCatalog if it's the storage of the bundles, None if they are stored in JSON files
+    """
+    if run_parameters.get('bundle_storage', 'json') == 'sqlite':
+        # sqlite3 is only imported when it's used
+        from LibraryCatalog import get_library_catalog
+        return get_library_catalog()
+    return None
+
+
+def get_bundle_key(backup_file):
+    return os.path.basename(backup_file)
+
 
-from utils import get_backup_file
+def backup_exists(backup_file):
+    catalog = get_bundle_catalog()
+    if catalog and catalog.has_bundle(get_bundle_key(backup_file)):
+        return True
+    return json_file_exists(backup_file)
 
 
 class BundleException(BaseException):
@@ -21,6 +50,9 @@ class BundleInfo:
 
     Uses a mutex to prevent concurrent access in write operations
 
+    Every write operation is logged to the journal of the backup file, save_to_file writes
+    the full dictionary (compacting the journal)
+
     {
         "name": ...,
         "machine_name": ...,
@@ -36,10 +68,12 @@ class BundleInfo:
                 "publisher_url": ...,
                 "description": ...,
                 "books_found": {},
+                "books_downloaded": {},
                 "downloaded": true/false
             }
             In the value of "books_found" we will store the books that we found in LibGen
-            after searching for this book's title
+            after searching for this book's title. Each book keeps its "download_attempts": mirror,
+            start time, duration and result of each try
         },
         "tier_order": [], -> a list of all the tier names
         "tier_display_data": {
@@ -56,6 +90,7 @@ class BundleInfo:
     def __init__(self, whole_bundle_dict=None, backup_file=None, from_file=False):
         self.__bundle_dict_access_mutex = Lock()
         self.__backup_file = backup_file
+        self.__journal = None
         if whole_bundle_dict is None:
             whole_bundle_dict = {}
         if from_file:
@@ -78,8 +113,22 @@ class BundleInfo:
 
     @classmethod
     def from_file(cls, backup_file):
-        with open(backup_file, 'r', encoding='utf-8') as content:
-            return cls(whole_bundle_dict=json.load(content), backup_file=backup_file, from_file=True)
+        """
+        :param backup_file: the name of the backup, with or without the extension of its compression
+        """
+        backup_file = strip_compressed_extension(backup_file)
+        catalog = get_bundle_catalog()
+        if catalog and catalog.has_bundle(get_bundle_key(backup_file)):
+            return cls(whole_bundle_dict=catalog.load_bundle(get_bundle_key(backup_file)), backup_file=backup_file,
+                       from_file=True)
+        bundle_info = cls(whole_bundle_dict=read_json_file(backup_file), backup_file=backup_file, from_file=True)
+        if catalog:
+            # migration: the JSON backup and its journal go to the catalog, the files are left as they are
+            BundleJournal(backup_file).replay(bundle_info.__dict)
+            bundle_info.save_to_file()
+        else:
+            bundle_info.replay_journal()
+        return bundle_info
 
     def __getitem__(self, key):
         if (key == 'tier_display_data') and (key not in self.__dict.keys()):
@@ -89,6 +138,7 @@ class BundleInfo:
     def __setitem__(self, key, value):
         with self.__bundle_dict_access_mutex:
             self.__dict[key] = value
+            self.log_changes([set_operation([key], value)])
 
     def get(self, key, default=None):
         return self.__dict.get(key, default)
@@ -126,7 +176,7 @@ class BundleInfo:
                 'tier_item_machine_names']
         }
         for tier in reversed(self.__dict['tier_order']):
-            small_tier_items = self.__dict['tier_display_data'][tier]['tier_item_machine_names']
+            small_tier_items = set(self.__dict['tier_display_data'][tier]['tier_item_machine_names'])
             reversed_tier_order.pop(0)
             for other_tier in reversed_tier_order:
                 if tier != other_tier:
@@ -148,43 +198,104 @@ class BundleInfo:
             self.__backup_file = get_backup_file(self.__dict['url'])
         else:
             self.__backup_file = backup_file
+        self.__journal = None
+
+    @property
+    def journal(self):
+        """
+            The storage of the bundle: a BundleJournal, or a CatalogStorage with the sqlite storage
+        """
+        if (not self.__journal) and self.__backup_file:
+            catalog = get_bundle_catalog()
+            if catalog:
+                from LibraryCatalog import CatalogStorage
+                self.__journal = CatalogStorage(catalog, self.__backup_file, self.__dict)
+            else:
+                self.__journal = BundleJournal(self.__backup_file)
+        return self.__journal
+
+    def replay_journal(self):
+        with self.__bundle_dict_access_mutex:
+            if self.journal:
+                self.journal.replay(self.__dict)
+
+    def log_changes(self, operations):
+        """
+            Appends the operations to the journal, must be called with the mutex held
+
+            The first write, or a journal that has grown too much, writes the whole dictionary
+        """
+        if not self.journal:
+            print('BundleInfo: file not defined')
+            return
+        if (not self.journal.snapshot_exists()) or self.journal.append(operations):
+            self.journal.write_snapshot(self.__dict)
 
     def save_to_file(self, lock=True):
-        if self.__backup_file:
+        """
+            Writes the whole dictionary to the backup file and empties the journal
+        """
+        if self.journal:
             if lock:
                 with self.__bundle_dict_access_mutex:
-                    with open(self.__backup_file, 'w', encoding='utf-8') as file:
-                        json.dump(self.__dict, file)
+                    self.journal.write_snapshot(self.__dict)
             else:
-                with open(self.__backup_file, 'w', encoding='utf-8') as file:
-                    json.dump(self.__dict, file)
+                self.journal.write_snapshot(self.__dict)
         else:
             print('BundleInfo: file not defined')
 
     def set_books_found(self, key, books_found):
         with self.__bundle_dict_access_mutex:
             self.__dict['tier_item_data'][key]['books_found'] = books_found
-            self.save_to_file(lock=False)
+            self.log_changes([set_operation(['tier_item_data', key, 'books_found'], books_found)])
 
     def set_book_downloaded(self, key, book_md5):
         with self.__bundle_dict_access_mutex:
             downloaded_book = self.__dict['tier_item_data'][key]['books_found'].pop(book_md5)
+            operations = [
+                del_operation(['tier_item_data', key, 'books_found', book_md5]),
+                set_operation(['tier_item_data', key, 'books_downloaded', book_md5], downloaded_book)
+            ]
             if not self.__dict['tier_item_data'][key]['books_found']:
                 self.__dict['tier_item_data'][key]['downloaded'] = True
+                operations.append(set_operation(['tier_item_data', key, 'downloaded'], True))
             if not self.__dict['tier_item_data'][key].get('books_downloaded', None):
                 self.__dict['tier_item_data'][key]['books_downloaded'] = {}
             self.__dict['tier_item_data'][key]['books_downloaded'][book_md5] = downloaded_book
-            self.save_to_file(lock=False)
+            self.log_changes(operations)
+
+    def set_book_mirrors(self, key, book_md5, mirrors):
+        with self.__bundle_dict_access_mutex:
+            book = self.__dict['tier_item_data'][key].get('books_found', {}).get(book_md5, None)
+            if book is None:
+                return
+            book['mirrors'] = mirrors
+            self.log_changes([set_operation(['tier_item_data', key, 'books_found', book_md5, 'mirrors'], mirrors)])
+
+    def add_download_attempt(self, key, book_md5, attempt):
+        """
+            Appends the attempt to the "download_attempts" list of the book, found or already downloaded
+        """
+        with self.__bundle_dict_access_mutex:
+            item = self.__dict['tier_item_data'][key]
+            for book_list in ('books_found', 'books_downloaded'):
+                book = item.get(book_list, {}).get(book_md5, None)
+                if book is not None:
+                    attempts = book.setdefault('download_attempts', [])
+                    attempts.append(attempt)
+                    self.log_changes([set_operation(['tier_item_data', key, book_list, book_md5, 'download_attempts'],
+                                                    attempts)])
+                    return
 
     def set_all_books_downloaded(self, key, downloaded=True):
         with self.__bundle_dict_access_mutex:
             self.__dict['tier_item_data'][key]['downloaded'] = downloaded
-            self.save_to_file(lock=False)
+            self.log_changes([set_operation(['tier_item_data', key, 'downloaded'], downloaded)])
 
     def set_tiers(self, new_tiers):
         with self.__bundle_dict_access_mutex:
             self.__dict['tier_display_data'] = new_tiers
-            self.save_to_file(lock=False)
+            self.log_changes([set_operation(['tier_display_data'], new_tiers)])
 
     def create_default_tiers(self):
         with self.__bundle_dict_access_mutex:
@@ -196,4 +307,5 @@ class BundleInfo:
             }
             for item in self.__dict['tier_item_data']:
                 self.__dict['tier_display_data']['all']['tier_item_machine_names'].append(item)
-            self.save_to_file(lock=False)
+            self.log_changes([set_operation(['tier_order'], self.__dict['tier_order']),
+                              set_operation(['tier_display_data'], self.__dict['tier_display_data'])])
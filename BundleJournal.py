@@ -0,0 +1,119 @@
+"""
+    Append-only journal for the BundleInfo backups
+
+    Instead of rewriting the whole bundle JSON after every change, each change is appended as a small
+    record to "backup_file.journal". Every JOURNAL_COMPACT_EVERY records the journal is compacted:
+    the whole dictionary is written to a temporary file that replaces the backup with an atomic rename,
+    and then the journal is emptied.
+
+    Each line of the journal is a JSON list of operations:
+        ["set", ["tier_item_data", "bookmachinename", "downloaded"], true]
+        ["del", ["tier_item_data", "bookmachinename", "books_found", "md5"]]
+
+    The operations are idempotent, so replaying a journal over a snapshot that already contains some of
+    its records (a crash between the rename and the truncation) gives the same result. A truncated last
+    line (a crash while appending) is ignored.
+
+    The records and the snapshot are encoded with JsonCodec, the snapshot is compressed if
+    run_parameters['backup_compression'] says so. The journal is never compressed
+
+"""
+import os
+import sys
+
+from JsonCodec import dumps, loads, write_json_file, json_file_exists
+from utils import run_parameters
+
+JOURNAL_COMPACT_EVERY = 200
+
+
+def set_operation(path, value):
+    return ['set', list(path), value]
+
+
+def del_operation(path):
+    return ['del', list(path)]
+
+
+def apply_operations(bundle_dict, operations):
+    for operation in operations:
+        path = operation[1]
+        node = bundle_dict
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        if operation[0] == 'set':
+            node[path[-1]] = operation[2]
+        elif operation[0] == 'del':
+            node.pop(path[-1], None)
+
+
+class BundleJournal:
+    """
+        Handles the snapshot file and its journal
+
+        It's not thread-safe, BundleInfo calls it with its mutex held
+    """
+
+    def __init__(self, snapshot_file, compact_every=JOURNAL_COMPACT_EVERY):
+        self.__snapshot_file = snapshot_file
+        self.__journal_file = f'{snapshot_file}.journal'
+        self.__compact_every = compact_every
+        self.__records = 0
+
+    @property
+    def journal_file(self):
+        return self.__journal_file
+
+    @property
+    def records(self):
+        return self.__records
+
+    def snapshot_exists(self):
+        return json_file_exists(self.__snapshot_file)
+
+    def append(self, operations):
+        """
+        :return: True if the journal is long enough to be compacted
+        """
+        record = dumps(operations)
+        with open(self.__journal_file, 'ab') as journal:
+            journal.write(record + b'\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.__records += 1
+        return self.__records >= self.__compact_every
+
+    def replay(self, bundle_dict):
+        """
+            Applies all the records of the journal to the dictionary read from the snapshot
+        """
+        if not os.path.isfile(self.__journal_file):
+            return bundle_dict
+        valid_length = 0
+        with open(self.__journal_file, 'rb') as journal:
+            for line in journal:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('record without end of line')
+                    operations = loads(line)
+                except ValueError:
+                    print(f'BundleJournal: ignoring truncated record in {self.__journal_file}', file=sys.stderr)
+                    break
+                apply_operations(bundle_dict, operations)
+                valid_length += len(line)
+                self.__records += 1
+        # new records must not be appended after a broken line
+        if valid_length < os.path.getsize(self.__journal_file):
+            os.truncate(self.__journal_file, valid_length)
+        return bundle_dict
+
+    def write_snapshot(self, bundle_dict):
+        """
+            Writes the whole dictionary and empties the journal
+        """
+        write_json_file(self.__snapshot_file, bundle_dict, compression=run_parameters.get('backup_compression', ''),
+                        durable=True)
+        # after the rename the journal is redundant
+        if os.path.isfile(self.__journal_file):
+            os.remove(self.__journal_file)
+        self.__records = 0
@@ -0,0 +1,110 @@
+"""
+    Extraction of the bundle data from the Humble Bundle page
+
+    The data is the JSON inside <script id="webpack-bundle-page-data" type="application/json">. Instead of
+    building the tree of the whole page, the raw bytes are scanned for the id of the script and only its
+    content is decoded, with orjson if it's installed (see JsonCodec).
+
+    The JSON has much more than BundleInfo needs (prices, images, translations, the data of the
+    storefront...), only the subtrees of bundleData it reads are kept:
+
+        {
+            "bundleData": {
+                "basic_data": {"human_name": ...},
+                "machine_name": ...,
+                "tier_order": [...],
+                "tier_display_data": {tier: {"tier_item_machine_names": [...]}},
+                "tier_item_data": {item: {"human_name", "developers", "publishers", "description_text"}}
+            }
+        }
+
+    BundlePageBenchmark compares it with building the soup of the page
+
+"""
+import re
+
+from JsonCodec import loads
+
+BUNDLE_DATA_SCRIPT_ID = 'webpack-bundle-page-data'
+ITEM_KEYS = ('human_name', 'developers', 'publishers', 'description_text')
+SCRIPT_END = re.compile(rb'</script', re.IGNORECASE)
+
+
+def script_tag_pattern(script_id):
+    """
+        The start tag of the script whose id is script_id, with its attributes in any order
+    """
+    return re.compile(rb'<script\b[^>]*?\bid\s*=\s*(["\']?)' + re.escape(script_id.encode('ascii')) +
+                      rb'\1(?=[\s>/])[^>]*>', re.IGNORECASE)
+
+
+BUNDLE_DATA_SCRIPT_TAG = script_tag_pattern(BUNDLE_DATA_SCRIPT_ID)
+
+
+def find_script_end(page, start):
+    """
+        bytes.find is much faster than a case-insensitive regex over the whole JSON, the regex is only
+        used for an end tag in mixed case
+    :return: the position of the end tag of the script, -1 if there is none
+    """
+    ends = [end for end in (page.find(b'</script', start), page.find(b'</SCRIPT', start)) if end >= 0]
+    if ends:
+        return min(ends)
+    end_tag = SCRIPT_END.search(page, start)
+    return end_tag.start() if end_tag else -1
+
+
+def find_script_content(page, script_id=BUNDLE_DATA_SCRIPT_ID):
+    """
+        Looks for the id and checks that it's in the start tag of a script, the rest of the page isn't parsed
+    :param page: the page as bytes, or str
+    :return: the content of the script as bytes, or None if it isn't in the page
+    """
+    if isinstance(page, str):
+        page = page.encode('utf-8')
+    script_tag = BUNDLE_DATA_SCRIPT_TAG if script_id == BUNDLE_DATA_SCRIPT_ID else script_tag_pattern(script_id)
+    script_id = script_id.encode('ascii')
+    idx = page.find(script_id)
+    while idx >= 0:
+        tag_start = page.rfind(b'<', 0, idx)
+        start_tag = script_tag.match(page, tag_start) if tag_start >= 0 else None
+        if start_tag and (start_tag.end() > idx):
+            end = find_script_end(page, start_tag.end())
+            return page[start_tag.end():end] if end >= 0 else None
+        idx = page.find(script_id, idx + 1)
+    return None
+
+
+def prune_bundle_data(page_data):
+    """
+    :return: a new dictionary with only the parts of page_data used by BundleInfo
+    """
+    bundle_data = page_data.get('bundleData', {})
+    pruned_data = {}
+    if 'basic_data' in bundle_data:
+        pruned_data['basic_data'] = {'human_name': bundle_data['basic_data'].get('human_name', '')}
+    for key in ('machine_name', 'tier_order'):
+        if key in bundle_data:
+            pruned_data[key] = bundle_data[key]
+    if 'tier_display_data' in bundle_data:
+        pruned_data['tier_display_data'] = {
+            tier: {'tier_item_machine_names': tier_data.get('tier_item_machine_names', [])}
+            for tier, tier_data in bundle_data['tier_display_data'].items()
+        }
+    if 'tier_item_data' in bundle_data:
+        pruned_data['tier_item_data'] = {
+            item_name: {key: item[key] for key in ITEM_KEYS if key in item}
+            for item_name, item in bundle_data['tier_item_data'].items()
+        }
+    return {'bundleData': pruned_data}
+
+
+def extract_bundle_data(page):
+    """
+    :return: the bundle data of the page, ready for BundleInfo, or None if the page doesn't have it
+    :raise ValueError: if the content of the script isn't valid JSON
+    """
+    content = find_script_content(page)
+    if content is None:
+        return None
+    return prune_bundle_data(loads(content))
@@ -0,0 +1,128 @@
+"""
+    Offline benchmark of the extraction of the bundle data from a Humble Bundle page
+
+    Each page is extracted in three ways:
+     - soup: the tree of the whole page with BeautifulSoup, the script found in it and json.loads
+     - scan_json: the script found in the raw bytes (BundlePage), decoded with json and pruned
+     - scan: the same with the decoder of JsonCodec (orjson if it's installed)
+
+    and the dictionary is given to BundleInfo, as extract_humble_dict_from_page does. The three must
+    build the same BundleInfo. For each case it reports the median and best time, the peak memory
+    allocated (tracemalloc) and the speedup against soup
+
+    The pages are the humble_bundle fixtures of BenchmarkFixtures. A page saved from Humble Bundle can
+    be added with -p, or replace a fixture file
+
+    The medians are compared with a baseline (BenchmarkBaseline)
+
+    Usage: python BundlePageBenchmark.py [-r repeats] [-t threshold] [-b baseline_file] [-s] [-p page_file]
+
+"""
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from BenchmarkBaseline import BaselineComparison, BenchmarkOption, benchmark_main, DEFAULT_REPEATS, \
+    DEFAULT_THRESHOLD
+from BenchmarkFixtures import FIXTURE_SIZES, load_fixture
+from BundleInfo import BundleInfo
+from BundlePage import extract_bundle_data, find_script_content, prune_bundle_data, BUNDLE_DATA_SCRIPT_ID
+from JsonCodec import get_backend
+from utils import HTML_PARSER
+
+BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bundle_page_baseline.json')
+BUNDLE_KEYS = ('name', 'machine_name', 'tier_item_data', 'tier_order', 'tier_display_data')
+
+
+def extract_soup(page):
+    soup = BeautifulSoup(page, HTML_PARSER)
+    return json.loads(soup.find('script', {'id': BUNDLE_DATA_SCRIPT_ID}).string)
+
+
+def extract_scan_json(page):
+    return prune_bundle_data(json.loads(find_script_content(page)))
+
+
+EXTRACTORS = {
+    'soup': extract_soup,
+    'scan_json': extract_scan_json,
+    'scan': extract_bundle_data,
+}
+
+
+def build_bundle_info(extractor, page):
+    # BundleInfo complains about the missing backup file
+    with contextlib.redirect_stdout(io.StringIO()):
+        return BundleInfo(extractor(page))
+
+
+def load_pages(page_files):
+    pages = {f'fixture_{size}': load_fixture('humble_bundle', size) for size in FIXTURE_SIZES}
+    for page_file in page_files:
+        with open(page_file, 'rb') as page:
+            pages[os.path.splitext(os.path.basename(page_file))[0]] = page.read()
+    return pages
+
+
+def run_case(extractor, page, repeats):
+    timings = []
+    bundle_info = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        bundle_info = build_bundle_info(extractor, page)
+        timings.append(time.perf_counter() - start)
+    # memory is measured in a separate run, tracemalloc slows down the parsing
+    tracemalloc.start()
+    try:
+        build_bundle_info(extractor, page)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'median': statistics.median(timings),
+        'best': min(timings),
+        'peak_memory': peak_memory,
+        'bundle': {key: bundle_info[key] for key in BUNDLE_KEYS},
+    }
+
+
+def run_benchmark(repeats=DEFAULT_REPEATS, threshold=DEFAULT_THRESHOLD, baseline_file=BASELINE_FILENAME,
+                  update_baseline=False, page_files=()):
+    """
+    :return: True if every extractor builds the same bundle and no case is slower than the baseline
+        by more than threshold percent
+    """
+    comparison = BaselineComparison(baseline_file, threshold)
+    print(f'Parser: {HTML_PARSER}, decoder: {get_backend()}, {repeats} repeats')
+    print(f'{"case":<36}{"KB":>8}{"median ms":>11}{"best ms":>10}{"peak KB":>10}{"speedup":>9}{"change":>9}')
+    for page_name, page in load_pages(page_files).items():
+        page_results = {}
+        for extractor_name, extractor in EXTRACTORS.items():
+            name = f'{page_name}_{extractor_name}'
+            result = page_results[extractor_name] = run_case(extractor, page, repeats)
+            change = comparison.compare(name, result['median'])
+            speedup = page_results['soup']['median'] / result['median'] if result['median'] else 0
+            print(f'{name:<36}{len(page) / 1024:>8.0f}{1000 * result["median"]:>11.2f}'
+                  f'{1000 * result["best"]:>10.2f}{result["peak_memory"] / 1024:>10.0f}{speedup:>8.1f}x{change:>9}')
+            if result['bundle'] != page_results['soup']['bundle']:
+                print(f'    {name} builds a different bundle than soup', file=sys.stderr)
+                comparison.add_failure(name)
+    return comparison.finish(update_baseline,
+                             problem=f'different or more than {threshold}% slower than the baseline')
+
+
+def main():
+    return benchmark_main('Bundle page benchmark', run_benchmark, BASELINE_FILENAME, extra_options=[
+        BenchmarkOption('p', 'page', 'page_files', 'A Humble Bundle page saved to a file, can be repeated',
+                        repeated=True)])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
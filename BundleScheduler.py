@@ -0,0 +1,122 @@
+"""
+    Runs the pipeline of several bundles at the same time
+
+    The bundles are independent, so up to run_parameters['bundle_workers'] of them are processed in
+    parallel. All of them share the module-level resources (HTTP session, selenium driver pool and
+    download pool), and each one keeps its own backup file and output folder.
+
+    When more than one bundle is running, everything printed by a bundle's thread goes to its own log
+    file, next to its backup file, instead of being mixed in the console
+
+"""
+import os
+import sys
+import threading
+from functools import partial
+
+from BundleInfo import BundleException
+from utils import run_parameters, get_backup_file, get_backup_folder
+
+
+class ThreadOutputRouter:
+    """
+        A replacement for sys.stdout/sys.stderr that writes to a different file for each thread
+
+        Threads that haven't set a file write to the original stream
+    """
+
+    def __init__(self, stream):
+        self.__stream = stream
+        self.__thread_data = threading.local()
+
+    def set_thread_output(self, output_file):
+        self.__thread_data.output = output_file
+
+    def get_thread_output(self):
+        return getattr(self.__thread_data, 'output', None)
+
+    def write(self, text):
+        output = getattr(self.__thread_data, 'output', None)
+        return (output or self.__stream).write(text)
+
+    def flush(self):
+        output = getattr(self.__thread_data, 'output', None)
+        (output or self.__stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.__stream, name)
+
+
+def with_current_output(target):
+    """
+        Wraps target so that, when run in another thread, it writes to the same place as the current thread
+    """
+    outputs = [stream.get_thread_output() if isinstance(stream, ThreadOutputRouter) else None
+               for stream in (sys.stdout, sys.stderr)]
+
+    def run_with_output(*args, **kwargs):
+        for stream, output in zip((sys.stdout, sys.stderr), outputs):
+            if output and isinstance(stream, ThreadOutputRouter):
+                stream.set_thread_output(output)
+        return target(*args, **kwargs)
+    return run_with_output
+
+
+def get_bundle_log_file(data_source, is_file):
+    backup_file = data_source if is_file else get_backup_file(data_source)
+    return f'{backup_file}.log'
+
+
+def run_bundle_with_log(bundle_processor, is_file, data_source):
+    log_filename = get_bundle_log_file(data_source, is_file)
+    print(f'Processing {data_source}, output in {log_filename}')
+    with open(log_filename, 'a', encoding='utf-8') as log_file:
+        sys.stdout.set_thread_output(log_file)
+        sys.stderr.set_thread_output(log_file)
+        try:
+            bundle_processor(data_source)
+        except (BundleException, Exception) as err:
+            # BundleException is a BaseException
+            print(f'Error processing {data_source} - {err}', file=sys.stderr)
+            return False
+        except BaseException as err:
+            # KeyboardInterrupt, SystemExit... stop the run: run_bundles raises them again in the main
+            # thread, a thread of the pool that raises them dies and the pool waits for it forever
+            print(f'Stopped processing {data_source} - {err!r}', file=sys.stderr)
+            return err
+        finally:
+            sys.stdout.set_thread_output(None)
+            sys.stderr.set_thread_output(None)
+    print(f'Finished {data_source}')
+    return True
+
+
+def run_bundles(data_sources, bundle_processor, is_file=False, concurrency=None):
+    """
+    :param data_sources: urls or backup files of the bundles
+    :param bundle_processor: function that runs the whole pipeline of one bundle
+    :param is_file: True if data_sources are backup files
+    :param concurrency: the number of bundles processed at the same time, by default
+                        run_parameters['bundle_workers']
+    """
+    if not concurrency:
+        concurrency = run_parameters.get('bundle_workers', 1)
+    concurrency = min(concurrency, len(data_sources))
+    if concurrency <= 1:
+        for data_source in data_sources:
+            bundle_processor(data_source)
+        return
+    # multiprocessing is slow to import and a single bundle doesn't need it
+    from multiprocessing.pool import ThreadPool
+    os.makedirs(get_backup_folder(), exist_ok=True)
+    original_stdout, original_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadOutputRouter(original_stdout), ThreadOutputRouter(original_stderr)
+    try:
+        with ThreadPool(processes=concurrency) as bundle_pool:
+            results = bundle_pool.map(partial(run_bundle_with_log, bundle_processor, is_file), data_sources)
+    finally:
+        sys.stdout, sys.stderr = original_stdout, original_stderr
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    print(f'{sum(results)}/{len(data_sources)} bundles processed without errors')
@@ -1,33 +1,169 @@
 """
     Handles the connections to different URLs.
 
-    Access to Humble Bundle is done using Requests
-    Access to LibGen is usually done with Opera webdriver because it's sometimes blocked by ISP
+    The pages are fetched with the transport that works for their host (see Transports): requests,
+    requests through run_parameters['http_proxy'] or the Opera webdriver, for the hosts blocked by the ISP
+
+    The requests-based fetches share two requests.Session, a direct one and one through the proxy, so the
+    connections to each host are pooled and kept alive between pages and books. Failed requests are
+    retried with exponential backoff. The books are downloaded with the session of their host
+
+    All the fetches, with requests or with selenium, wait for their turn in the per-host RateLimiter
+
+    selenium and tqdm are imported by the functions that use them, a run that doesn't use the browser
+    or doesn't download anything doesn't load them
+
+    Books downloaded with requests can be resumed (Range/If-Range) after a lost connection or a restart
+
+    The MD5 of a book downloaded in a single stream is computed while it's written, a resumed file only
+    reads back the part downloaded before. A book that doesn't match the MD5 of LibGen is quarantined
+    (see ContentIndex)
+
+    Books bigger than run_parameters['segmented_download_min_size'] are split in
+    run_parameters['download_segments'] byte ranges downloaded in parallel into a preallocated file,
+    if the server accepts ranges. Some mirrors throttle each connection, not each client. The progress of
+    the segments is saved every SEGMENT_SAVE_INTERVAL bytes, a killed process resumes from there
 
 """
+import hashlib
+import json
 import os
 import sys
 import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from urllib.parse import urlparse
 
 import requests
 from bs4 import BeautifulSoup
 from requests import codes
-import selenium
-if selenium.__version__ == '3.141.0':
-    from selenium.webdriver.common.keys import Keys
-else:
-    from selenium.webdriver import Keys
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.common.by import By
-from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from ContentIndex import hash_file, verify_file, get_book_md5, ChecksumMismatch
+from DownloadMonitor import data_received, current_download_monitor, watch_response, DownloadCancelled
+from MirrorScoreboard import get_mirror_scoreboard
+from RateLimiter import get_rate_limiter, THROTTLE_STATUS
 from resources import humble_resources
-from utils import generate_filename, libgen_search
+from utils import generate_filename, libgen_search, HTML_PARSER, run_parameters
+
+# number of hosts that keep a connection pool and number of connections kept alive in each pool
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+# retry policy: sleeps backoff_factor * 2 ^ (retry - 1) seconds between retries
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 1
+# 429 and 503 aren't retried by urllib3 but by RateLimitedAdapter, waiting in the queue of the host
+HTTP_RETRY_STATUS = (500, 502, 504)
+RATE_LIMIT_RETRIES = 5
+# Cloudflare marks its browser challenges (403/503) with this header, they aren't throttling
+CHALLENGE_HEADER = 'cf-mitigated'
+
+# books are downloaded into a partial file, next to a file with the data needed to resume them
+PARTIAL_EXTENSION = '.part'
+RESUME_STATE_EXTENSION = '.json'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_RESUME_RETRIES = 5
+SEGMENT_RETRIES = 5
+SEGMENT_SAVE_INTERVAL = 8 * 1024 * 1024
+
+http_session_mutex = Lock()
+# use_proxy -> requests.Session
+http_sessions = {}
+# partial files being written, two attempts of the same book (hedged downloads) never share one
+part_files_mutex = Lock()
+part_files_in_use = set()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+        Every request waits for its turn in the RateLimiter of its host, and the throttled answers
+        (429/503) are requested again after the pause the host asks for
+    """
+
+    def send(self, request, **kwargs):
+        rate_limiter = get_rate_limiter()
+        host = urlparse(request.url).hostname
+        retries = RATE_LIMIT_RETRIES
+        while True:
+            rate_limiter.acquire(host)
+            response = super().send(request, **kwargs)
+            if response.headers.get(CHALLENGE_HEADER, '') == 'challenge':
+                # see Transports
+                return response
+            rate_limiter.response_received(host, response.status_code, response.headers.get('Retry-After', None))
+            if (response.status_code not in THROTTLE_STATUS) or (retries <= 0):
+                return response
+            retries -= 1
+            response.close()
+
+
+def wait_for_host(url):
+    """
+        The pages loaded with selenium also wait for their turn, but the browser doesn't give us the HTTP status
+    """
+    get_rate_limiter().acquire(urlparse(url).hostname)
+
+
+def build_http_session(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                       max_retries=HTTP_MAX_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR, proxy=''):
+    retry_policy = Retry(total=max_retries,
+                         backoff_factor=backoff_factor,
+                         status_forcelist=HTTP_RETRY_STATUS,
+                         allowed_methods=frozenset(['GET', 'HEAD']),
+                         # urllib3 would retry the 429/503 with Retry-After before RateLimitedAdapter sees them
+                         respect_retry_after_header=False,
+                         raise_on_status=False)
+    adapter = RateLimitedAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                 max_retries=retry_policy)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if proxy:
+        # the environment proxies would take precedence over the ones of the session
+        session.trust_env = False
+        session.proxies = {'http': proxy, 'https': proxy}
+    return session
+
+
+def get_http_session(use_proxy=None):
+    """
+        Returns a session shared by all the requests-based fetches, creating it on first use
+    :param use_proxy: the session through run_parameters['http_proxy'] or the direct one,
+        by default the proxy is used if there is one
+    """
+    proxy = run_parameters.get('http_proxy', '')
+    if use_proxy is None:
+        use_proxy = bool(proxy)
+    with http_session_mutex:
+        if use_proxy not in http_sessions:
+            http_sessions[use_proxy] = build_http_session(proxy=proxy if use_proxy else '')
+        return http_sessions[use_proxy]
+
+
+def get_book_session(book_url):
+    from Transports import get_transport_selector
+    return get_transport_selector().get_session(book_url)
+
+
+def close_http_session():
+    with http_session_mutex:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
 
 
 def scroll_to_end():
     if not libgen_search.get('do_scroll', False):
         return
+    import selenium
+    if selenium.__version__ == '3.141.0':
+        from selenium.webdriver.common.keys import Keys
+    else:
+        from selenium.webdriver import Keys
+    from selenium.common.exceptions import NoSuchElementException
+    from selenium.webdriver.common.by import By
     keep_scrolling = True
     i = 3
     while keep_scrolling:
@@ -40,29 +176,25 @@ def scroll_to_end():
             keep_scrolling = False
 
 
-def get_soup_from_page(current_url, use_opera_vpn=True):
-    if use_opera_vpn:
-        return get_soup_from_page_selenium(current_url)
-    else:
-        return get_soup_from_page_requests(current_url)
+def get_page(current_url, allow_browser=True):
+    """
+    :param allow_browser: False for the pages that are never fetched with the browser (Humble Bundle)
+    :return: the content of the page, bytes or str if it comes from the browser, or None
+    """
+    from Transports import get_transport_selector
+    return get_transport_selector().get_page(current_url, allow_browser=allow_browser)
 
 
-def get_soup_from_page_requests(current_url):
-    req = requests.get(current_url, timeout=30)
-    if req.status_code != requests.codes.ok:
+def get_soup_from_page(current_url, allow_browser=True, parse_only=None):
+    """
+    :param parse_only: a SoupStrainer to build the tree only with the parts of the page we need
+    """
+    page = get_page(current_url, allow_browser=allow_browser)
+    if page is None:
         return None
-    response = req.content
-    soup = BeautifulSoup(response, 'html.parser', from_encoding='utf-8')
-    return soup
-
-
-def get_soup_from_page_selenium(current_url):
-    humble_resources.driver.driver.set_page_load_timeout(3000)
-    humble_resources.driver.driver.get(current_url)
-    # FIXME anna's archive -> necesita scroll
-    scroll_to_end()
-    soup = BeautifulSoup(humble_resources.driver.driver.page_source, 'html.parser', from_encoding='utf-8')
-    return soup
+    # the browser gives the page already decoded
+    from_encoding = 'utf-8' if isinstance(page, bytes) else None
+    return BeautifulSoup(page, HTML_PARSER, from_encoding=from_encoding, parse_only=parse_only)
 
 
 def get_filename_from_header(request, md5):
@@ -78,64 +210,421 @@ def get_filename_from_header(request, md5):
     return filename
 
 
+def get_total_size(response):
+    """
+        The size of the whole file: in a partial response it's at the end of Content-Range (bytes 0-99/1234)
+    """
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    return int(response.headers.get('content-length', 0))
+
+
+def get_validators(response):
+    return {
+        'etag': response.headers.get('ETag', ''),
+        'last_modified': response.headers.get('Last-Modified', '')
+    }
+
+
+def load_resume_state(part_file):
+    try:
+        with open(part_file + RESUME_STATE_EXTENSION, 'r', encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_resume_state(part_file, state):
+    # a process killed while writing the state leaves the previous one
+    temp_file = part_file + RESUME_STATE_EXTENSION + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_file, part_file + RESUME_STATE_EXTENSION)
+
+
+def can_resume(state, response):
+    """
+        A partial file can be resumed if the server accepts ranges and the file hasn't changed since
+        the partial file was started
+    """
+    if not state:
+        return False
+    if response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return False
+    for validator, value in get_validators(response).items():
+        if state.get(validator, '') and value and state[validator] != value:
+            return False
+    total_size = get_total_size(response)
+    return not (state.get('total_size', 0) and total_size and state['total_size'] != total_size)
+
+
+def request_range(book_url, offset, state, end=''):
+    headers = {'Range': f'bytes={offset}-{end}'}
+    # If-Range makes the server send the whole file if it has changed
+    if_range = state.get('etag', '') or state.get('last_modified', '')
+    if if_range:
+        headers['If-Range'] = if_range
+    return get_book_session(book_url).get(book_url, headers=headers, timeout=60 * 5, stream=True)
+
+
+def write_response(response, part_file, offset, total_size, hasher=None):
+    from tqdm import tqdm
+    with open(part_file, 'r+b' if offset else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        with tqdm(
+                total=total_size,
+                initial=offset,
+                desc='Progress',
+                unit='B',
+                unit_scale=True,
+                unit_divisor=1024
+        ) as progress:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                data_size = f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                progress.update(data_size)
+                data_received(data_size)
+
+
+def get_range_start(response):
+    """
+        The first byte of a partial response (Content-Range: bytes 100-999/1000)
+    """
+    content_range = response.headers.get('Content-Range', '')
+    first_byte = content_range.replace('bytes', '').strip().split('-', 1)[0]
+    return int(first_byte) if first_byte.isdigit() else 0
+
+
+def download_to_part_file(book_url, response, part_file):
+    """
+        Downloads the file into part_file, resuming it if possible
+
+        A partial file left by a previous run is resumed if the server allows it. If the connection is lost
+        the download is resumed from the last byte written, up to DOWNLOAD_RESUME_RETRIES times
+
+    :param response: the first response from the server, a GET or the Range request for the rest of
+        the partial file made by get_book_requests
+    :return: the resume state of the file, with the MD5 of its content, or None if the download failed
+    """
+    state = load_resume_state(part_file)
+    offset = 0
+    if response.status_code == codes.requested_range_not_satisfiable:
+        # nothing left to download
+        response.close()
+        return state
+    if response.status_code == codes.partial_content:
+        offset = get_range_start(response)
+    elif os.path.isfile(part_file) and os.path.getsize(part_file) and can_resume(state, response):
+        # the rest of the file is asked with a Range request
+        response.close()
+        response = None
+    else:
+        state = {'url': book_url, 'total_size': get_total_size(response), **get_validators(response)}
+        save_resume_state(part_file, state)
+    retries = DOWNLOAD_RESUME_RETRIES
+    hasher, hashed_size = None, -1
+    while True:
+        try:
+            if response is None:
+                offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+                print(f'Resuming {book_url} from byte {offset}')
+                response = request_range(book_url, offset, state)
+                if response.status_code == codes.requested_range_not_satisfiable:
+                    response.close()
+                    return state
+                if response.status_code == codes.ok:
+                    # the server sends the whole file again
+                    offset = 0
+                elif response.status_code != codes.partial_content:
+                    print(f'Unable to resume {book_url} - HTTP {response.status_code}', file=sys.stderr)
+                    response.close()
+                    return None
+            if offset != hashed_size:
+                # the bytes already in the file are read once, the rest is hashed as it arrives
+                hasher = hash_file(part_file, hashlib.md5(), size=offset) if offset else hashlib.md5()
+            with response, watch_response(response):
+                write_response(response, part_file, offset, state['total_size'], hasher=hasher)
+            state['md5'] = hasher.hexdigest()
+            return state
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as err:
+            retries -= 1
+            if retries < 0:
+                print(f'Unable to download {book_url} - {err}', file=sys.stderr)
+                return None
+            print(f'Connection lost downloading {book_url} - {err}', file=sys.stderr)
+            response = None
+            # every chunk written has been hashed
+            hashed_size = os.path.getsize(part_file) if (hasher and os.path.isfile(part_file)) else -1
+
+
+def split_in_segments(total_size, num_segments):
+    """
+    :return: a list of [first byte, last byte, bytes downloaded]
+    """
+    if total_size <= 0:
+        return []
+    segment_size = -(-total_size // max(1, num_segments))
+    return [[start, min(start + segment_size, total_size) - 1, 0] for start in range(0, total_size, segment_size)]
+
+
+def download_segment(segment, book_url, part_file, state, progress, monitor=None, save_progress=None):
+    """
+        Downloads one byte range into its place of the partial file, retrying from the last byte written
+
+        A response that doesn't add anything to the segment counts as a failed retry
+    :param save_progress: called every SEGMENT_SAVE_INTERVAL bytes, to save the resume state
+    """
+    start, end = segment[0], segment[1]
+    segment_size = end - start + 1
+    retries = SEGMENT_RETRIES
+    saved_size = segment[2]
+    while segment[2] < segment_size:
+        offset = start + segment[2]
+        try:
+            with request_range(book_url, offset, state, end=end) as response, watch_response(response, monitor):
+                if response.status_code != codes.partial_content:
+                    raise requests.exceptions.HTTPError(f'HTTP {response.status_code} for bytes {offset}-{end}')
+                with open(part_file, 'r+b') as f:
+                    f.seek(offset)
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[:segment_size - segment[2]]
+                        f.write(chunk)
+                        segment[2] += len(chunk)
+                        progress.update(len(chunk))
+                        data_received(len(chunk), monitor)
+                        if save_progress and (segment[2] - saved_size >= SEGMENT_SAVE_INTERVAL):
+                            f.flush()
+                            save_progress()
+                            saved_size = segment[2]
+            if start + segment[2] == offset:
+                raise requests.exceptions.RequestException(f'Empty response for bytes {offset}-{end}')
+        except requests.exceptions.RequestException as err:
+            retries -= 1
+            if retries < 0:
+                print(f'Unable to download bytes {offset}-{end} of {book_url} - {err}', file=sys.stderr)
+                return False
+            print(f'Retrying bytes {offset}-{end} of {book_url} - {err}', file=sys.stderr)
+    return True
+
+
+def use_segmented_download(response, part_file):
+    if run_parameters.get('download_segments', 1) <= 1:
+        return False
+    if response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return False
+    if get_total_size(response) < run_parameters.get('segmented_download_min_size', 0):
+        return False
+    # a partial file downloaded with a single stream is resumed with a single stream
+    state = load_resume_state(part_file)
+    return not (state and (not state.get('segments', None)) and os.path.isfile(part_file))
+
+
+def download_segmented(book_url, response, part_file):
+    """
+        Downloads the file in byte ranges using parallel connections
+
+        The progress of each segment is kept in the resume state, so an interrupted download only
+        requests the missing bytes
+    :return: the resume state of the file or None if any segment failed
+    """
+    from tqdm import tqdm
+    total_size = get_total_size(response)
+    state = load_resume_state(part_file)
+    if not (state and state.get('segments', None) and os.path.isfile(part_file) and can_resume(state, response)):
+        state = {'url': book_url, 'total_size': total_size, **get_validators(response),
+                 'segments': split_in_segments(total_size, run_parameters['download_segments'])}
+        # preallocate the whole file, each segment writes in its own place
+        with open(part_file, 'wb') as f:
+            f.truncate(total_size)
+        save_resume_state(part_file, state)
+    response.close()
+    state_mutex = Lock()
+
+    def save_progress():
+        with state_mutex:
+            save_resume_state(part_file, state)
+
+    pending_segments = [segment for segment in state['segments'] if segment[2] < segment[1] - segment[0] + 1]
+    print(f'Downloading {book_url} in {len(pending_segments)} segments')
+    with tqdm(
+            total=total_size,
+            initial=total_size - sum(segment[1] - segment[0] + 1 - segment[2] for segment in pending_segments),
+            desc='Progress',
+            unit='B',
+            unit_scale=True,
+            unit_divisor=1024
+    ) as progress:
+        try:
+            with ThreadPool(processes=len(pending_segments) or 1) as segment_pool:
+                # the segments run in other threads, they get the monitor of this one
+                results = segment_pool.map(partial(download_segment, book_url=book_url, part_file=part_file,
+                                                   state=state, progress=progress,
+                                                   monitor=current_download_monitor(),
+                                                   save_progress=save_progress),
+                                           pending_segments)
+        finally:
+            # a cancelled download keeps the progress of its segments
+            save_progress()
+    return state if all(results) else None
+
+
+def claim_part_file(target_filename):
+    with part_files_mutex:
+        part_file = target_filename + PARTIAL_EXTENSION
+        idx = 1
+        while part_file in part_files_in_use:
+            idx += 1
+            part_file = f'{target_filename}.{idx}{PARTIAL_EXTENSION}'
+        part_files_in_use.add(part_file)
+        return part_file
+
+
+def release_part_file(part_file):
+    with part_files_mutex:
+        part_files_in_use.discard(part_file)
+
+
+def remove_part_file(part_file):
+    for leftover_file in (part_file, part_file + RESUME_STATE_EXTENSION):
+        if os.path.isfile(leftover_file):
+            os.remove(leftover_file)
+
+
+def open_book_request(book_url, path, filename):
+    """
+        If a previous run left a partial file of filename, only the rest of it is asked for
+    :return: the response of a Range request for the rest of the partial file, or of a GET
+    """
+    if filename:
+        part_file = os.path.join(path, filename) + PARTIAL_EXTENSION
+        with part_files_mutex:
+            in_use = part_file in part_files_in_use
+        state = None if in_use else load_resume_state(part_file)
+        # the segmented downloads ask for each of their segments
+        if state and (not state.get('segments', None)) and os.path.isfile(part_file) and os.path.getsize(part_file):
+            offset = os.path.getsize(part_file)
+            print(f'Resuming {book_url} from byte {offset}')
+            return request_range(book_url, offset, state)
+    return get_book_session(book_url).get(book_url, timeout=60 * 5, stream=True)
+
+
 def get_book_requests(book_url, path, filename, extension='', md5=''):
-    if book_url:
-        print(f'Requesting book from {book_url}')
-        file_req = requests.get(book_url, book_url, timeout=60 * 5, stream=True)
+    """
+        Downloads a book into "filename.part" and renames it to its final name when it's complete
+
+        The partial file and its resume state (filename.part.json) are kept if the download fails,
+        so the next run can resume it
+
+        The segments of a segmented download arrive out of order, its MD5 is computed when it's complete
+    :raise ChecksumMismatch: if the content isn't the one of md5, the file is quarantined
+    :return: the full filename of the book or None if it couldn't be downloaded
+    """
+    if not book_url:
+        return None
+    print(f'Requesting book from {book_url}')
+    request_start = time.monotonic()
+    file_req = open_book_request(book_url, path, filename)
+    ttfb = time.monotonic() - request_start
+    # closing the response returns the connection to the pool
+    with file_req:
+        if file_req.status_code not in (codes.ok, codes.partial_content, codes.requested_range_not_satisfiable):
+            print(f'Unable to download {book_url} - HTTP {file_req.status_code}', file=sys.stderr)
+            return None
         if not filename:
             filename = get_filename_from_header(file_req, md5)
-        total_size = int(file_req.headers.get('content-length', 0))
-        if file_req.status_code == codes.ok:
+        total_size = get_total_size(file_req)
+        target_filename = os.path.join(path, filename)
+        if total_size and os.path.isfile(target_filename) and (os.path.getsize(target_filename) == total_size):
+            print(f'Book already downloaded in {target_filename}')
+            return target_filename
+        part_file = claim_part_file(target_filename)
+        try:
+            transfer_start = time.monotonic()
+            if use_segmented_download(file_req, part_file):
+                state = download_segmented(book_url, file_req, part_file)
+            else:
+                state = download_to_part_file(book_url, file_req, part_file)
+            if not state:
+                return None
+            downloaded_size = os.path.getsize(part_file)
+            if state['total_size'] and (downloaded_size != state['total_size']):
+                print(f'Incomplete download {book_url}: {downloaded_size} of {state["total_size"]} bytes',
+                      file=sys.stderr)
+                return None
+            get_mirror_scoreboard().transfer_finished(book_url, ttfb, downloaded_size,
+                                                      time.monotonic() - transfer_start)
+            if not verify_file(part_file, get_book_md5(md5, book_url), actual_md5=state.get('md5', None),
+                               name=filename):
+                remove_part_file(part_file)
+                raise ChecksumMismatch(f'The content of {book_url} is not {md5}')
+            monitor = current_download_monitor()
+            if monitor and not monitor.claim_finish():
+                raise DownloadCancelled(f'Another attempt has downloaded {book_url} first')
             full_filename = generate_filename(path, filename, extension)
-            chunk_size = 5 * 1024
-            with open(full_filename, 'wb') as f:
-                with tqdm(
-                        total=total_size,
-                        desc='Progress',
-                        unit='B',
-                        unit_scale=True,
-                        unit_divisor=1024
-                ) as progress:
-                    for chunk in file_req.iter_content(chunk_size=chunk_size):
-                        data_size = f.write(chunk)
-                        progress.update(data_size)
-            print(f'Book downloaded successfully from {book_url} to {os.path.join(path, filename)}')
+            os.replace(part_file, full_filename)
+            os.remove(part_file + RESUME_STATE_EXTENSION)
+        except DownloadCancelled:
+            # another attempt has the book, this partial file won't be resumed
+            remove_part_file(part_file)
+            raise
+        finally:
+            release_part_file(part_file)
+    print(f'Book downloaded successfully from {book_url} to {full_filename}')
+    return full_filename
 
 
 def get_book_selenium(css_path):
-    download_url = humble_resources.driver.driver.current_url
-    try:
-        link = humble_resources.driver.driver.find_element(By.CSS_SELECTOR, css_path)
-        # delete_all_files(humble_resources.download_folder)
-        print(f'Acquiring semaphore {humble_resources.pool.max_download_limit}')
-        humble_resources.pool.max_download_limit.acquire()
-        link.click()
-        # espero para comprobar si no me redirecciona a página de error
-        time.sleep(1)
-        if humble_resources.driver.driver.current_url != download_url:
-            raise ConnectionError(humble_resources.driver.driver.find_element(By.TAG_NAME, 'body').text)
-        return True
-    except Exception as ex:
-        print(f'Unable to download {download_url} - {ex}', file=sys.stderr)
-        humble_resources.pool.max_download_limit.release()
+    """
+        Clicks on the download link of the page loaded in the browser, which must still be checked out
+        by this thread (OperaDriverPool.driver_in_use)
+    :raise DriverNotInUse: if the thread doesn't hold the browser that loaded the page
+    """
+    from selenium.webdriver.common.by import By
+    opera_driver = humble_resources.drivers.current_driver()
+    with opera_driver.mutex:
+        download_url = opera_driver.driver.current_url
+        try:
+            link = opera_driver.driver.find_element(By.CSS_SELECTOR, css_path)
+            # delete_all_files(humble_resources.download_folder)
+            print(f'Acquiring semaphore {humble_resources.pool.max_download_limit}')
+            humble_resources.pool.max_download_limit.acquire()
+            wait_for_host(link.get_attribute('href') or download_url)
+            link.click()
+            # espero para comprobar si no me redirecciona a página de error
+            time.sleep(1)
+            if opera_driver.driver.current_url != download_url:
+                raise ConnectionError(opera_driver.driver.find_element(By.TAG_NAME, 'body').text)
+            return True
+        except Exception as ex:
+            print(f'Unable to download {download_url} - {ex}', file=sys.stderr)
+            humble_resources.pool.max_download_limit.release()
     return False
 
 
 def get_book_selenium_by_url(url):
-    download_url = humble_resources.driver.driver.current_url
-    try:
-        print(f'Acquiring semaphore {humble_resources.pool.max_download_limit}')
-        humble_resources.pool.max_download_limit.acquire()
-        humble_resources.driver.driver.get(url)
-        # espero para comprobar si no me redirecciona a página de error
-        time.sleep(1)
+    from selenium.common.exceptions import NoSuchElementException
+    from selenium.webdriver.common.by import By
+    with humble_resources.drivers.driver_in_use() as opera_driver, opera_driver.mutex:
         try:
-            humble_resources.driver.driver.find_element(By.CSS_SELECTOR, 'body.neterror')
-            raise ConnectionError(humble_resources.driver.driver.find_element(By.TAG_NAME, 'body').text)
-        except NoSuchElementException:
-            pass
-        return True
-    except Exception as ex:
-        print(f'Unable to download {download_url} - {ex}', file=sys.stderr)
-        humble_resources.pool.release()
+            print(f'Acquiring semaphore {humble_resources.pool.max_download_limit}')
+            humble_resources.pool.max_download_limit.acquire()
+            wait_for_host(url)
+            opera_driver.driver.get(url)
+            # espero para comprobar si no me redirecciona a página de error
+            time.sleep(1)
+            try:
+                opera_driver.driver.find_element(By.CSS_SELECTOR, 'body.neterror')
+                raise ConnectionError(opera_driver.driver.find_element(By.TAG_NAME, 'body').text)
+            except NoSuchElementException:
+                pass
+            return True
+        except Exception as ex:
+            print(f'Unable to download {url} - {ex}', file=sys.stderr)
+            humble_resources.pool.max_download_limit.release()
     return False
@@ -0,0 +1,275 @@
+"""
+    Index of the books already downloaded, by the MD5 of their content
+
+    The books of every bundle are saved in output_root/bundle_name, so the same book found in several
+    bundles would be downloaded once for each. The index maps each MD5 to the file that has it
+    (a path relative to the output root) and is stored in a JSON file
+    (run_parameters['content_index_file'], by default output_root/content_index.json).
+
+    Before getting the mirrors of a book, download_books_from_bundle_item looks for its MD5 in the index:
+     - run_parameters['duplicate_books'] == 'link': the file is hard linked into the folder of the bundle
+       (or skipped if a hard link can't be made)
+     - 'skip': the book is marked as downloaded, the file stays where it is
+     - '': the book is downloaded again
+
+    The MD5 of a download is also checked against the MD5 LibGen gives for it. A file that doesn't match
+    is moved to the quarantine folder (run_parameters['quarantine_dir'], by default output_root/quarantine)
+
+    The key of the books found in libgen.li and libgen.rocks is the id of the edition, not the MD5: the
+    MD5 is taken from the download link (get.php?md5=...) if it has it, otherwise the file isn't checked.
+    Those books aren't kept in the index
+
+    The index of an output folder filled before it existed is built with:
+
+        python ContentIndex.py [-o output_dir]
+
+"""
+import getopt
+import hashlib
+import os
+import re
+import sys
+from threading import Lock
+
+from JsonCodec import read_json_state, write_json_state
+from utils import run_parameters, get_output_root, generate_filename
+
+CONTENT_INDEX_FILENAME = 'content_index.json'
+QUARANTINE_FOLDER = 'quarantine'
+HASH_BLOCK_SIZE = 1024 * 1024
+# partial downloads, resume states and the files of the browser aren't books
+NOT_BOOK_EXTENSIONS = ('.part', '.json', '.opdownload', '.tmp')
+MD5_REGEX = re.compile('^[0-9A-Fa-f]{32}$')
+MD5_IN_URL_REGEX = re.compile('md5=([0-9A-Fa-f]{32})')
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def hash_file(filename, hasher=None, size=None):
+    """
+    :param hasher: a hashlib object to update, a new md5 by default
+    :param size: hashes only the first size bytes of the file
+    :return: the hasher
+    """
+    if hasher is None:
+        hasher = hashlib.md5()
+    remaining = os.path.getsize(filename) if size is None else size
+    with open(filename, 'rb') as f:
+        while remaining > 0:
+            block = f.read(min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def is_md5(value):
+    return bool(value) and bool(MD5_REGEX.match(value))
+
+
+def get_book_md5(book_key, url=''):
+    """
+    :param book_key: the key of the book in books_found, an MD5 or the id of an edition in libgen.li
+    :param url: a link to the book, ads.php?md5=... or get.php?md5=...
+    :return: the MD5 of the book or '' if it isn't known
+    """
+    if is_md5(book_key):
+        return book_key
+    md5_in_url = MD5_IN_URL_REGEX.search(url or '')
+    return md5_in_url.group(1) if md5_in_url else ''
+
+
+def get_quarantine_dir():
+    quarantine_dir = run_parameters.get('quarantine_dir', '')
+    if not quarantine_dir:
+        quarantine_dir = os.path.join(get_output_root(), QUARANTINE_FOLDER)
+    os.makedirs(quarantine_dir, exist_ok=True)
+    return quarantine_dir
+
+
+def quarantine_file(filename, expected_md5, actual_md5, name=''):
+    """
+        Moves a file whose content isn't the expected one out of the bundle folders
+    :param name: the name of the book, by default the one of the file
+    :return: the new filename
+    """
+    quarantine_dir = get_quarantine_dir()
+    name = name or os.path.basename(filename)
+    quarantined_file = generate_filename(quarantine_dir, f'{expected_md5.lower()}_{name}', name.split('.')[-1])
+    os.replace(filename, quarantined_file)
+    print(f'MD5 mismatch in {filename}: expected {expected_md5.lower()}, got {actual_md5}. '
+          f'Moved to {quarantined_file}', file=sys.stderr)
+    return quarantined_file
+
+
+def verify_file(filename, expected_md5, actual_md5=None, name=''):
+    """
+        Quarantines the file if its MD5 isn't expected_md5
+    :param actual_md5: the MD5 computed while downloading the file, if known
+    :param name: the name of the book, if filename is a partial file
+    :return: True if the file is right, or if expected_md5 isn't an MD5
+    """
+    if (not is_md5(expected_md5)) or (not run_parameters.get('verify_md5', True)):
+        return True
+    if not actual_md5:
+        actual_md5 = hash_file(filename).hexdigest()
+    if actual_md5.lower() == expected_md5.lower():
+        return True
+    quarantine_file(filename, expected_md5, actual_md5, name=name)
+    return False
+
+
+class ContentIndex:
+
+    def __init__(self, output_root, index_file=None):
+        self.__output_root = output_root
+        self.__index_file = index_file
+        self.__mutex = Lock()
+        self.__books = read_json_state(self.__index_file, 'ContentIndex')
+
+    @property
+    def output_root(self):
+        return self.__output_root
+
+    @property
+    def num_books(self):
+        return len(self.__books)
+
+    def add(self, md5, filename):
+        if not (is_md5(md5) and os.path.isfile(filename)):
+            return
+        with self.__mutex:
+            self.__books[md5.lower()] = {
+                'path': os.path.relpath(os.path.abspath(filename), self.__output_root),
+                'size': os.path.getsize(filename)
+            }
+            write_json_state(self.__index_file, self.__books)
+
+    def lookup(self, md5):
+        """
+        :return: the full filename of the book, or None if it isn't in the index or the file has changed
+        """
+        if not is_md5(md5):
+            return None
+        with self.__mutex:
+            book = self.__books.get(md5.lower(), None)
+            if not book:
+                return None
+            filename = os.path.join(self.__output_root, book['path'])
+            if os.path.isfile(filename) and (os.path.getsize(filename) == book['size']):
+                return filename
+            # deleted or replaced since it was indexed
+            self.__books.pop(md5.lower())
+            write_json_state(self.__index_file, self.__books)
+            return None
+
+    def link_into(self, md5, path):
+        """
+            Hard links the book into path, unless a file with its name is already there
+        :return: the filename in path, or None if the book isn't in the index or can't be linked
+        """
+        filename = self.lookup(md5)
+        if not filename:
+            return None
+        if os.path.dirname(os.path.abspath(filename)) == os.path.abspath(path):
+            return filename
+        name = os.path.basename(filename)
+        target_filename = os.path.join(path, name)
+        if os.path.isfile(target_filename) and os.path.samefile(filename, target_filename):
+            return target_filename
+        target_filename = generate_filename(path, name, name.split('.')[-1])
+        try:
+            os.link(filename, target_filename)
+        except OSError as err:
+            # other file system, or one without hard links
+            print(f'Unable to link {filename} into {path} - {err}', file=sys.stderr)
+            return None
+        return target_filename
+
+    def rebuild(self):
+        """
+            Hashes every book in the folders of the output root
+        """
+        quarantine_dir = os.path.abspath(get_quarantine_dir())
+        books = {}
+        for folder, subfolders, files in os.walk(self.__output_root):
+            if os.path.abspath(folder) == quarantine_dir:
+                subfolders.clear()
+                continue
+            if os.path.abspath(folder) == os.path.abspath(self.__output_root):
+                # the bundle backups, the books are in the folder of each bundle
+                continue
+            for name in files:
+                if name.endswith(NOT_BOOK_EXTENSIONS):
+                    continue
+                filename = os.path.join(folder, name)
+                books[hash_file(filename).hexdigest()] = {
+                    'path': os.path.relpath(filename, self.__output_root),
+                    'size': os.path.getsize(filename)
+                }
+        with self.__mutex:
+            self.__books = books
+            write_json_state(self.__index_file, self.__books)
+
+
+def reuse_downloaded_book(md5, path):
+    """
+        Applies run_parameters['duplicate_books'] to a book already in the index
+    :return: the filename of the book, or None if it must be downloaded
+    """
+    duplicate_books = run_parameters.get('duplicate_books', 'link')
+    content_index = get_content_index()
+    if (not duplicate_books) or (not content_index):
+        return None
+    if duplicate_books == 'link':
+        linked_file = content_index.link_into(md5, path)
+        if linked_file:
+            return linked_file
+    return content_index.lookup(md5)
+
+
+content_index_mutex = Lock()
+content_index = None
+
+
+def get_content_index():
+    """
+        The index is created on first use, once parse_arguments has set the output dir
+    :return: the ContentIndex, or None if run_parameters['content_index'] is False
+    """
+    global content_index
+    if not run_parameters.get('content_index', True):
+        return None
+    with content_index_mutex:
+        if not content_index:
+            index_file = run_parameters.get('content_index_file', '')
+            if not index_file:
+                index_file = os.path.join(get_output_root(), CONTENT_INDEX_FILENAME)
+            content_index = ContentIndex(get_output_root(), index_file)
+        return content_index
+
+
+def main():
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], 'ho:')
+        for current_argument, current_value in arguments:
+            if current_argument == '-h':
+                print('Content index\n'
+                      '\tParameters: -h | -o "output_dir"\n'
+                      '-o Output dir of HumbleJson, whose books are hashed into its content index')
+                return
+            elif current_argument == '-o':
+                run_parameters['output_dir'] = current_value
+    except getopt.error as err:
+        print(str(err))
+        return
+    index = get_content_index()
+    index.rebuild()
+    print(f'{index.num_books} books indexed in {index.output_root}')
+
+
+if __name__ == '__main__':
+    main()
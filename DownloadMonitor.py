@@ -0,0 +1,262 @@
+"""
+    Watches the progress of a requests download so it can be abandoned
+
+    The download functions of Connections call data_received for each chunk written, with the monitor
+    bound to the current thread (monitor_download). A download is stopped raising:
+     - DownloadCancelled: another attempt of the same book has finished first (see the hedged downloads
+       in LibGenDownload)
+     - SlowDownload: after SLOW_DOWNLOAD_GRACE seconds, the throughput of the last THROUGHPUT_WINDOW
+       seconds is below run_parameters['min_download_throughput'] bytes/s
+
+    A stalled download doesn't receive chunks, so it's checked by a watchdog thread every
+    WATCHDOG_INTERVAL seconds too. The responses being read are registered with watch_response: when the
+    download is stopped their connections are shut down, so the thread blocked reading them gets an error
+    at once (check_download turns it into the reason of the stop) instead of waiting for the read timeout
+
+    The attempts of a hedged download share a DownloadRace: only the first one to finish keeps its file
+    (claim_finish), the others are cancelled
+
+    The partial file is kept, so the download can be resumed later
+
+"""
+import socket
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+
+from utils import run_parameters
+
+SLOW_DOWNLOAD_GRACE = 30
+THROUGHPUT_WINDOW = 10
+WATCHDOG_INTERVAL = 1
+
+thread_data = threading.local()
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class SlowDownload(Exception):
+    pass
+
+
+def abort_response(response):
+    """
+        Shuts down the connection of a requests response, a read blocked in another thread fails at once
+    """
+    # the socket the http.client response is reading from (urllib3 doesn't keep it in the connection)
+    http_response = getattr(response.raw, '_fp', None)
+    socket_io = getattr(getattr(http_response, 'fp', None), 'raw', None)
+    sock = getattr(socket_io, '_sock', None) or getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+class DownloadRace:
+    """
+        The attempts of the same book running at the same time
+    """
+
+    def __init__(self):
+        self.__mutex = Lock()
+        self.__monitors = []
+        self.__winner = None
+
+    def add(self, monitor):
+        with self.__mutex:
+            self.__monitors.append(monitor)
+
+    def claim_finish(self, monitor):
+        """
+        :return: True if monitor is the first attempt to finish, the rest are cancelled
+        """
+        with self.__mutex:
+            if self.__winner is None and not monitor.cancelled:
+                self.__winner = monitor
+            losers = [other for other in self.__monitors if other is not self.__winner]
+        for loser in losers:
+            loser.cancel()
+        return self.__winner is monitor
+
+
+class DownloadMonitor:
+
+    def __init__(self, min_throughput=None, grace_period=SLOW_DOWNLOAD_GRACE, race=None):
+        if min_throughput is None:
+            min_throughput = run_parameters.get('min_download_throughput', 0)
+        self.__min_throughput = min_throughput
+        self.__grace_period = grace_period
+        self.__cancelled = Event()
+        self.__stop_error = None
+        self.__mutex = Lock()
+        self.__start = time.monotonic()
+        self.__window_start = self.__start
+        self.__window_bytes = 0
+        self.__responses = set()
+        self.__race = race
+        if race:
+            race.add(self)
+
+    def cancel(self):
+        self._stop(DownloadCancelled('Download cancelled'))
+
+    def _stop(self, error):
+        with self.__mutex:
+            if self.__stop_error is None:
+                self.__stop_error = error
+            self.__cancelled.set()
+            responses = list(self.__responses)
+        for response in responses:
+            abort_response(response)
+
+    @property
+    def cancelled(self):
+        return self.__cancelled.is_set()
+
+    def check(self):
+        """
+        :raise DownloadCancelled, SlowDownload: if the download has been stopped
+        """
+        if self.__cancelled.is_set():
+            raise self.__stop_error
+
+    def claim_finish(self):
+        """
+            Called before a finished download is renamed to its final name
+        :return: False if the download has been stopped or another attempt of the book has finished first
+        """
+        if self.__race:
+            return self.__race.claim_finish(self)
+        return not self.cancelled
+
+    def add_response(self, response):
+        with self.__mutex:
+            self.__responses.add(response)
+            stopped = self.__cancelled.is_set()
+        if stopped:
+            abort_response(response)
+        elif self.__min_throughput:
+            start_watchdog(self)
+
+    def remove_response(self, response):
+        with self.__mutex:
+            self.__responses.discard(response)
+
+    def data_received(self, num_bytes):
+        """
+            Called from the download threads (several for a segmented download)
+        """
+        self.check()
+        if not self.__min_throughput:
+            return
+        with self.__mutex:
+            self.__window_bytes += num_bytes
+            now = time.monotonic()
+            window_time = now - self.__window_start
+            if window_time < THROUGHPUT_WINDOW:
+                return
+            throughput = self.__window_bytes / window_time
+            self.__window_start, self.__window_bytes = now, 0
+        if (now - self.__start >= self.__grace_period) and (throughput < self.__min_throughput):
+            # the other segments of the download stop too
+            self._stop(SlowDownload(f'{throughput / 1024:.1f} KB/s is below the minimum throughput'))
+            self.check()
+
+    def check_stalled(self):
+        """
+            Called by the watchdog, a download that doesn't receive anything doesn't call data_received
+        :return: False if the download doesn't have to be watched anymore
+        """
+        with self.__mutex:
+            if self.__cancelled.is_set() or not self.__responses:
+                return not self.__cancelled.is_set()
+            now = time.monotonic()
+            window_time = now - self.__window_start
+            throughput = self.__window_bytes / window_time if window_time else 0
+            stalled = (window_time >= THROUGHPUT_WINDOW) and (now - self.__start >= self.__grace_period) and \
+                (throughput < self.__min_throughput)
+        if stalled:
+            self._stop(SlowDownload(f'{throughput / 1024:.1f} KB/s is below the minimum throughput'))
+            return False
+        return True
+
+
+watchdog_mutex = Lock()
+watched_monitors = weakref.WeakSet()
+watchdog_thread = None
+
+
+def watchdog():
+    while True:
+        time.sleep(WATCHDOG_INTERVAL)
+        with watchdog_mutex:
+            monitors = list(watched_monitors)
+        for monitor in monitors:
+            if not monitor.check_stalled():
+                with watchdog_mutex:
+                    watched_monitors.discard(monitor)
+
+
+def start_watchdog(monitor):
+    global watchdog_thread
+    with watchdog_mutex:
+        watched_monitors.add(monitor)
+        if not watchdog_thread:
+            watchdog_thread = Thread(target=watchdog, name='download watchdog', daemon=True)
+            watchdog_thread.start()
+
+
+def current_download_monitor():
+    return getattr(thread_data, 'monitor', None)
+
+
+@contextmanager
+def monitor_download(monitor):
+    previous_monitor = current_download_monitor()
+    thread_data.monitor = monitor
+    try:
+        yield monitor
+    finally:
+        thread_data.monitor = previous_monitor
+
+
+@contextmanager
+def watch_response(response, monitor=None):
+    """
+        The response is shut down if the download is stopped while it's being read
+    """
+    monitor = monitor or current_download_monitor()
+    if not monitor:
+        yield response
+        return
+    monitor.add_response(response)
+    try:
+        yield response
+    except Exception:
+        # the error of a response shut down by the monitor
+        monitor.check()
+        raise
+    finally:
+        monitor.remove_response(response)
+
+
+def check_download(monitor=None):
+    monitor = monitor or current_download_monitor()
+    if monitor:
+        monitor.check()
+
+
+def data_received(num_bytes, monitor=None):
+    """
+        Reports a chunk to the given monitor or to the one of the current thread, if any
+    """
+    monitor = monitor or current_download_monitor()
+    if monitor:
+        monitor.data_received(num_bytes)
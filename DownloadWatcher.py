@@ -0,0 +1,307 @@
+"""
+    Detects when the browser finishes a download
+
+    The browser downloads big files with a temporary name ("name.opdownload") that is renamed to the
+    final name when the download is complete. Small files are written directly with their final name.
+
+    A DownloadWatcher follows the changes in one download folder and hands out futures:
+     - expect_download returns a Future that is resolved with the final filename of the next download
+       that starts in the folder (downloads are matched to the waiters in order of arrival)
+     - the future fails with a TimeoutError if no download starts in DOWNLOAD_START_TIMEOUT seconds or
+       if the file stops growing for DOWNLOAD_STALL_TIMEOUT seconds
+
+    On Linux the folder is watched with inotify (creation, growth and rename events), anywhere else, or
+    if inotify can't be used, the folder is polled every POLL_INTERVAL seconds
+
+    An error reading the folder is logged and the watcher goes on. If the folder has been removed (a
+    browser recycled by OperaDriverPool) the watcher stops, its futures fail with the error and
+    get_download_watcher creates a new one for the folder
+
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+TEMP_EXTENSION = '.opdownload'
+POLL_INTERVAL = 1
+# a file written without temporary name is complete when its size doesn't change for this time
+SETTLE_TIME = 3
+DOWNLOAD_START_TIMEOUT = 60
+DOWNLOAD_STALL_TIMEOUT = 600
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def get_base_name(filename):
+    if filename.endswith(TEMP_EXTENSION):
+        return filename[:-len(TEMP_EXTENSION)]
+    return filename
+
+
+class InotifyFolder:
+    """
+        Minimal inotify wrapper using ctypes, so no extra dependency is needed
+    """
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.__fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.__fd, os.fsencode(folder), INOTIFY_MASK) < 0:
+            os.close(self.__fd)
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {folder}')
+
+    def close(self):
+        os.close(self.__fd)
+
+    def read_events(self, timeout):
+        """
+        :return: a list of (mask, filename), empty if nothing happened in timeout seconds
+        """
+        readable, _, _ = select.select([self.__fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, name_length = INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT.size
+            name = buffer[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+
+class PendingDownload:
+
+    def __init__(self, base_name):
+        self.base_name = base_name
+        self.future = None
+        self.has_temp_file = False
+        self.renamed = False
+        self.size = -1
+        self.last_change = time.monotonic()
+
+
+class DownloadWatcher:
+    """
+        Follows the downloads in a folder. The events are processed in a daemon thread
+    """
+
+    def __init__(self, folder, use_inotify=True):
+        self.__folder = folder
+        self.__mutex = Lock()
+        # futures waiting for a download to start, with the time they were created
+        self.__waiters = deque()
+        # base name -> PendingDownload
+        self.__downloads = {}
+        # files that aren't downloads in progress: the ones already there and the finished downloads
+        self.__ignored_files = set(os.listdir(folder))
+        self.__last_listing = set(self.__ignored_files)
+        self.__inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self.__inotify = InotifyFolder(folder)
+            except (OSError, AttributeError, TypeError) as err:
+                print(f'DownloadWatcher: inotify not available, polling {folder} - {err}', file=sys.stderr)
+        self.__running = True
+        self.__thread = Thread(target=self._watch, name=f'DownloadWatcher {folder}', daemon=True)
+        self.__thread.start()
+
+    @property
+    def folder(self):
+        return self.__folder
+
+    @property
+    def uses_inotify(self):
+        return self.__inotify is not None
+
+    @property
+    def running(self):
+        return self.__running and self.__thread.is_alive()
+
+    def expect_download(self):
+        future = Future()
+        with self.__mutex:
+            # the download might have started before anybody asked for it
+            for download in self.__downloads.values():
+                if not download.future:
+                    download.future = future
+                    return future
+            self.__waiters.append((future, time.monotonic()))
+        return future
+
+    def stop(self):
+        self.__running = False
+        self.__thread.join()
+
+    def _fail_pending(self, error=None):
+        """
+            Nobody will resolve the futures once the thread ends: they are cancelled, or fail with error
+        """
+        with self.__mutex:
+            futures = [future for future, _ in self.__waiters]
+            futures += [download.future for download in self.__downloads.values() if download.future]
+            self.__waiters.clear()
+            self.__downloads.clear()
+        for future in futures:
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.cancel()
+
+    def _watch(self):
+        error = None
+        try:
+            while self.__running:
+                try:
+                    if not os.path.isdir(self.__folder):
+                        # inotify says nothing when the folder is removed
+                        raise FileNotFoundError(f'{self.__folder} has been removed')
+                    if self.__inotify:
+                        for mask, filename in self.__inotify.read_events(POLL_INTERVAL):
+                            self._process_event(mask, filename)
+                    else:
+                        time.sleep(POLL_INTERVAL)
+                        self._poll_folder()
+                    self._check_pending_downloads()
+                except Exception as err:
+                    print(f'DownloadWatcher: error watching {self.__folder} - {err}', file=sys.stderr)
+                    if not os.path.isdir(self.__folder):
+                        error = err
+                        break
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            self.__running = False
+            if self.__inotify:
+                self.__inotify.close()
+            self._fail_pending(error)
+
+    def _process_event(self, mask, filename):
+        if mask & (IN_CREATE | IN_MOVED_TO | IN_MODIFY | IN_CLOSE_WRITE):
+            self._file_changed(filename)
+        if mask & (IN_MOVED_FROM | IN_DELETE):
+            self._file_removed(filename)
+
+    def _poll_folder(self):
+        """
+            The same changes inotify reports, but found comparing listings of the folder
+        """
+        current_files = set(os.listdir(self.__folder))
+        for filename in self.__last_listing - current_files:
+            self._file_removed(filename)
+        for filename in current_files:
+            self._file_changed(filename)
+        self.__last_listing = current_files
+
+    def _get_size(self, filename):
+        try:
+            return os.path.getsize(os.path.join(self.__folder, filename))
+        except OSError:
+            return -1
+
+    def _file_changed(self, filename):
+        base_name = get_base_name(filename)
+        with self.__mutex:
+            download = self.__downloads.get(base_name, None)
+            if not download:
+                if filename in self.__ignored_files:
+                    return
+                download = PendingDownload(base_name)
+                if self.__waiters:
+                    download.future, _ = self.__waiters.popleft()
+                self.__downloads[base_name] = download
+            if filename.endswith(TEMP_EXTENSION):
+                download.has_temp_file = True
+            elif download.has_temp_file:
+                # the placeholder with the final name, the growth is followed in the temporary file
+                return
+            size = self._get_size(filename)
+            if size != download.size:
+                download.size = size
+                download.last_change = time.monotonic()
+
+    def _file_removed(self, filename):
+        with self.__mutex:
+            if not filename.endswith(TEMP_EXTENSION):
+                # a finished download moved out of the folder, the same name can be downloaded again
+                self.__ignored_files.discard(filename)
+                return
+            download = self.__downloads.get(get_base_name(filename), None)
+            if download:
+                # the temporary file has been renamed to its final name
+                download.has_temp_file = False
+                download.renamed = True
+                download.last_change = time.monotonic()
+
+    def _check_pending_downloads(self):
+        now = time.monotonic()
+        finished = []
+        with self.__mutex:
+            while self.__waiters and (now - self.__waiters[0][1] > DOWNLOAD_START_TIMEOUT):
+                future, _ = self.__waiters.popleft()
+                future.set_exception(TimeoutError(f'Download not started in {self.__folder}'))
+            for base_name, download in self.__downloads.items():
+                if not download.future:
+                    continue
+                final_exists = os.path.isfile(os.path.join(self.__folder, base_name))
+                if (not download.has_temp_file) and final_exists:
+                    if os.path.isfile(os.path.join(self.__folder, base_name + TEMP_EXTENSION)):
+                        # a rename event was lost, check again in the next loop
+                        download.has_temp_file = True
+                        continue
+                    size = self._get_size(base_name)
+                    if download.renamed:
+                        finished.append(base_name)
+                        download.future.set_result(base_name)
+                    elif size != download.size:
+                        download.size = size
+                        download.last_change = now
+                    elif (size > 0) and (now - download.last_change >= SETTLE_TIME):
+                        finished.append(base_name)
+                        download.future.set_result(base_name)
+                elif now - download.last_change > DOWNLOAD_STALL_TIMEOUT:
+                    finished.append(base_name)
+                    download.future.set_exception(TimeoutError(f'Download of {base_name} stalled'))
+            for base_name in finished:
+                self.__downloads.pop(base_name)
+                self.__ignored_files.add(base_name)
+
+
+watchers_mutex = Lock()
+download_watchers = {}
+
+
+def get_download_watcher(folder):
+    with watchers_mutex:
+        if (folder not in download_watchers) or (not download_watchers[folder].running):
+            download_watchers[folder] = DownloadWatcher(folder)
+        return download_watchers[folder]
+
+
+def stop_all_watchers():
+    with watchers_mutex:
+        for watcher in download_watchers.values():
+            watcher.stop()
+        download_watchers.clear()
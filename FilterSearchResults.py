@@ -3,17 +3,88 @@
 
     We take all the books found using the title as the keywords and discard the ones that
     don't match enough words in the title or author fields
+
+    The matching is done by BatchMatcher: every title is normalized only once (the tokens are interned
+    and cached) and the candidates are put in an inverted index token -> candidates, so many Humble
+    items can be filtered against many LibGen results in one pass
 """
 import re
+import sys
+from collections import Counter
+from functools import lru_cache
+
+VALID_EXTENSIONS = ('epub', 'mobi', 'pdf')
+# a candidate is discarded when this number of words of the Humble title are not in its title
+MAX_MISMATCHES = 3
+
+non_word_regex = re.compile(r'\W+')
 
 
 def sanitize_word(x):
-    x = re.sub(r'\W+', '', x)
+    x = non_word_regex.sub('', x)
     if x.isdigit():
         return ''
     return x
 
 
+@lru_cache(maxsize=65536)
+def normalize_words(text):
+    """
+        The words longer than two characters, lowercase and sanitized. The list keeps repeated words
+    """
+    return tuple(sys.intern(sanitize_word(x)) for x in text.lower().split() if len(x) > 2)
+
+
+class BatchMatcher:
+    """
+        Inverted index of the LibGen results: token -> ids of the candidates with that token in the title
+
+        A Humble item matches a candidate if less than MAX_MISMATCHES of its title words
+        (counting repetitions) are missing in the candidate title
+    """
+
+    def __init__(self, libgen_dict=None):
+        self.__candidates = []
+        self.__index = {}
+        if libgen_dict:
+            self.add_candidates(libgen_dict)
+
+    def add_candidates(self, libgen_dict):
+        for libgen_item, book in libgen_dict.items():
+            if not (book['extension'] and book['extension'] in VALID_EXTENSIONS):
+                continue
+            candidate_id = len(self.__candidates)
+            self.__candidates.append((libgen_item, book))
+            for token in set(normalize_words(book['title'])):
+                self.__index.setdefault(token, []).append(candidate_id)
+
+    def matching_ids(self, humble_dict):
+        title_words = normalize_words(humble_dict['name'])
+        hits = Counter()
+        for word in title_words:
+            hits.update(self.__index.get(word, ()))
+        min_hits = len(title_words) - MAX_MISMATCHES + 1
+        if min_hits <= 0:
+            # not enough words to reach the mismatch limit, everything matches
+            return range(len(self.__candidates))
+        return sorted(candidate_id for candidate_id, num_hits in hits.items() if num_hits >= min_hits)
+
+    def filter(self, humble_dict):
+        # TODO sometimes humble author may be empty, the author is not used to filter
+        filtered_dict = {}
+        for candidate_id in self.matching_ids(humble_dict):
+            libgen_item, book = self.__candidates[candidate_id]
+            filtered_dict[libgen_item] = book
+        return filtered_dict
+
+    def filter_many(self, humble_items):
+        """
+        :param humble_items: a dictionary of Humble items, as in tier_item_data
+        :return: a dictionary with the filtered candidates of each item
+        """
+        return {key: self.filter(item) for key, item in humble_items.items()}
+
+
 def filter_search_results(humble_dict, libgen_dict):
     """
 
@@ -22,35 +93,7 @@ def filter_search_results(humble_dict, libgen_dict):
     :return:
 
         filter criteria:
-            - all words in humble title must be in libgen title
-            - at least one match in author words
+            - all words in humble title must be in libgen title (up to two missing words are allowed)
+            - the extension must be epub, mobi or pdf
     """
-    match_author = False
-    humble_author_words = list(filter(lambda x: len(x) > 2, humble_dict['author'].lower().split()))
-    humble_title_words = list(filter(lambda x: len(x) > 2, humble_dict['name'].lower().split()))
-    humble_author_words = list(map(sanitize_word, humble_author_words))
-    humble_title_words = list(map(sanitize_word, humble_title_words))
-    filtered_dict = {}
-    for libgen_item in libgen_dict:
-        if libgen_dict[libgen_item]['extension'] and libgen_dict[libgen_item]['extension'] in ('epub', 'mobi', 'pdf'):
-            libgen_title = list(filter(lambda x: len(x) > 2, libgen_dict[libgen_item]['title'].lower().split()))
-            libgen_title = set(map(sanitize_word, libgen_title))
-            title_match = True
-            mismatchs = 3
-            for word in humble_title_words:
-                if word in libgen_title:
-                    continue
-                mismatchs -= 1
-                if mismatchs == 0:
-                    title_match = False
-                    break
-            # TODO sometimes humble author may be empty
-            author_match = not match_author
-            if match_author:
-                libgen_author = list(filter(lambda x: len(x) > 2, libgen_dict[libgen_item]['author'].lower().split()))
-                libgen_author = set(map(sanitize_word, libgen_author))
-                # if author is empty then I don't filter
-                author_match = (len(humble_author_words) == 0)
-            if title_match and author_match:
-                filtered_dict[libgen_item] = libgen_dict[libgen_item]
-    return filtered_dict
+    return BatchMatcher(libgen_dict).filter(humble_dict)
@@ -2,42 +2,55 @@
 
     Extract Humble Bundle info from the HTML code in the page:
 
-        <script id="webpack-bundle-data" type="application/json">
-          {"bundleVars": ...}
+        <script id="webpack-bundle-page-data" type="application/json">
+          {"bundleData": ...}
         </script>
 
+    The script is found in the raw page, without building its tree (see BundlePage)
+
     Once extracted we can search for the books in LibGen and extract the download links
     Then we can download each book in the bundle
 
+    Searches and downloads are a pipeline: as soon as the search of an item ends, the item goes into a
+    bounded queue and run_parameters['download_workers'] threads download it while the search goes on
+    with the next items. With run_parameters['search_workers'] > 1 that number of items are searched at
+    the same time
+
+    A book whose MD5 is already in the ContentIndex isn't downloaded again
+
+    The modules of the search and the downloads (requests, BeautifulSoup...) are imported by the
+    functions that use them, so a run that only reads backups (-f) or only parses (-p) starts faster.
+    python StartupTiming.py measures it
+
 """
-import os
 import sys
-
-from waybackpy import Url
+from functools import partial
+from queue import Queue
+from threading import Thread
 
 import json
-from BundleInfo import BundleInfo, BundleException
-from Connections import get_soup_from_page
-from FilterSearchResults import filter_search_results
-from LibGen import search_libgen_by_title
-from LibGenDownload import get_mirror_list, get_file_from_url
-from json import loads
+from BundleInfo import BundleInfo, BundleException, backup_exists
+from BundlePage import extract_bundle_data, BUNDLE_DATA_SCRIPT_ID
+from BundleScheduler import run_bundles, with_current_output
+from ContentIndex import reuse_downloaded_book
+from MirrorScoreboard import get_mirror_scoreboard
+from RateLimiter import get_rate_limiter
+from SearchCache import get_search_cache
+from SingleFlight import single_flight_stats_to_str
 from resources import humble_resources
 from utils import parse_arguments, run_parameters, get_backup_file
 
 
 def extract_humble_dict_from_page(humble_url):
-    soup = get_soup_from_page(humble_url, use_opera_vpn=False)
-    if not soup:
+    from Connections import get_page
+    page = get_page(humble_url, allow_browser=False)
+    if page is None:
         raise BundleException(f'Failed to get {humble_url}')
     # tiers no longer present in HTML code
-    json_node_name = 'webpack-bundle-page-data'
-    bundle_vars = soup.find('script', {'id': json_node_name})
-    if bundle_vars:
-        whole_bundle_dict = loads(bundle_vars.string)
-        return BundleInfo(whole_bundle_dict)
-    else:
-        raise BundleException(f'JSON info in {json_node_name} not found')
+    bundle_data = extract_bundle_data(page)
+    if bundle_data is None:
+        raise BundleException(f'JSON info in {BUNDLE_DATA_SCRIPT_ID} not found')
+    return BundleInfo(bundle_data)
 
 
 def get_bundle_dict(humble_url, is_file):
@@ -46,7 +59,7 @@ def get_bundle_dict(humble_url, is_file):
         return BundleInfo.from_file(humble_url)
     else:
         backup_file = get_backup_file(humble_url)
-        if not os.path.isfile(backup_file):
+        if not backup_exists(backup_file):
             bundle_dict = extract_humble_dict_from_page(humble_url)
             bundle_dict.backup_file = backup_file
             bundle_dict['url'] = humble_url
@@ -70,13 +83,14 @@ def search_books_to_bundle_item(bundle_dict=None, key=None, index_str=''):
         return
     if item.get('skip', False) or item.get('downloaded', False) or (item.get('books_found', {})):
         return
+    from FilterSearchResults import filter_search_results
+    from LibGen import search_libgen_by_title
     print(f'{index_str} - {item_in_bundle_dict_to_str(item)}')
     try:
         if not item.get('books_found', {}):
             books_found = search_libgen_by_title(item['name'])
             filtered_books = filter_search_results(item, books_found)
             bundle_dict.set_books_found(key, dict(filtered_books))
-            bundle_dict.save_to_file()
         else:
             filtered_books = dict(item['books_found'])
         # print(filtered_books)
@@ -84,7 +98,6 @@ def search_books_to_bundle_item(bundle_dict=None, key=None, index_str=''):
             bundle_dict.set_all_books_downloaded(key)
     except Exception as err:
         print(f'Error searching book: {item["name"]} - {err}', file=sys.stderr)
-    bundle_dict.save_to_file()
     print('--------------------------------------------')
 
 
@@ -94,23 +107,30 @@ def download_books_from_bundle_item(bundle_dict=None, key=None, index_str=''):
         return
     if item.get('skip', False) or item.get('downloaded', False) or (not item.get('books_found', {})):
         return
+    from LibGenDownload import get_mirror_list, get_file_from_url, get_output_path
     print(f'{index_str} - {item_in_bundle_dict_to_str(item)}')
-    # start thread pool
-    humble_resources.pool.bundle_dict = bundle_dict
     filtered_books = item['books_found']
     # print(json.dumps(filtered_books, sort_keys=True, indent=4))
+    path = get_output_path(run_parameters, bundle_dict.get('machine_name', ''))
+    # the books downloaded leave filtered_books
+    num_books = len(filtered_books)
     for idx, md5 in enumerate(dict(filtered_books)):
         try:
+            book_file = reuse_downloaded_book(md5, path)
+            if book_file:
+                # the same book in another bundle, or downloaded in a previous run
+                print(f'{idx + 1}/{num_books} - {md5} already downloaded: {book_file}')
+                bundle_dict.set_book_downloaded(key, md5)
+                continue
             all_mirrors = get_mirror_list(filtered_books[md5]['url'])
-            filtered_books[md5]['mirrors'] = all_mirrors
-            print(f'{idx + 1}/{len(filtered_books)}')
+            bundle_dict.set_book_mirrors(key, md5, all_mirrors)
+            print(f'{idx + 1}/{num_books}')
             get_file_from_url(run_parameters=run_parameters,
                               bundle_data=bundle_dict, bundle_item=key, book=filtered_books[md5], md5=md5)
         except Exception as err:
             print(f'Error downloading {item["name"]} - {err}', file=sys.stderr)
     if not item.get('books_found', {}):
         bundle_dict.set_all_books_downloaded(key)
-    bundle_dict.save_to_file()
 
 
 def iterate_tiers(bundle_dict, functor):
@@ -122,7 +142,67 @@ def iterate_tiers(bundle_dict, functor):
                                         index_str=f'{tier_idx + 1}/{len(tier_components)}')
 
 
+def search_and_queue_item(bundle_dict=None, key=None, index_str='', download_queue=None):
+    search_books_to_bundle_item(bundle_dict=bundle_dict, key=key, index_str=index_str)
+    # items already downloaded or without results are discarded by the download workers
+    download_queue.put((key, index_str))
+
+
+def download_worker(bundle_dict, download_queue):
+    while True:
+        queued_item = download_queue.get()
+        if queued_item is None:
+            break
+        key, index_str = queued_item
+        try:
+            download_books_from_bundle_item(bundle_dict=bundle_dict, key=key, index_str=index_str)
+        except Exception as err:
+            print(f'Error downloading {key} - {err}', file=sys.stderr)
+
+
+def search_concurrently(bundle_dict, functor, search_workers):
+    """
+        Runs functor for every item of the bundle in a pool of search_workers threads
+    """
+    from multiprocessing.pool import ThreadPool
+    with ThreadPool(processes=search_workers) as search_pool:
+        searches = []
+        iterate_tiers(bundle_dict,
+                      functor=lambda **kwargs: searches.append(
+                          search_pool.apply_async(with_current_output(functor), kwds=kwargs)))
+        for search in searches:
+            try:
+                search.get()
+            except Exception as err:
+                print(f'Error searching - {err}', file=sys.stderr)
+
+
+def search_and_download_bundle(bundle_dict):
+    """
+        Searches the items of the bundle and downloads them as soon as their search finishes
+    """
+    download_queue = Queue(maxsize=run_parameters.get('download_queue_size', 10))
+    workers = [Thread(target=with_current_output(download_worker), args=(bundle_dict, download_queue),
+                      name=f'download_worker_{idx}')
+               for idx in range(max(1, run_parameters.get('download_workers', 1)))]
+    for worker in workers:
+        worker.start()
+    search_workers = max(1, run_parameters.get('search_workers', 1))
+    try:
+        if search_workers > 1:
+            search_concurrently(bundle_dict, partial(search_and_queue_item, download_queue=download_queue),
+                                search_workers)
+        else:
+            iterate_tiers(bundle_dict, functor=partial(search_and_queue_item, download_queue=download_queue))
+    finally:
+        for _ in workers:
+            download_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+
 def archive_bundle(url):
+    from waybackpy import Url
     try:
         # archive using archive.org
         user_agent = 'Mozilla/5.0 (Linux; Android 5.0; SM-G900P Build/LRX21T)' \
@@ -135,24 +215,34 @@ def archive_bundle(url):
         print(f'Error saving URL to archive {e}', file=sys.stderr)
 
 
+def process_bundle(url, json_from_file):
+    print('\n\n\n\n\n++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\n\n\n\n\n')
+    if run_parameters['archive']:
+        archive_bundle(url)
+    bundle_dict = get_bundle_dict(url, is_file=json_from_file)
+    print(f'{bundle_dict.get("name", "")}\t{bundle_dict.get("url", "")}')
+    if run_parameters['parse_only']:
+        print('Parsing finished, exit...')
+    else:
+        search_and_download_bundle(bundle_dict)
+        bundle_dict.save_to_file()
+    print('\n\n\n\n\n++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\n\n\n\n\n')
+
+
 def main():
     parse_arguments()
     json_from_file = len(run_parameters['files']) > 0
     all_data_sources = run_parameters['files'] if json_from_file else run_parameters['bundles']
-    for url in all_data_sources:
-        print('\n\n\n\n\n++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\n\n\n\n\n')
-        if run_parameters['archive']:
-            archive_bundle(url)
-        bundle_dict = get_bundle_dict(url, is_file=json_from_file)
-        print(f'{bundle_dict.get("name", "")}\t{bundle_dict.get("url", "")}')
-        if run_parameters['parse_only']:
-            print('Parsing finished, exit...')
-        else:
-            iterate_tiers(bundle_dict, functor=search_books_to_bundle_item)
-            iterate_tiers(bundle_dict, functor=download_books_from_bundle_item)
-            bundle_dict.save_to_file()
-        print('\n\n\n\n\n++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\n\n\n\n\n')
-    humble_resources.pool.wait_for_all_threads()
+    run_bundles(all_data_sources, partial(process_bundle, json_from_file=json_from_file), is_file=json_from_file)
+    humble_resources.wait_for_all_threads()
+    search_cache = get_search_cache()
+    if search_cache:
+        print(search_cache.stats_to_str())
+    print(get_rate_limiter().stats_to_str())
+    print(get_mirror_scoreboard().stats_to_str())
+    single_flight_stats = single_flight_stats_to_str()
+    if single_flight_stats:
+        print(single_flight_stats)
 
 
 # Lanzamos la función principal
@@ -0,0 +1,197 @@
+"""
+    Encoding and decoding of the JSON files: the bundle backups, the search results without bundle and
+    the preferences of the browser
+
+    orjson is used if it's installed, it encodes straight to bytes several times faster than json.
+    Otherwise, or for the values orjson doesn't accept, json is used. The integers bigger than 64 bits
+    are the exception: orjson would read them back as float, so dumps rejects them
+
+    The backups can be compressed (run_parameters['backup_compression']): 'gz' writes filename.gz and
+    'zst' filename.zst (if zstandard is installed, gz otherwise). The name of the backup doesn't change
+    for the rest of the program: read_json_file reads whichever of filename, filename.gz or
+    filename.zst has been written last, recognising the format by its first bytes
+
+"""
+import gzip
+import json
+import os
+import sys
+import zlib
+
+# both optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the TypeError of orjson.dumps for an integer bigger than 64 bits
+ORJSON_BIG_INT_ERROR = '64-bit'
+GZIP_EXTENSION = '.gz'
+ZSTD_EXTENSION = '.zst'
+COMPRESSED_EXTENSIONS = {'gz': GZIP_EXTENSION, 'zst': ZSTD_EXTENSION}
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# fast levels, the backups are rewritten often
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+zstd_missing_reported = False
+
+
+class JsonCodecError(ValueError):
+    """
+        A compressed file that can't be decompressed, or a value that can't be written
+    """
+
+
+def get_backend():
+    return 'orjson' if orjson else 'json'
+
+
+def dumps(obj, indent=False):
+    """
+    :return: the JSON of obj as UTF-8 bytes
+    :raise JsonCodecError: with orjson, if obj has an integer bigger than 64 bits
+    """
+    if orjson:
+        options = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(obj, option=options)
+        except TypeError as err:
+            if ORJSON_BIG_INT_ERROR in str(err):
+                raise JsonCodecError(f'orjson reads the integers bigger than 64 bits as float - {err}')
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+
+def loads(data):
+    """
+    :param data: bytes or str
+    :raise ValueError: if it isn't valid JSON
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def get_compression(compression):
+    """
+        'zst' without zstandard is written as gz
+    """
+    global zstd_missing_reported
+    if (compression == 'zst') and (not zstandard):
+        if not zstd_missing_reported:
+            zstd_missing_reported = True
+            print('zstandard is not installed, the backups are compressed with gzip')
+        return 'gz'
+    return compression if compression in COMPRESSED_EXTENSIONS else ''
+
+
+def compress(data, compression):
+    if compression == 'gz':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL)
+    if compression == 'zst':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+def decompress(data):
+    if data.startswith(GZIP_MAGIC):
+        try:
+            return gzip.decompress(data)
+        except (EOFError, zlib.error) as err:
+            raise JsonCodecError(f'Broken gzip file - {err}')
+    if data.startswith(ZSTD_MAGIC):
+        if not zstandard:
+            raise JsonCodecError('zstandard is needed to read a .zst file')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def strip_compressed_extension(filename):
+    """
+        The name of the backup, with or without the extension of its compression
+    """
+    for extension in COMPRESSED_EXTENSIONS.values():
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+
+def get_variants(filename):
+    filename = strip_compressed_extension(filename)
+    return [filename] + [f'{filename}{extension}' for extension in COMPRESSED_EXTENSIONS.values()]
+
+
+def find_json_file(filename):
+    """
+    :return: the newest of filename and its compressed versions, None if there is none
+    """
+    existing = [variant for variant in get_variants(filename) if os.path.isfile(variant)]
+    if not existing:
+        return None
+    return max(existing, key=os.path.getmtime)
+
+
+def json_file_exists(filename):
+    return find_json_file(filename) is not None
+
+
+def read_json_file(filename):
+    """
+    :raise FileNotFoundError: if neither filename nor its compressed versions exist
+    :raise ValueError: if the content isn't valid JSON
+    """
+    existing_file = find_json_file(filename)
+    if not existing_file:
+        raise FileNotFoundError(filename)
+    with open(existing_file, 'rb') as json_file:
+        return loads(decompress(json_file.read()))
+
+
+def write_json_file(filename, obj, compression='', indent=False, durable=False):
+    """
+        Writes a temporary file and renames it, the other versions of the file are removed after that
+    :param compression: '', 'gz' or 'zst'
+    :param durable: fsync before the rename
+    :return: the name of the file written
+    """
+    compression = get_compression(compression)
+    target_file = strip_compressed_extension(filename) + COMPRESSED_EXTENSIONS.get(compression, '')
+    temp_file = f'{target_file}.tmp'
+    with open(temp_file, 'wb') as json_file:
+        json_file.write(compress(dumps(obj, indent=indent), compression))
+        if durable:
+            json_file.flush()
+            os.fsync(json_file.fileno())
+    os.replace(temp_file, target_file)
+    for variant in get_variants(filename):
+        if (variant != target_file) and os.path.isfile(variant):
+            os.remove(variant)
+    return target_file
+
+
+def read_json_state(filename, owner):
+    """
+        The state a class keeps in a JSON file (ContentIndex, MirrorScoreboard, TransportSelector...)
+    :param owner: the name of the class, for the error message
+    :return: the content of the file, {} if there is no file or it can't be read
+    """
+    if not (filename and json_file_exists(filename)):
+        return {}
+    try:
+        return read_json_file(filename)
+    except (OSError, ValueError) as err:
+        print(f'{owner}: unable to read {filename} - {err}', file=sys.stderr)
+        return {}
+
+
+def write_json_state(filename, state):
+    """
+        Writes the state atomically, nothing if there is no filename. The caller keeps state from changing
+        meanwhile (holds its mutex)
+    """
+    if filename:
+        write_json_file(filename, state, indent=True)
@@ -0,0 +1,182 @@
+"""
+    Micro-benchmark of JsonCodec on big bundle dictionaries
+
+    The dictionaries are like the backups of a bundle after the search: every item has the books found
+    in LibGen, with their mirrors and download attempts. For each size it times:
+     - dumps / loads: stdlib json against JsonCodec (orjson if it's installed)
+     - write / read: a backup written and read back as BundleJournal did before (json.dump to a text
+       file) against write_json_file / read_json_file, uncompressed, gz and zst (if zstandard is installed)
+
+    and reports the median, the MB/s of JSON, the size of the file and the speedup against json. Every
+    file read back must be equal to the dictionary written
+
+    The medians are compared with a baseline (BenchmarkBaseline)
+
+    Usage: python JsonCodecBenchmark.py [-r repeats] [-t threshold] [-b baseline_file] [-s]
+
+"""
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import JsonCodec
+from BenchmarkBaseline import BaselineComparison, benchmark_main, DEFAULT_REPEATS, DEFAULT_THRESHOLD
+from JsonCodec import dumps, loads, read_json_file, write_json_file
+
+BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json_codec_baseline.json')
+BUNDLE_SIZES = {'small': 20, 'large': 500, 'huge': 3000}
+BOOKS_PER_ITEM = 5
+
+
+def build_bundle_dict(num_items):
+    items = {}
+    for i in range(num_items):
+        books = {}
+        for j in range(BOOKS_PER_ITEM):
+            md5 = f'{i:016X}{j:016X}'
+            books[md5] = {
+                'title': f'Title of the book number {i}, edition {j}', 'authors': f'Author {i}; Ñame Ünicode {j}',
+                'publisher': f'Publisher {i}', 'year': 2000 + j, 'pages': 300 + j, 'language': 'English',
+                'size': f'{j + 1} Mb', 'extension': ('pdf', 'epub', 'mobi')[j % 3],
+                'url': f'https://libgen.rs/book/index.php?md5={md5}',
+                'mirrors': [f'http://mirror{k}.example.org/main/{md5}' for k in range(4)],
+                'download_attempts': [{'mirror': f'http://mirror{k}.example.org/main/{md5}', 'start': 1700000000.5,
+                                       'duration': 12.34, 'result': 'failed', 'hedged': False} for k in range(2)],
+            }
+        items[f'bookbundle_item_{i}'] = {
+            'name': f'Title of the book number {i}', 'author': f'Author {i}', 'author_url': '', 'publisher': '',
+            'publisher_url': '', 'description': f'<p>Description of the book number {i}.</p>' * 10,
+            'books_found': books, 'books_downloaded': {}, 'downloaded': False,
+        }
+    return {
+        'name': 'Humble Book Bundle: Benchmark', 'machine_name': 'benchmark_bookbundle',
+        'tier_item_data': items, 'tier_order': ['all'],
+        'tier_display_data': {'all': {'tier_item_machine_names': list(items)}},
+        'url': 'https://www.humblebundle.com/books/benchmark', 'from_backup': True,
+    }
+
+
+def stdlib_write(filename, bundle_dict):
+    with open(filename, 'w', encoding='utf-8') as backup:
+        json.dump(bundle_dict, backup)
+    return filename
+
+
+def stdlib_read(filename):
+    with open(filename, 'r', encoding='utf-8') as backup:
+        return json.load(backup)
+
+
+class CodecCase:
+    """
+        function receives the bundle dict, or its JSON if takes_json, and returns the dict it reads or None
+
+        measured_file is the file whose size is reported
+    """
+
+    def __init__(self, function, takes_json=False, measured_file=None):
+        self.function = function
+        self.takes_json = takes_json
+        self.measured_file = measured_file
+
+
+def build_cases(work_folder):
+    stdlib_file = os.path.join(work_folder, 'stdlib_backup')
+    cases = {
+        'dumps_json': CodecCase(lambda bundle_dict: json.dumps(bundle_dict) and None),
+        'dumps_codec': CodecCase(lambda bundle_dict: dumps(bundle_dict) and None),
+        'loads_json': CodecCase(json.loads, takes_json=True),
+        'loads_codec': CodecCase(loads, takes_json=True),
+        'write_json': CodecCase(lambda bundle_dict: stdlib_write(stdlib_file, bundle_dict) and None,
+                                measured_file=stdlib_file),
+        'read_json': CodecCase(lambda bundle_dict: stdlib_read(stdlib_file)),
+    }
+    compressions = ['', 'gz'] + (['zst'] if JsonCodec.zstandard else [])
+    for compression in compressions:
+        backup_file = os.path.join(work_folder, f'backup_{compression or "plain"}')
+        written_file = backup_file + JsonCodec.COMPRESSED_EXTENSIONS.get(compression, '')
+        cases[f'write_codec_{compression or "plain"}'] = CodecCase(
+            lambda bundle_dict, name=backup_file, compression=compression:
+            write_json_file(name, bundle_dict, compression=compression) and None, measured_file=written_file)
+        cases[f'read_codec_{compression or "plain"}'] = CodecCase(
+            lambda bundle_dict, name=backup_file: read_json_file(name))
+    return cases
+
+
+def time_function(function, argument, repeats):
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(argument)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), min(timings), result
+
+
+def run_size(size_name, bundle_dict, repeats, work_folder):
+    results = {}
+    json_bytes = json.dumps(bundle_dict).encode('utf-8')
+    for case_name, case in build_cases(work_folder).items():
+        median, best, decoded = time_function(case.function, json_bytes if case.takes_json else bundle_dict,
+                                              repeats)
+        results[f'{size_name}_{case_name}'] = {
+            'median': median,
+            'best': best,
+            'mb_per_second': (len(json_bytes) / median / 1e6) if median else 0,
+            'file_size': os.path.getsize(case.measured_file) if case.measured_file else 0,
+            'round_trip': (decoded is None) or (decoded == bundle_dict),
+        }
+    return results
+
+
+def get_reference(name):
+    """
+        The stdlib case each one is compared with
+    """
+    for operation in ('dumps', 'loads', 'write', 'read'):
+        if f'_{operation}_' in name:
+            return name[:name.index(f'_{operation}_')] + f'_{operation}_json'
+    return name
+
+
+def run_benchmark(repeats=DEFAULT_REPEATS, threshold=DEFAULT_THRESHOLD, baseline_file=BASELINE_FILENAME,
+                  update_baseline=False):
+    """
+    :return: True if every file is read back right and no case is slower than the baseline by more
+        than threshold percent
+    """
+    comparison = BaselineComparison(baseline_file, threshold)
+    results = {}
+    work_folder = tempfile.mkdtemp(prefix='humble_json_codec_')
+    print(f'Backend: {JsonCodec.get_backend()}, zstandard: {"yes" if JsonCodec.zstandard else "no"}, '
+          f'{repeats} repeats')
+    print(f'{"case":<30}{"median ms":>11}{"best ms":>10}{"MB/s":>9}{"file KB":>10}{"speedup":>9}{"change":>9}')
+    try:
+        for size_name, num_items in BUNDLE_SIZES.items():
+            size_results = run_size(size_name, build_bundle_dict(num_items), repeats, work_folder)
+            results.update(size_results)
+            for name, result in size_results.items():
+                change = comparison.compare(name, result['median'])
+                reference = results[get_reference(name)]['median']
+                speedup = reference / result['median'] if result['median'] else 0
+                file_size = f'{result["file_size"] / 1024:.0f}' if result['file_size'] else ''
+                print(f'{name:<30}{1000 * result["median"]:>11.2f}{1000 * result["best"]:>10.2f}'
+                      f'{result["mb_per_second"]:>9.0f}{file_size:>10}{speedup:>8.1f}x{change:>9}')
+                if not result['round_trip']:
+                    print(f'    {name} doesn\'t read back the same dictionary', file=sys.stderr)
+                    comparison.add_failure(name)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return comparison.finish(update_baseline, problem=f'wrong or more than {threshold}% slower than the baseline')
+
+
+def main():
+    return benchmark_main('JSON codec benchmark', run_benchmark, BASELINE_FILENAME)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
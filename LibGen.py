@@ -15,15 +15,113 @@
             }
     The "url" field in the value is the page where we can get the download link of the file
 
+    The first result page is fetched alone to read the paginator, the rest of the pages (2..N) are
+    fetched in parallel using run_parameters['search_page_workers'] threads
+
+    The parsed pages are stored in the SearchCache, so searching again for the same title doesn't
+    hit the mirror until the cached results expire. Concurrent searches of the same title in the same
+    mirror are run once (see SingleFlight)
+
 """
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from urllib.parse import quote
 
 from Connections import get_soup_from_page
 from MirrorParser import select_parser
+from SearchCache import get_search_cache
+from SingleFlight import single_flight
 from utils import run_parameters, update_run_parameters, libgen_search_libgen_li
 
 
+def get_cached_page(search_url, page_number):
+    cache = get_search_cache()
+    if not cache:
+        return None
+    return cache.get(run_parameters['libgen_base'], search_url, page_number)
+
+
+def cache_page(search_url, page_number, page_results, empty):
+    cache = get_search_cache()
+    if cache:
+        cache.put(run_parameters['libgen_base'], search_url, page_number, page_results, empty=empty)
+
+
+def find_fiction_link(parser, soup):
+    parser.search_fiction_link(soup)
+    return parser.get_fiction_link()
+
+
+def get_books_from_page(page_number, search_url, page_parser, parse_only=None):
+    books = get_cached_page(search_url, page_number)
+    if books is not None:
+        return books
+    page_url = f'{search_url}&page={page_number}'
+    print(page_url)
+    soup = get_soup_from_page(page_url, parse_only=parse_only)
+    if not soup:
+        print(f'Unable to connect to LibGen {page_url}')
+        return {}
+    books = page_parser(soup)
+    cache_page(search_url, page_number, books, empty=not books)
+    return books
+
+
+def get_first_page(search_url, get_result_pages, page_parser, get_fiction_link=None, parse_only=None):
+    """
+        The first page is loaded alone because we need it to know the number of result pages
+        and the link to the fiction search
+
+    :return: {'books': ..., 'last_page': ..., 'fiction_link': ...} or None if the page can't be loaded
+    """
+    first_page = get_cached_page(search_url, 1)
+    if first_page is not None:
+        return first_page
+    url_with_page = f'{search_url}&page=1'
+    print(url_with_page)
+    soup = get_soup_from_page(url_with_page, parse_only=parse_only)
+    if not soup:
+        print(f'Unable to connect to LibGen {url_with_page}')
+        return None
+    result_pages = get_result_pages(soup, search_url)
+    last_page = len(list(result_pages)) if result_pages else 0
+    first_page = {
+        'books': page_parser(soup) if last_page else {},
+        'last_page': last_page,
+        'fiction_link': get_fiction_link(soup) if get_fiction_link else None
+    }
+    cache_page(search_url, 1, first_page, empty=not first_page['books'])
+    return first_page
+
+
+def get_books_from_all_pages(search_url, first_page, page_parser, parse_only=None):
+    """
+        Page 1 is already loaded (we needed it for the paginator), so only pages 2..N are requested.
+
+        The results are merged in page order, so the output is the same as in a sequential search
+    :param search_url: the search url, without the page parameter
+    :param first_page: the result of get_first_page
+    :param page_parser: the parser method that extracts the books from a page
+    :param parse_only: the SoupStrainer used to parse the pages
+    :return: a dictionary with all the books found
+    """
+    all_books = dict(first_page['books'])
+    remaining_pages = range(2, first_page['last_page'] + 1)
+    if not remaining_pages:
+        return all_books
+    workers = max(1, min(run_parameters.get('search_page_workers', 1), len(remaining_pages)))
+    with ThreadPool(processes=workers) as page_pool:
+        for books in page_pool.imap(partial(get_books_from_page, search_url=search_url, page_parser=page_parser,
+                                            parse_only=parse_only),
+                                    remaining_pages):
+            all_books.update(books)
+    return all_books
+
+
 def get_books_no_fiction(parser, search_parameter):
+    """
+    :return: the books found and the link to the fiction search (if the mirror has one)
+    """
     items_per_page = 100
     # query can be 'title', 'author', 'publisher'
     query = 'title'
@@ -38,55 +136,39 @@ def get_books_no_fiction(parser, search_parameter):
                  f'res={items_per_page}&column={query}&phrase=1&{detailed_view}topics%5B%5D=l&topics%5B%5D=f'
 
     search_url = parser.build_search_url(urlencoded_query, items_per_page, query, detailed_view)
-    all_books = {}
-    page_number = 1
-    url_with_page = f'{search_url}&page={page_number}'
-    soup = get_soup_from_page(url_with_page)
-    all_books = {}
-    for page in parser.get_list_results_pages(soup, search_url):
-        print(page)
-        current_url = page
-        soup = get_soup_from_page(current_url)
-        if not soup:
-            print(f'Unable to connecto to LibGen {url_with_page}')
-            continue
-        books = parser.get_non_fiction(soup)
-        all_books.update(books)
+    first_page = get_first_page(search_url, parser.get_list_results_pages, parser.get_non_fiction,
+                                get_fiction_link=partial(find_fiction_link, parser),
+                                parse_only=parser.results_strainer)
     # prepare the parser for the fiction loop
-    parser.search_fiction_link(soup)
     parser.restart_iterator()
-    return all_books
+    if not first_page:
+        return {}, None
+    all_books = get_books_from_all_pages(search_url, first_page, parser.get_non_fiction,
+                                         parse_only=parser.results_strainer)
+    return all_books, first_page['fiction_link']
 
 
-def get_books_fiction(parser):
+def get_books_fiction(parser, fiction_link):
     all_books = {}
-    fiction_link = parser.get_fiction_link()
     if not fiction_link:
         return all_books
     search_url = f'{run_parameters["libgen_base"]}{fiction_link}'
-    page_number = 1
-    url_with_page = f'{search_url}&page={page_number}'
-    soup = get_soup_from_page(url_with_page)
-    for page in parser.get_list_results_pages_fiction(soup, search_url):
-        print(page)
-        current_url = page
-        soup = get_soup_from_page(current_url)
-        if not soup:
-            print(f'Unable to connect to to LibGen {url_with_page}')
-            continue
-        books = parser.get_fiction(soup)
-        all_books.update(books)
-    return all_books
+    first_page = get_first_page(search_url, parser.get_list_results_pages_fiction, parser.get_fiction,
+                                parse_only=parser.fiction_results_strainer)
+    if not first_page:
+        return all_books
+    return get_books_from_all_pages(search_url, first_page, parser.get_fiction,
+                                    parse_only=parser.fiction_results_strainer)
 
 
 def get_all_books(title):
     parser = select_parser()
-    all_books = get_books_no_fiction(parser, title)
-    all_books.update(get_books_fiction(parser))
+    all_books, fiction_link = get_books_no_fiction(parser, title)
+    all_books.update(get_books_fiction(parser, fiction_link))
     return all_books
 
 
 def search_libgen_by_title(title):
     if not run_parameters:
         return {}
-    return get_all_books(title)
+    return single_flight('search', (run_parameters['libgen_base'], title), get_all_books, title)
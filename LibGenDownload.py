@@ -6,16 +6,27 @@
 
 """
 import os
+import sys
+import time
 import urllib
+from queue import Queue, Empty
+from threading import Thread
 from urllib.parse import urlparse
 
 from bs4 import Tag
 
+from BundleScheduler import with_current_output
+from ContentIndex import get_content_index
 from Connections import get_soup_from_page, get_book_requests, get_book_selenium, get_book_selenium_by_url
+from DownloadMonitor import DownloadMonitor, DownloadRace, DownloadCancelled, SlowDownload, monitor_download
+from MirrorScoreboard import get_mirror_scoreboard
 from annasarchive import get_annas_archive_mirrors, get_download_link_from_annas_archive
 from resources import humble_resources
+from SingleFlight import single_flight
+from OperaDriver import DriverNotInUse
+from Transports import needs_browser, known_without_browser
 from utils import run_parameters, libgen_search_libgen_rs, libgen_search_libgen_li, libgen_search_libgen_is, \
-    libgen_search_libgen_rc, annas_archive_search
+    libgen_search_libgen_rc, annas_archive_search, get_output_root
 
 
 def get_output_path(run_parameters, bundle_name):
@@ -26,10 +37,7 @@ def get_output_path(run_parameters, bundle_name):
         final_path = output_path\\humble_name
     :return: The full path
     """
-    out_dir = run_parameters['output_dir']
-    if not out_dir:
-        out_dir = os.path.join(os.path.expanduser('~'), 'HumbleJsonBooks')
-    out_dir = os.path.join(out_dir, bundle_name)
+    out_dir = os.path.join(get_output_root(), bundle_name)
     os.makedirs(out_dir, exist_ok=True)
     return out_dir
 
@@ -40,34 +48,45 @@ def get_mirror_list(libgen_md5_url=''):
     :param libgen_md5_url:
     :return:
     """
-    mirror_list = []
     if libgen_md5_url:
-        soup = get_soup_from_page(libgen_md5_url)
-        if soup:
-            url_part = urlparse(libgen_md5_url)
-            mirror_host = f'{url_part.scheme}://{url_part.hostname}/'
-            mirrors = []
-            if mirror_host.find(annas_archive_search['base_url']) >= 0:
-                return get_annas_archive_mirrors(soup, mirror_host, url_part.path.split('/')[-1])
-            if ((mirror_host == libgen_search_libgen_rs['base_url']) or
-                    (mirror_host == libgen_search_libgen_is['base_url'])):
-                if libgen_md5_url.find('/fiction/') >= 0:
-                    mirror_location = '.record_mirrors li a'
-                else:
-                    mirror_location = 'tr:nth-child(18) td a'
-                mirrors = soup.select(mirror_location)
-            if ((mirror_host == libgen_search_libgen_li['base_url']) or
-                    (mirror_host == libgen_search_libgen_rc['base_url'])):
-                mirrors = soup.select('table#tablelibgen a')
-
-            for mirror in mirrors:
-                if isinstance(mirror, Tag):
-                    mirror_link = mirror.get('href', '')
-                    url_parts = urlparse(mirror_link)
-                    if url_parts.scheme.find('http') >= 0:
-                        mirror_list.append(mirror_link)
-                    if not url_parts.scheme:
-                        mirror_list.append(f'{mirror_host}{mirror_link}')
+        # the same book can be in several bundles downloading at the same time
+        return single_flight('mirrors', libgen_md5_url, get_mirror_list_from_url, libgen_md5_url)
+    return []
+
+
+def get_mirror_list_from_url(libgen_md5_url):
+    soup = get_soup_from_page(libgen_md5_url)
+    if soup:
+        return get_mirror_list_from_soup(soup, libgen_md5_url)
+    return []
+
+
+def get_mirror_list_from_soup(soup, libgen_md5_url):
+    mirror_list = []
+    url_part = urlparse(libgen_md5_url)
+    mirror_host = f'{url_part.scheme}://{url_part.hostname}/'
+    mirrors = []
+    if mirror_host.find(annas_archive_search['base_url']) >= 0:
+        return get_annas_archive_mirrors(soup, mirror_host, url_part.path.split('/')[-1])
+    if ((mirror_host == libgen_search_libgen_rs['base_url']) or
+            (mirror_host == libgen_search_libgen_is['base_url'])):
+        if libgen_md5_url.find('/fiction/') >= 0:
+            mirror_location = '.record_mirrors li a'
+        else:
+            mirror_location = 'tr:nth-child(18) td a'
+        mirrors = soup.select(mirror_location)
+    if ((mirror_host == libgen_search_libgen_li['base_url']) or
+            (mirror_host == libgen_search_libgen_rc['base_url'])):
+        mirrors = soup.select('table#tablelibgen a')
+
+    for mirror in mirrors:
+        if isinstance(mirror, Tag):
+            mirror_link = mirror.get('href', '')
+            url_parts = urlparse(mirror_link)
+            if url_parts.scheme.find('http') >= 0:
+                mirror_list.append(mirror_link)
+            if not url_parts.scheme:
+                mirror_list.append(f'{mirror_host}{mirror_link}')
     return mirror_list
 
 
@@ -86,25 +105,30 @@ def get_download_link_from_library_lol(url, run_parameters, bundle_data, bundle_
         css_path = 'div#download>ul>li>a'
     else:
         css_path = 'div#download>h2>a'
-    if humble_resources.driver.use_opera_vpn:
+    if needs_browser(url):
         download_click = get_book_selenium(css_path=css_path)
         if download_click:
             humble_resources.pool.add_selenium_download(bundle_item, md5,
-                                                        humble_resources.driver.download_folder, path)
+                                                        humble_resources.driver.download_folder, path,
+                                                        bundle_dict=bundle_data)
+        return download_click
     else:
         get_link = soup.select_one(css_path)
         if get_link:
             download_link = get_link.get('href', '')
             filename = urllib.parse.unquote(url[url.rfind('/') + 1:])
-            get_book_requests(download_link, path, filename)
+            return get_book_requests(download_link, path, filename, extension=book['extension'], md5=md5)
 
 
 def get_download_link_from_cloudfare_mirror(url, run_parameters, bundle_data, bundle_item, book, md5, path):
-    if humble_resources.driver.use_opera_vpn:
+    # the book is downloaded directly, with the browser only if its host has needed it for a page
+    if needs_browser(url):
         # TODO download using selenium but not by clicking
         download_click = get_book_selenium_by_url(url=url)
         if download_click:
-            humble_resources.pool.add_selenium_download(bundle_item, md5, humble_resources.driver.download_folder, path)
+            humble_resources.pool.add_selenium_download(bundle_item, md5, humble_resources.driver.download_folder, path,
+                                                        bundle_dict=bundle_data)
+        return download_click
     else:
         return get_book_requests(url, path, filename='', extension=book['extension'], md5=md5)
 
@@ -129,11 +153,13 @@ def get_download_link_from_libgen_rocks(url, run_parameters, bundle_data, bundle
     soup = get_soup_from_page(url)
     if soup:
         css_path = 'table#main td:nth-of-type(2) a'
-        if humble_resources.driver.use_opera_vpn:
+        if needs_browser(url):
             download_click = get_book_selenium(css_path=css_path)
             if download_click:
                 humble_resources.pool.add_selenium_download(bundle_item, md5,
-                                                            humble_resources.driver.download_folder, path)
+                                                            humble_resources.driver.download_folder, path,
+                                                            bundle_dict=bundle_data)
+            return download_click
         else:
             get_link = soup.select_one(css_path)
             if get_link:
@@ -146,13 +172,22 @@ def get_download_link_from_libgen_rocks(url, run_parameters, bundle_data, bundle
     return False
 
 
-def choose_mirror(mirror_list, preferred_mirror=None):
-    if preferred_mirror:
-        # search mirror according to preferred download methods
-        for mirror in mirror_list:
-            if mirror.find(run_parameters['libgen_download']) >= 0:
-                return mirror
-    return mirror_list[0]
+def order_mirrors(mirror_list, preferred_mirror=''):
+    """
+        The mirrors ranked by the MirrorScoreboard, the ones of the preferred download method first
+    """
+    ranked_mirrors = get_mirror_scoreboard().rank(mirror_list)
+    preferred = [preferred_mirror] if preferred_mirror else []
+    if preferred_mirror == 'cloudflare':
+        # i want to download from cloudflare but if I don't have a mirror link, go to library.lol
+        preferred.append('library.lol')
+
+    def preference(mirror):
+        for idx, mirror_name in enumerate(preferred):
+            if mirror.find(mirror_name) >= 0:
+                return idx
+        return len(preferred)
+    return sorted(ranked_mirrors, key=preference)
 
 
 def get_file_from_url(run_parameters, bundle_data, bundle_item, book, md5):
@@ -163,14 +198,148 @@ def get_file_from_url(run_parameters, bundle_data, bundle_item, book, md5):
     mirror_list = book['mirrors']
 
     path = get_output_path(run_parameters=run_parameters, bundle_name=bundle_data.get('machine_name', ''))
-    humble_resources.driver.destination_path = path
-
-    mirror_link = choose_mirror(mirror_list, preferred_mirror=run_parameters.get('libgen_download', ''))
+    # the page load and the click on the download link must be done in the same browser
+    with humble_resources.drivers.driver_in_use() as opera_driver:
+        opera_driver.destination_path = path
+        downloaded_file = download_from_mirror(run_parameters, bundle_data, bundle_item, book, md5, path,
+                                               mirror_list)
+    # the downloads done with selenium are marked as downloaded by the pool, when the browser finishes them
+    if isinstance(downloaded_file, str):
+        bundle_data.set_book_downloaded(bundle_item, md5)
+        content_index = get_content_index()
+        if content_index:
+            content_index.add(md5, downloaded_file)
+    return downloaded_file
+
+
+def download_from_mirror(run_parameters, bundle_data, bundle_item, book, md5, path, mirror_list):
+    """
+        Tries the mirrors of the book in order until one of them works (failover), up to
+        run_parameters['max_mirror_attempts'] mirrors. A download slower than
+        run_parameters['min_download_throughput'] is abandoned and the next mirror is tried
+
+        If run_parameters['hedge_after'] is set and every mirror is known to work without the browser (see
+        Transports), an attempt that hasn't finished after that number of seconds gets a second one from the
+        next mirror, and the first to finish cancels the other. The mirrors that turn out to need the browser
+        are tried after that in this thread, the one that holds the browser
+    :return: the filename, True if the browser has started the download, or None if every mirror failed
+    """
+    mirrors = order_mirrors(mirror_list, preferred_mirror=run_parameters.get('libgen_download', ''))
+    mirrors = mirrors[:max(1, run_parameters.get('max_mirror_attempts', 1))]
+    hedge_after = run_parameters.get('hedge_after', 0)
+    if hedge_after and (len(mirrors) > 1) and all(known_without_browser(mirror) for mirror in mirrors):
+        downloaded_file, mirrors = download_hedged(run_parameters, bundle_data, bundle_item, book, md5, path,
+                                                   mirrors, hedge_after)
+        if downloaded_file:
+            return downloaded_file
+    for mirror_link in mirrors:
+        downloaded_file = try_mirror(run_parameters, bundle_data, bundle_item, book, md5, path, mirror_link)
+        if downloaded_file:
+            return downloaded_file
+    return None
+
+
+def try_mirror(run_parameters, bundle_data, bundle_item, book, md5, path, mirror_link, monitor=None, hedged=False):
+    """
+        One download attempt, recorded in the MirrorScoreboard and in the "download_attempts" of the book
+    :raise DriverNotInUse: if the mirror needs the browser and this thread doesn't hold one (download_hedged)
+    """
+    if not monitor:
+        monitor = DownloadMonitor()
+    start = time.time()
+    downloaded_file = None
+    browser_error = None
+    with get_mirror_scoreboard().attempt(mirror_link) as attempt, monitor_download(monitor):
+        try:
+            downloaded_file = download_from_mirror_link(run_parameters, bundle_data, bundle_item, book, md5, path,
+                                                        mirror_link)
+            if isinstance(downloaded_file, str):
+                result = 'downloaded'
+            else:
+                result = 'started' if downloaded_file else 'failed'
+        except DownloadCancelled:
+            result = 'cancelled'
+        except SlowDownload as err:
+            result = f'slow: {err}'
+        except DriverNotInUse as err:
+            result = 'needs the browser'
+            browser_error = err
+        except Exception as err:
+            result = f'error: {err}'
+        if result in ('started', 'cancelled', 'needs the browser'):
+            # the browser downloads in the background, and a cancelled download or one without the browser it
+            # needs say nothing about the mirror
+            attempt.discard()
+        else:
+            attempt.succeeded = (result == 'downloaded')
+    if result not in ('downloaded', 'started', 'cancelled', 'needs the browser'):
+        print(f'Download of {md5} from {mirror_link} failed - {result}', file=sys.stderr)
+    bundle_data.add_download_attempt(bundle_item, md5, {
+        'mirror': mirror_link,
+        'start': start,
+        'duration': round(time.time() - start, 2),
+        'result': result,
+        'hedged': hedged
+    })
+    if browser_error:
+        raise browser_error
+    return downloaded_file if result in ('downloaded', 'started') else None
+
+
+def download_hedged(run_parameters, bundle_data, bundle_item, book, md5, path, mirrors, hedge_after):
+    """
+        Each attempt runs in its own thread, at most two at the same time
 
-    if (run_parameters.get('libgen_download', '') == 'cloudflare') and (mirror_link.find('cloudflare') < 0):
-        # i want to download from cloudflare but I don't have a mirror link, go to library.lol
-        mirror_link = choose_mirror(mirror_list, preferred_mirror='library.lol')
+        Only the first attempt to finish keeps its file (DownloadRace), it's returned at once: the other
+        one is cancelled and its thread removes its partial file
 
+        The threads of the attempts don't hold a browser, a mirror whose page needs it is given back
+    :return: (the filename or None, the mirrors that need the browser)
+    """
+    pending_mirrors = list(mirrors)
+    running_attempts = {}
+    finished_attempts = Queue()
+    race = DownloadRace()
+    browser_mirrors = []
+
+    def run_attempt(mirror_link, monitor, hedged):
+        downloaded_file = None
+        try:
+            downloaded_file = try_mirror(run_parameters, bundle_data, bundle_item, book, md5, path, mirror_link,
+                                         monitor=monitor, hedged=hedged)
+        except DriverNotInUse:
+            browser_mirrors.append(mirror_link)
+        finally:
+            finished_attempts.put((mirror_link, downloaded_file))
+
+    def start_next_attempt(hedged):
+        mirror_link = pending_mirrors.pop(0)
+        monitor = DownloadMonitor(race=race)
+        running_attempts[mirror_link] = monitor
+        Thread(target=with_current_output(run_attempt), args=(mirror_link, monitor, hedged),
+               name=f'download {md5} {len(running_attempts)}', daemon=True).start()
+
+    start_next_attempt(hedged=False)
+    while running_attempts:
+        can_hedge = pending_mirrors and (len(running_attempts) == 1)
+        try:
+            mirror_link, downloaded_file = finished_attempts.get(timeout=hedge_after if can_hedge else None)
+        except Empty:
+            print(f'Download of {md5} is taking more than {hedge_after}s, trying {pending_mirrors[0]} too')
+            start_next_attempt(hedged=True)
+            continue
+        running_attempts.pop(mirror_link)
+        if downloaded_file:
+            # the attempt still running has been cancelled by the race, its thread cleans up after itself
+            for monitor in running_attempts.values():
+                monitor.cancel()
+            return downloaded_file, []
+        if (not running_attempts) and pending_mirrors:
+            start_next_attempt(hedged=False)
+    return None, browser_mirrors
+
+
+def download_from_mirror_link(run_parameters, bundle_data, bundle_item, book, md5, path, mirror_link):
     #
     #     return get_download_link_from_cloudfare_mirror(run_parameters=run_parameters, bundle_data=bundle_data,
     #                                                    bundle_item=bundle_item, book=book, md5=md5, path=path)
@@ -0,0 +1,421 @@
+"""
+    SQLite catalog of every bundle, item, search candidate and download
+
+    With run_parameters['bundle_storage'] == 'sqlite' BundleInfo keeps its state in the catalog
+    (run_parameters['library_catalog_file'], by default library.sqlite3 next to the backups) instead of a JSON
+    backup and its journal. Each change of a BundleInfo rewrites only the rows it touches.
+
+    Tables:
+     - bundles: one row per bundle, keyed by the name of its backup file. The fields that aren't items
+       (name, url, tiers...) are stored as JSON
+     - items: the Humble items, with their title and author normalized for the lookups (normalize_text:
+       every word is kept, even the short ones and the numbers, so "Vol. 1" and "Vol. 2" are different)
+     - candidates: the books_found of each item, the results of the LibGen search
+     - downloads: the books_downloaded of each item
+
+    candidates and downloads are indexed by MD5 and items by normalized title and author, so finding
+    a book in any bundle doesn't need to load the bundles. The database uses WAL mode: the bundles
+    processed at the same time write from their own threads while the others read
+
+    A JSON backup is migrated the first time BundleInfo.from_file reads it with the sqlite storage, or
+    all the backups of an output dir at once with:
+
+        python LibraryCatalog.py -o output_dir -m
+
+    and the catalog is queried with:
+
+        python LibraryCatalog.py -o output_dir [-5 md5] [-t title [-a author]]
+
+"""
+import getopt
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from threading import Lock
+
+from BundleInfo import get_bundle_key
+from BundleJournal import BundleJournal
+from JsonCodec import dumps, loads, read_json_file, strip_compressed_extension
+from utils import run_parameters, get_backup_folder
+
+LIBRARY_CATALOG_FILENAME = 'library.sqlite3'
+BUSY_TIMEOUT = 30
+BOOK_LISTS = {'books_found': 'candidates', 'books_downloaded': 'downloads'}
+# PRAGMA user_version of the catalog, the older ones are upgraded when opened
+# 2: normalize_text keeps every word
+CATALOG_VERSION = 2
+NON_ALPHANUMERIC_REGEX = re.compile(r'[\W_]+')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    bundle_key TEXT PRIMARY KEY,
+    name TEXT,
+    machine_name TEXT,
+    url TEXT,
+    data TEXT NOT NULL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS items (
+    bundle_key TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    position INTEGER,
+    name TEXT,
+    author TEXT,
+    norm_title TEXT,
+    norm_author TEXT,
+    downloaded INTEGER DEFAULT 0,
+    data TEXT NOT NULL,
+    PRIMARY KEY (bundle_key, item_key)
+);
+CREATE INDEX IF NOT EXISTS items_norm_title ON items (norm_title);
+CREATE INDEX IF NOT EXISTS items_norm_author ON items (norm_author);
+CREATE TABLE IF NOT EXISTS candidates (
+    bundle_key TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    md5 TEXT NOT NULL COLLATE NOCASE,
+    position INTEGER,
+    title TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (bundle_key, item_key, md5)
+);
+CREATE INDEX IF NOT EXISTS candidates_md5 ON candidates (md5);
+CREATE TABLE IF NOT EXISTS downloads (
+    bundle_key TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    md5 TEXT NOT NULL COLLATE NOCASE,
+    position INTEGER,
+    title TEXT,
+    data TEXT NOT NULL,
+    downloaded REAL,
+    PRIMARY KEY (bundle_key, item_key, md5)
+);
+CREATE INDEX IF NOT EXISTS downloads_md5 ON downloads (md5);
+"""
+
+
+def normalize_text(text):
+    """
+        Casefolded, without accents or punctuation and with single spaces. Every word is kept
+    """
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(NON_ALPHANUMERIC_REGEX.sub(' ', without_accents.casefold()).split())
+
+
+class LibraryCatalog:
+
+    def __init__(self, catalog_file):
+        self.__catalog_file = catalog_file
+        self.__thread_data = threading.local()
+        self.connection.executescript(SCHEMA)
+        self._upgrade()
+
+    @property
+    def catalog_file(self):
+        return self.__catalog_file
+
+    @property
+    def connection(self):
+        """
+            Each thread has its own connection, sqlite3 connections can't be shared between threads
+        """
+        connection = getattr(self.__thread_data, 'connection', None)
+        if not connection:
+            connection = sqlite3.connect(self.__catalog_file, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # with WAL, a commit is durable at the next checkpoint
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.__thread_data.connection = connection
+        return connection
+
+    def _upgrade(self):
+        """
+            The items of an older catalog are normalized again
+        """
+        with self.transaction() as connection:
+            if connection.execute('PRAGMA user_version').fetchone()[0] >= CATALOG_VERSION:
+                return
+            connection.create_function('normalize_text', 1, normalize_text, deterministic=True)
+            connection.execute('UPDATE items SET norm_title = normalize_text(name), '
+                               'norm_author = normalize_text(author)')
+            connection.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def has_bundle(self, bundle_key):
+        row = self.connection.execute('SELECT 1 FROM bundles WHERE bundle_key = ?', (bundle_key,)).fetchone()
+        return row is not None
+
+    def list_bundles(self):
+        return self.connection.execute('SELECT bundle_key, name, url FROM bundles ORDER BY bundle_key').fetchall()
+
+    def load_bundle(self, bundle_key):
+        """
+        :return: the dictionary of the bundle, as BundleInfo stores it, or None if it isn't in the catalog
+        """
+        connection = self.connection
+        row = connection.execute('SELECT data FROM bundles WHERE bundle_key = ?', (bundle_key,)).fetchone()
+        if not row:
+            return None
+        bundle_dict = loads(row[0])
+        items = {}
+        for item_key, data in connection.execute(
+                'SELECT item_key, data FROM items WHERE bundle_key = ? ORDER BY position', (bundle_key,)):
+            items[item_key] = loads(data)
+        for book_list, table in BOOK_LISTS.items():
+            for item_key, md5, data in connection.execute(
+                    f'SELECT item_key, md5, data FROM {table} WHERE bundle_key = ? ORDER BY item_key, position',
+                    (bundle_key,)):
+                if item_key in items:
+                    items[item_key].setdefault(book_list, {})[md5] = loads(data)
+        bundle_dict['tier_item_data'] = items
+        return bundle_dict
+
+    def write_bundle(self, bundle_key, bundle_dict):
+        """
+            Replaces all the rows of the bundle
+        """
+        with self.transaction() as connection:
+            self._replace_bundle(connection, bundle_key, bundle_dict)
+
+    def apply_changes(self, bundle_key, bundle_dict, operations):
+        """
+            Writes the rows changed by the BundleJournal operations, already applied to bundle_dict
+        """
+        with self.transaction() as connection:
+            for operation in operations:
+                path = operation[1]
+                if path[0] != 'tier_item_data':
+                    self._write_bundle_row(connection, bundle_key, bundle_dict)
+                elif len(path) == 1:
+                    self._replace_bundle(connection, bundle_key, bundle_dict)
+                elif (len(path) >= 3) and (path[2] in BOOK_LISTS):
+                    self._write_books(connection, bundle_key, bundle_dict, path[1], path[2],
+                                      md5=path[3] if len(path) > 3 else None)
+                else:
+                    self._write_item(connection, bundle_key, bundle_dict, path[1], with_books=(len(path) == 2))
+
+    def _replace_bundle(self, connection, bundle_key, bundle_dict):
+        for table in ('bundles', 'items', 'candidates', 'downloads'):
+            connection.execute(f'DELETE FROM {table} WHERE bundle_key = ?', (bundle_key,))
+        self._write_bundle_row(connection, bundle_key, bundle_dict)
+        for item_key in bundle_dict.get('tier_item_data', {}):
+            self._write_item(connection, bundle_key, bundle_dict, item_key)
+
+    def _write_bundle_row(self, connection, bundle_key, bundle_dict):
+        data = {key: value for key, value in bundle_dict.items() if key != 'tier_item_data'}
+        connection.execute('INSERT OR REPLACE INTO bundles VALUES (?, ?, ?, ?, ?, ?)',
+                           (bundle_key, bundle_dict.get('name', ''), bundle_dict.get('machine_name', ''),
+                            bundle_dict.get('url', ''), dumps(data).decode('utf-8'), time.time()))
+
+    def _write_item(self, connection, bundle_key, bundle_dict, item_key, with_books=True):
+        items = bundle_dict.get('tier_item_data', {})
+        item = items.get(item_key, None)
+        if item is None:
+            for table in ('items', 'candidates', 'downloads'):
+                connection.execute(f'DELETE FROM {table} WHERE bundle_key = ? AND item_key = ?',
+                                   (bundle_key, item_key))
+            return
+        # the books have their own tables, the item keeps an empty dictionary to know it had them
+        data = {key: ({} if key in BOOK_LISTS else value) for key, value in item.items()}
+        connection.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (bundle_key, item_key, list(items).index(item_key), item.get('name', ''),
+                            item.get('author', ''), normalize_text(item.get('name', '')),
+                            normalize_text(item.get('author', '')), int(bool(item.get('downloaded', False))),
+                            dumps(data).decode('utf-8')))
+        if with_books:
+            for book_list in BOOK_LISTS:
+                self._write_books(connection, bundle_key, bundle_dict, item_key, book_list)
+
+    def _write_books(self, connection, bundle_key, bundle_dict, item_key, book_list, md5=None):
+        """
+            Writes one book of the list, or the whole list if md5 is None
+        """
+        table = BOOK_LISTS[book_list]
+        books = bundle_dict.get('tier_item_data', {}).get(item_key, {}).get(book_list, None) or {}
+        if md5 is None:
+            connection.execute(f'DELETE FROM {table} WHERE bundle_key = ? AND item_key = ?', (bundle_key, item_key))
+            md5_list = list(books)
+        else:
+            md5_list = [md5]
+        for position, book_md5 in enumerate(md5_list):
+            book = books.get(book_md5, None)
+            if book is None:
+                connection.execute(f'DELETE FROM {table} WHERE bundle_key = ? AND item_key = ? AND md5 = ?',
+                                   (bundle_key, item_key, book_md5))
+                continue
+            if md5 is not None:
+                position = list(books).index(book_md5)
+            values = [bundle_key, item_key, book_md5, position, book.get('title', ''), dumps(book).decode('utf-8')]
+            if table == 'downloads':
+                values.append(time.time())
+            connection.execute(f'INSERT OR REPLACE INTO {table} VALUES ({", ".join("?" * len(values))})', values)
+
+    def find_md5(self, md5):
+        """
+        :return: a list of (bundle_key, item_key, 'downloaded' or 'found') of the book in every bundle
+        """
+        connection = self.connection
+        found = [(bundle_key, item_key, 'downloaded') for bundle_key, item_key in connection.execute(
+            'SELECT bundle_key, item_key FROM downloads WHERE md5 = ?', (md5,))]
+        found.extend((bundle_key, item_key, 'found') for bundle_key, item_key in connection.execute(
+            'SELECT bundle_key, item_key FROM candidates WHERE md5 = ?', (md5,)))
+        return found
+
+    def is_downloaded(self, md5):
+        row = self.connection.execute('SELECT 1 FROM downloads WHERE md5 = ? LIMIT 1', (md5,)).fetchone()
+        return row is not None
+
+    def find_title(self, title, author=''):
+        """
+        :return: a list of (bundle_key, item_key, name, author, downloaded) of the items with the same
+            normalized title (and author, if given). Empty if nothing is left of the title once normalized
+        """
+        norm_title = normalize_text(title)
+        if not norm_title:
+            return []
+        query = 'SELECT bundle_key, item_key, name, author, downloaded FROM items WHERE norm_title = ?'
+        parameters = [norm_title]
+        if author:
+            query += ' AND norm_author = ?'
+            parameters.append(normalize_text(author))
+        return self.connection.execute(query, parameters).fetchall()
+
+    def migrate_backup(self, backup_file):
+        """
+            Copies a JSON backup, with the records of its journal, into the catalog
+        :return: False if the file isn't a bundle backup
+        """
+        try:
+            bundle_dict = read_json_file(backup_file)
+        except (OSError, ValueError):
+            return False
+        if not (isinstance(bundle_dict, dict) and ('tier_item_data' in bundle_dict)):
+            return False
+        BundleJournal(backup_file).replay(bundle_dict)
+        self.write_bundle(get_bundle_key(backup_file), bundle_dict)
+        return True
+
+
+class CatalogStorage:
+    """
+        The storage of one BundleInfo in the catalog, with the same methods BundleInfo uses of BundleJournal
+
+        The changes are written as they happen, so there is nothing to replay or compact
+    """
+
+    def __init__(self, catalog, backup_file, bundle_dict):
+        self.__catalog = catalog
+        self.__bundle_key = get_bundle_key(backup_file)
+        self.__bundle_dict = bundle_dict
+
+    def snapshot_exists(self):
+        return self.__catalog.has_bundle(self.__bundle_key)
+
+    def append(self, operations):
+        self.__catalog.apply_changes(self.__bundle_key, self.__bundle_dict, operations)
+        return False
+
+    def replay(self, bundle_dict):
+        return bundle_dict
+
+    def write_snapshot(self, bundle_dict):
+        self.__catalog.write_bundle(self.__bundle_key, bundle_dict)
+
+
+library_catalog_mutex = Lock()
+library_catalog = None
+
+
+def get_library_catalog():
+    """
+        The catalog is created on first use, once parse_arguments has set the output dir
+    """
+    global library_catalog
+    with library_catalog_mutex:
+        if not library_catalog:
+            catalog_file = run_parameters.get('library_catalog_file', '')
+            if not catalog_file:
+                # next to the backups, the ones migrate_output_dir reads
+                os.makedirs(get_backup_folder(), exist_ok=True)
+                catalog_file = os.path.join(get_backup_folder(), LIBRARY_CATALOG_FILENAME)
+            library_catalog = LibraryCatalog(catalog_file)
+        return library_catalog
+
+
+def migrate_output_dir(catalog):
+    migrated = 0
+    backup_folder = get_backup_folder()
+    # a backup and its compressed versions are the same bundle
+    backup_files = set()
+    for name in sorted(os.listdir(backup_folder)):
+        backup_file = os.path.join(backup_folder, name)
+        if (not os.path.isfile(backup_file)) or name.endswith(('.journal', '.tmp', '.log')) or \
+                name.startswith(LIBRARY_CATALOG_FILENAME):
+            continue
+        backup_files.add(strip_compressed_extension(backup_file))
+    for backup_file in sorted(backup_files):
+        if catalog.migrate_backup(backup_file):
+            print(f'Migrated {backup_file}')
+            migrated += 1
+    print(f'{migrated} bundles migrated to {catalog.catalog_file}')
+
+
+def display_help():
+    print('Library catalog\n'
+          '\tParameters: -h | -o "output_dir" | -m | -5 "md5" | -t "title" | -a "author"\n'
+          '-o Output dir of HumbleJson, the catalog is output_dir/library.sqlite3\n'
+          '-m Migrates the JSON backups of the output dir into the catalog\n'
+          '-5 Lists the bundles where a book has been found or downloaded\n'
+          '-t Lists the items with this title in every bundle\n'
+          '-a Author of the title searched with -t')
+
+
+def main():
+    migrate, md5, title, author = False, '', '', ''
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], 'ho:m5:t:a:')
+        for current_argument, current_value in arguments:
+            if current_argument == '-h':
+                display_help()
+                return
+            elif current_argument == '-o':
+                run_parameters['output_dir'] = current_value
+            elif current_argument == '-m':
+                migrate = True
+            elif current_argument == '-5':
+                md5 = current_value
+            elif current_argument == '-t':
+                title = current_value
+            elif current_argument == '-a':
+                author = current_value
+    except getopt.error as err:
+        print(str(err))
+        return
+    catalog = get_library_catalog()
+    if migrate:
+        migrate_output_dir(catalog)
+    if md5:
+        for bundle_key, item_key, state in catalog.find_md5(md5):
+            print(f'{md5}\t{state}\t{bundle_key}\t{item_key}')
+    if title:
+        for bundle_key, item_key, name, item_author, downloaded in catalog.find_title(title, author):
+            print(f'{name} - {item_author}\t{"downloaded" if downloaded else "pending"}\t{bundle_key}\t{item_key}')
+
+
+if __name__ == '__main__':
+    main()
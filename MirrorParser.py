@@ -1,9 +1,19 @@
 """
     Each libgen mirror is subtly different from the others in the way the
     pages are built and where each piece of data is stored
+
+    The result pages are big, so the parsers try to do as little work as possible:
+     - each parser has a SoupStrainer (results_strainer, fiction_results_strainer) so only the
+       tables and scripts of the result page are turned into a tree
+     - the CSS selectors are compiled once with soupsieve
+     - the results table is walked once, row by row, taking author, title, publisher and
+       extension from the cells of each <tr>
 """
 import re
 
+import soupsieve
+from bs4 import SoupStrainer
+
 from annasarchive import build_search_url
 from utils import run_parameters, libgen_search_libgen_rs, libgen_search_libgen_is, \
     libgen_search_libgen_li, build_url, libgen_search_libgen_rc, annas_archive_search
@@ -19,6 +29,28 @@ def build_book_dict(title, author, publisher, extension, url):
     }
 
 
+def top_level_tables(soup):
+    """
+        The tables that are direct children of <body> or, in a strained soup, of the document itself
+    """
+    container = soup.body if soup.body else soup
+    return container.find_all('table', recursive=False)
+
+
+def table_rows(table):
+    """
+        The rows of a table, with or without <tbody>, skipping the rows of nested tables
+    """
+    rows = table.find_all('tr', recursive=False)
+    for body in table.find_all('tbody', recursive=False):
+        rows.extend(body.find_all('tr', recursive=False))
+    return rows
+
+
+def row_cells(row):
+    return row.find_all('td', recursive=False)
+
+
 class LibgenIterator:
     """
         Iterates through a series of result pages
@@ -82,6 +114,9 @@ class LibGenParser:
     """
         Generic virtual class
     """
+    # a SoupStrainer to parse only the parts of the result pages that are used
+    results_strainer = None
+    fiction_results_strainer = None
 
     def get_list_results_pages(self, soup, base_url):
         raise NotImplementedError
@@ -115,16 +150,23 @@ class LibGenParserRs(LibGenParser):
 
         It also works for libgen.is
     """
-    items_found_selector = 'body table:nth-of-type(2) td:nth-child(1) font'
-    authors_selector = 'table:nth-of-type(3) tr:not(:first-child) td:nth-of-type(2)'
-    titles_selector = 'table:nth-of-type(3) tr:not(:first-child) td:nth-of-type(3)'
-    publisher_selector = 'table:nth-of-type(3) tr:not(:first-child) td:nth-of-type(4)'
-    extension_selector = 'table:nth-of-type(3) tr:not(:first-child) td:nth-of-type(9)'
+    results_strainer = SoupStrainer(['table', 'script'])
+    fiction_results_strainer = SoupStrainer(['table', 'select'])
+
+    # the results are in the third table of the page, one book per row (the first row is the header)
+    # author, title, publisher and extension are in the cells 2, 3, 4 and 9
+    results_table_index = 2
+    author_cell, title_cell, publisher_cell, extension_cell = 1, 2, 3, 8
     regex_md5 = re.compile('md5=([A-F0-9]+)')
 
-    authors_fiction_selector = 'table.catalog ul.catalog_authors'
-    titles_fiction_selector = 'table.catalog tbody td:nth-of-type(3) a'
-    extension_fiction_selector = 'table.catalog tbody td:nth-of-type(5)'
+    # the link to the fiction search is in the third cell of the second table
+    fiction_link_selector = soupsieve.compile('td:nth-of-type(3) a')
+
+    catalog_selector = soupsieve.compile('table.catalog')
+    authors_fiction_selector = soupsieve.compile('ul.catalog_authors')
+    page_selector_fiction = soupsieve.compile('select.page_selector')
+    # author, title (a link) and extension are in the cells 1, 3 and 5
+    title_fiction_cell, extension_fiction_cell = 2, 4
     regex_md5_fiction = re.compile('/fiction/([A-F0-9]+)')
 
     def __init__(self):
@@ -143,7 +185,7 @@ class LibGenParserRs(LibGenParser):
         if not self.__paginator:
             num = 1
             try:
-                page_selector = soup.select_one('div.catalog_paginator select.page_selector')
+                page_selector = self.page_selector_fiction.select_one(soup)
                 if page_selector:
                     num_last_page = re.search(r'\s*([0-9]+)', page_selector.text.split('/')[-1])
                     num = int(num_last_page.group(1))
@@ -153,19 +195,23 @@ class LibGenParserRs(LibGenParser):
         return self.__paginator
 
     def get_non_fiction(self, soup):
-        all_authors = soup.select(self.authors_selector)
-        all_titles = soup.select(self.titles_selector)
-        all_publishers = soup.select(self.publisher_selector)
-        all_extensions = soup.select(self.extension_selector)
         books_found = {}
-        for a, t, p, e in zip(all_authors, all_titles, all_publishers, all_extensions):
+        all_tables = top_level_tables(soup)
+        if len(all_tables) <= self.results_table_index:
+            return books_found
+        for row in table_rows(all_tables[self.results_table_index])[1:]:
+            cells = row_cells(row)
+            if len(cells) <= self.extension_cell:
+                continue
+            a, t, p, e = (cells[self.author_cell], cells[self.title_cell],
+                          cells[self.publisher_cell], cells[self.extension_cell])
             # in some results we have some data we don't want to parse, so I get rid of it
-            links_in_title = t.select('a')
+            links_in_title = t.find_all('a')
             link_to_book = None
             for l in links_in_title:
                 if l.get('id', None):
                     link_to_book = l
-                    fonts = link_to_book.select('font')
+                    fonts = link_to_book.find_all('font')
                     for f in fonts:
                         f.extract()
                     break
@@ -184,26 +230,42 @@ class LibGenParserRs(LibGenParser):
         return books_found
 
     def get_fiction(self, soup):
-        all_authors = soup.select(self.authors_fiction_selector)
-        all_titles = soup.select(self.titles_fiction_selector)
-        all_extensions = soup.select(self.extension_fiction_selector)
         books_found = {}
-        for a, t, e in zip(all_authors, all_titles, all_extensions):
-            book_url = t['href']
-            book_id = self.regex_md5_fiction.search(book_url)
-            if book_id:
-
-                books_found[book_id.group(1)] = build_book_dict(t.text,
-                                                                a.text,
-                                                                '',
-                                                                e.text.split('/')[0].strip().lower(),
-                                                                build_url(run_parameters['libgen_base'], book_url))
-            else:
-                print(f'!!!!!!!!!!!! {book_url} - {t.text} - {a.text}')
+        catalog = self.catalog_selector.select_one(soup)
+        if not catalog:
+            return books_found
+        for body in catalog.find_all('tbody', recursive=False):
+            for row in body.find_all('tr', recursive=False):
+                book = self.get_fiction_row(row)
+                if book:
+                    books_found[book[0]] = book[1]
         return books_found
 
+    def get_fiction_row(self, row):
+        cells = row_cells(row)
+        if len(cells) <= self.extension_fiction_cell:
+            return None
+        a = self.authors_fiction_selector.select_one(row)
+        t = cells[self.title_fiction_cell].find('a')
+        e = cells[self.extension_fiction_cell]
+        if (not a) or (not t):
+            return None
+        book_url = t['href']
+        book_id = self.regex_md5_fiction.search(book_url)
+        if book_id:
+            return book_id.group(1), build_book_dict(t.text,
+                                                     a.text,
+                                                     '',
+                                                     e.text.split('/')[0].strip().lower(),
+                                                     build_url(run_parameters['libgen_base'], book_url))
+        print(f'!!!!!!!!!!!! {book_url} - {t.text} - {a.text}')
+        return None
+
     def search_fiction_link(self, soup):
-        fiction = soup.select_one('body>table:nth-of-type(2) td:nth-of-type(3) a')
+        all_tables = top_level_tables(soup)
+        if len(all_tables) < 2:
+            return
+        fiction = self.fiction_link_selector.select_one(all_tables[1])
         if fiction:
             self.__fiction_link = fiction['href']
 
@@ -217,11 +279,11 @@ class LibGenParserLi(LibGenParser):
 
         All the fiction-related methods do nothing
     """
-    authors_selector = 'table#tablelibgen tbody td:nth-of-type(2)'
-    titles_selector = 'table#tablelibgen tbody td:nth-of-type(1)>a:nth-of-type(1)'
-    publisher_selector = 'table#tablelibgen tbody td:nth-of-type(3)'
-    extension_selector = 'table#tablelibgen tbody td:nth-of-type(8)'
-    link_selector = 'table#tablelibgen tbody td:nth-of-type(9) a:nth-of-type(1)'
+    results_strainer = SoupStrainer(['table', 'script'])
+
+    results_table_selector = soupsieve.compile('table#tablelibgen')
+    # title (the first link), author, publisher and extension are in the cells 1, 2, 3 and 8
+    title_cell, author_cell, publisher_cell, extension_cell = 0, 1, 2, 7
     regex_id = re.compile('id=([A-F0-9]+)')
 
     def __init__(self):
@@ -241,25 +303,35 @@ class LibGenParserLi(LibGenParser):
         return self.__paginator
 
     def get_non_fiction(self, soup):
-        all_authors = soup.select(self.authors_selector)
-        all_titles = soup.select(self.titles_selector)
-        all_publishers = soup.select(self.publisher_selector)
-        all_extensions = soup.select(self.extension_selector)
-        # all_links = soup.select(self.link_selector)
         books_found = {}
-        for a, t, p, e in zip(all_authors, all_titles, all_publishers, all_extensions):
-            book_url = t['href']
-            book_id_m = self.regex_id.search(book_url)
-            if book_id_m:
-                book_id = book_id_m.group(1)
-                books_found[book_id] = build_book_dict(t.text,
+        results_table = self.results_table_selector.select_one(soup)
+        if not results_table:
+            return books_found
+        for body in results_table.find_all('tbody', recursive=False):
+            for row in body.find_all('tr', recursive=False):
+                book = self.get_non_fiction_row(row)
+                if book:
+                    books_found[book[0]] = book[1]
+        return books_found
+
+    def get_non_fiction_row(self, row):
+        cells = row_cells(row)
+        if len(cells) <= self.extension_cell:
+            return None
+        t = cells[self.title_cell].find('a', recursive=False)
+        if not t:
+            return None
+        a, p, e = cells[self.author_cell], cells[self.publisher_cell], cells[self.extension_cell]
+        book_url = t['href']
+        book_id_m = self.regex_id.search(book_url)
+        if book_id_m:
+            return book_id_m.group(1), build_book_dict(t.text,
                                                        a.text,
                                                        p.text,
                                                        e.text.lower(),
                                                        build_url(run_parameters['libgen_base'], book_url))
-            else:
-                print(f'!!!!!!!!!!!! {book_url} - {t.text} - {a.text} - {p.text}')
-        return books_found
+        print(f'!!!!!!!!!!!! {book_url} - {t.text} - {a.text} - {p.text}')
+        return None
 
     def get_fiction(self, soup):
         return {}
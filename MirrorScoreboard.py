@@ -0,0 +1,209 @@
+"""
+    Measured ranking of the download mirrors
+
+    For each mirror host the scoreboard keeps the attempts, successes and failures, and a moving average
+    of the time to first byte and of the throughput of its downloads. The stats are stored in a JSON file
+    (run_parameters['mirror_scoreboard_file'], by default in output_dir) so they survive between runs.
+
+    rank orders the mirrors of a book by their expected download time:
+
+        (time to first byte + EXPECTED_BOOK_SIZE / throughput) / probability of success
+
+    The hosts never tried use PRIOR_TTFB and PRIOR_THROUGHPUT. A host that fails DEAD_HOST_FAILURES times
+    in a row is considered dead and goes to the end of the list, until DEAD_HOST_PROBE_INTERVAL seconds
+    after its last attempt: then it goes first once, to check if it has recovered. The rank that hands out
+    the probe counts it as an attempt, so the downloads ranked while the probe runs don't go to the host
+
+    A download is measured with attempt(mirror_url): the requests download functions running inside
+    the block add the time to first byte and the bytes received (transfer_finished) to the attempt of
+    the current thread
+
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from threading import Lock
+from urllib.parse import urlparse
+
+from JsonCodec import read_json_state, write_json_state
+from utils import run_parameters
+
+MIRROR_SCOREBOARD_FILENAME = 'mirror_scoreboard.json'
+# weight of the last measure in the moving averages
+EWMA_WEIGHT = 0.3
+EXPECTED_BOOK_SIZE = 10 * 1024 * 1024
+PRIOR_TTFB = 2.0
+PRIOR_THROUGHPUT = 500 * 1024
+DEAD_HOST_FAILURES = 3
+DEAD_HOST_PROBE_INTERVAL = 3600
+
+
+def get_host(url):
+    return urlparse(url).hostname or url
+
+
+def moving_average(average, value):
+    if average is None:
+        return value
+    return (1 - EWMA_WEIGHT) * average + EWMA_WEIGHT * value
+
+
+class MirrorAttempt:
+    """
+        One download from a mirror. succeeded is set by the caller, discard() if the result isn't known
+    """
+
+    def __init__(self, mirror_url):
+        self.mirror_url = mirror_url
+        self.host = get_host(mirror_url)
+        self.start = time.monotonic()
+        self.ttfb = None
+        self.size = 0
+        self.transfer_time = 0
+        self.succeeded = False
+        self.discarded = False
+
+    def discard(self):
+        self.discarded = True
+
+
+class MirrorScoreboard:
+
+    def __init__(self, scoreboard_file=None):
+        self.__scoreboard_file = scoreboard_file
+        self.__mutex = Lock()
+        self.__thread_data = threading.local()
+        self.__hosts = read_json_state(self.__scoreboard_file, 'MirrorScoreboard')
+
+    def host_stats(self, host):
+        with self.__mutex:
+            return dict(self.__hosts.get(host, {}))
+
+    def record(self, host, succeeded, ttfb=None, size=0, transfer_time=0):
+        now = time.time()
+        with self.__mutex:
+            stats = self.__hosts.setdefault(host, {
+                'attempts': 0, 'successes': 0, 'failures': 0, 'consecutive_failures': 0,
+                'ttfb': None, 'throughput': None, 'last_attempt': 0, 'last_success': 0
+            })
+            stats['attempts'] += 1
+            stats['last_attempt'] = now
+            if succeeded:
+                stats['successes'] += 1
+                stats['consecutive_failures'] = 0
+                stats['last_success'] = now
+                if ttfb is not None:
+                    stats['ttfb'] = moving_average(stats['ttfb'], ttfb)
+                if size and transfer_time > 0:
+                    stats['throughput'] = moving_average(stats['throughput'], size / transfer_time)
+            else:
+                stats['failures'] += 1
+                stats['consecutive_failures'] += 1
+            write_json_state(self.__scoreboard_file, self.__hosts)
+
+    def is_dead(self, host, now=None):
+        stats = self.__hosts.get(host, None)
+        if (not stats) or stats['consecutive_failures'] < DEAD_HOST_FAILURES:
+            return False
+        return ((now or time.time()) - stats['last_attempt']) < DEAD_HOST_PROBE_INTERVAL
+
+    def needs_probe(self, host, now=None):
+        stats = self.__hosts.get(host, None)
+        if (not stats) or stats['consecutive_failures'] < DEAD_HOST_FAILURES:
+            return False
+        return ((now or time.time()) - stats['last_attempt']) >= DEAD_HOST_PROBE_INTERVAL
+
+    def expected_time(self, host):
+        stats = self.__hosts.get(host, {})
+        ttfb = stats.get('ttfb', None)
+        throughput = stats.get('throughput', None)
+        # Laplace smoothing: a host without attempts has a probability of success of 1/2
+        success_rate = (stats.get('successes', 0) + 1) / (stats.get('attempts', 0) + 2)
+        ttfb = PRIOR_TTFB if ttfb is None else ttfb
+        throughput = PRIOR_THROUGHPUT if not throughput else throughput
+        return (ttfb + EXPECTED_BOOK_SIZE / throughput) / success_rate
+
+    def rank(self, mirror_list):
+        """
+        :return: the mirrors sorted from the fastest expected download to the slowest, dead hosts at the end
+        """
+        now = time.time()
+        with self.__mutex:
+            probes = set()
+            for mirror in mirror_list:
+                host = get_host(mirror)
+                if self.needs_probe(host, now):
+                    # only this caller probes the host, for the rest it's dead until the probe ends
+                    self.__hosts[host]['last_attempt'] = now
+                    probes.add(host)
+
+            def sort_key(mirror):
+                host = get_host(mirror)
+                if host in probes:
+                    return 0, 0
+                if self.is_dead(host, now):
+                    return 2, 0
+                return 1, self.expected_time(host)
+            return sorted(mirror_list, key=sort_key)
+
+    @contextmanager
+    def attempt(self, mirror_url):
+        """
+            Measures a download from mirror_url, recorded when the block ends. An exception is a failure
+        """
+        mirror_attempt = MirrorAttempt(mirror_url)
+        previous_attempt = getattr(self.__thread_data, 'attempt', None)
+        self.__thread_data.attempt = mirror_attempt
+        try:
+            yield mirror_attempt
+        except BaseException:
+            mirror_attempt.succeeded = False
+            raise
+        finally:
+            self.__thread_data.attempt = previous_attempt
+            if not mirror_attempt.discarded:
+                self.record(mirror_attempt.host, mirror_attempt.succeeded, ttfb=mirror_attempt.ttfb,
+                            size=mirror_attempt.size, transfer_time=mirror_attempt.transfer_time)
+
+    def transfer_finished(self, url, ttfb, size, transfer_time):
+        """
+            Called by the download functions. Outside an attempt the download is recorded for the host of url
+        """
+        mirror_attempt = getattr(self.__thread_data, 'attempt', None)
+        if mirror_attempt:
+            if mirror_attempt.ttfb is None:
+                mirror_attempt.ttfb = ttfb
+            mirror_attempt.size += size
+            mirror_attempt.transfer_time += transfer_time
+        else:
+            self.record(get_host(url), True, ttfb=ttfb, size=size, transfer_time=transfer_time)
+
+    def stats_to_str(self):
+        with self.__mutex:
+            hosts = {host: dict(stats) for host, stats in self.__hosts.items()}
+        lines = []
+        for host, stats in sorted(hosts.items()):
+            ttfb = f'{stats["ttfb"]:.2f}s' if stats['ttfb'] is not None else '-'
+            throughput = f'{stats["throughput"] / 1024:.0f} KB/s' if stats['throughput'] else '-'
+            lines.append(f'Mirror {host}: {stats["successes"]}/{stats["attempts"]} downloads, '
+                         f'first byte {ttfb}, {throughput}')
+        return '\n'.join(lines)
+
+
+mirror_scoreboard_mutex = Lock()
+mirror_scoreboard = None
+
+
+def get_mirror_scoreboard():
+    """
+        The scoreboard is created on first use, once parse_arguments has set the output dir
+    """
+    global mirror_scoreboard
+    with mirror_scoreboard_mutex:
+        if not mirror_scoreboard:
+            scoreboard_file = run_parameters.get('mirror_scoreboard_file', '')
+            if not scoreboard_file:
+                scoreboard_file = os.path.join(run_parameters['output_dir'], MIRROR_SCOREBOARD_FILENAME)
+            mirror_scoreboard = MirrorScoreboard(scoreboard_file)
+        return mirror_scoreboard
@@ -0,0 +1,452 @@
+"""
+    Local stand-in for Humble Bundle and the LibGen mirrors, to run the whole pipeline offline
+
+    The server works as an HTTP proxy: the requests keep their real URLs (http://libgen.rs/search.php...)
+    and the server answers depending on the host and the path:
+     - www.humblebundle.com: a bundle page with the JSON in the "webpack-bundle-page-data" script
+     - libgen.rs: search.php (results and paginator), fiction/ (empty fiction search) and
+       book/index.php?md5= (the page with the mirrors)
+     - libgen.li: index.php (results and paginator), edition.php?id= (the page with the mirrors) and
+       ads.php?md5= (the page with the download link)
+     - library.lol: main/MD5 (the page with the download link)
+     - get.php?md5= in any host: the book, with Range/If-Range support
+
+    The contents are synthetic but deterministic: the same query always gets the same books, and the
+    MD5 of each book is the real MD5 of its content. Only the first result page of each search has books
+    that match the title of the Humble item, the rest are noise discarded by filter_search_results
+
+    The conditions of the network are configured in StandInConfig:
+     - latency: seconds added to every response
+     - bandwidth: bytes per second of each connection sending a book (0 = unlimited), host_bandwidth
+       changes it for some hosts ({'library.lol': 10000})
+     - error_rate: probability of answering 503
+     - throttle_rate: requests per second allowed for each host before answering 429 with Retry-After
+       (0 = no limit)
+
+    Usage: python MirrorStandIn.py [port]
+
+"""
+import hashlib
+import json
+import math
+import random
+import sys
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+from urllib.parse import urlsplit, parse_qs, quote
+
+HUMBLE_HOST = 'www.humblebundle.com'
+LIBGEN_RS_HOST = 'libgen.rs'
+LIBGEN_LI_HOST = 'libgen.li'
+LIBRARY_LOL_HOST = 'library.lol'
+NOISE_BOOK_SIZE = 4 * 1024
+SEND_CHUNK_SIZE = 16 * 1024
+
+TOPICS = ['Python', 'Distributed', 'Systems', 'Compilers', 'Databases', 'Networks', 'Graphics', 'Security',
+          'Algorithms', 'Kubernetes', 'Rust', 'Haskell', 'Statistics', 'Robotics', 'Cryptography', 'Linux']
+
+
+class StandInConfig:
+
+    def __init__(self, items_per_bundle=10, books_per_item=2, result_pages=2, results_per_page=5,
+                 book_size=1024 * 1024, latency=0.05, bandwidth=0, error_rate=0.0, throttle_rate=0, seed=0,
+                 host_bandwidth=None):
+        self.items_per_bundle = items_per_bundle
+        self.books_per_item = books_per_item
+        self.result_pages = result_pages
+        self.results_per_page = results_per_page
+        self.book_size = book_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+        self.host_bandwidth = host_bandwidth if host_bandwidth else {}
+
+    def get_bandwidth(self, host):
+        return self.host_bandwidth.get(host, self.bandwidth)
+
+
+def item_title(bundle_name, idx):
+    words = [TOPICS[(idx + shift * 7 + len(bundle_name)) % len(TOPICS)] for shift in range(3)]
+    return f'Stand-in Handbook of {" ".join(words)} volume{idx}'
+
+
+def build_bundle_json(bundle_name, num_items):
+    items = {}
+    for idx in range(num_items):
+        items[f'{bundle_name}_item_{idx}'] = {
+            'human_name': item_title(bundle_name, idx),
+            'developers': [{'developer-name': f'Author {idx}', 'developer-url': ''}],
+            'publishers': [{'publisher-name': 'Stand-in Press', 'publisher-url': ''}],
+            'description_text': f'Book {idx} of the {bundle_name} bundle'
+        }
+    return {
+        'bundleData': {
+            # like in Humble Bundle, the machine name isn't the last part of the url
+            'machine_name': f'{bundle_name.replace("-", "")}_bookbundle',
+            'basic_data': {'human_name': f'Humble stand-in bundle {bundle_name}'},
+            'tier_item_data': items,
+            'tier_order': ['all'],
+            'tier_display_data': {'all': {'tier_item_machine_names': list(items)}}
+        }
+    }
+
+
+class StandInBook:
+    """
+        The content of a book is a block derived from its key, repeated up to its size
+    """
+
+    def __init__(self, key, title, extension, size):
+        self.title = title
+        self.extension = extension
+        self.size = size
+        self.block = hashlib.sha256(key.encode('utf-8')).digest() * 2048
+        md5 = hashlib.md5()
+        for start in range(0, size, len(self.block)):
+            md5.update(self.content(start, min(start + len(self.block), size) - 1))
+        self.md5 = md5.hexdigest().upper()
+
+    def content(self, start, end):
+        """
+            Bytes start..end (both included)
+        """
+        block_size = len(self.block)
+        data = bytearray()
+        position = start
+        while position <= end:
+            offset = position % block_size
+            piece = self.block[offset:offset + end - position + 1]
+            data += piece
+            position += len(piece)
+        return bytes(data)
+
+
+class StandInCatalog:
+    """
+        The books returned by each search, generated on the first search and kept by MD5
+    """
+
+    def __init__(self, config):
+        self.__config = config
+        self.__mutex = Lock()
+        self.__searches = {}
+        self.__books = {}
+
+    def search(self, query, page):
+        """
+        :return: the list of books of a result page
+        """
+        with self.__mutex:
+            if (query, page) not in self.__searches:
+                books = []
+                for row in range(self.__config.results_per_page):
+                    key = f'{self.__config.seed}|{query}|{page}|{row}'
+                    if (page == 1) and (row < self.__config.books_per_item):
+                        book = StandInBook(key, f'{query} edition {row + 1}', ('pdf', 'epub')[row % 2],
+                                           self.__config.book_size)
+                    else:
+                        book = StandInBook(key, f'Unrelated notes {page} {row}', 'djvu', NOISE_BOOK_SIZE)
+                    self.__books[book.md5] = book
+                    books.append(book)
+                self.__searches[(query, page)] = books
+            return self.__searches[(query, page)]
+
+    def get_book(self, md5):
+        with self.__mutex:
+            return self.__books.get(md5.upper(), None)
+
+    def get_book_by_id(self, book_id):
+        """
+            libgen.li identifies the editions with a number, here it's the position of the book in the catalog
+        """
+        with self.__mutex:
+            books = list(self.__books.values())
+        return books[book_id] if 0 <= book_id < len(books) else None
+
+    def get_book_id(self, md5):
+        with self.__mutex:
+            return list(self.__books).index(md5)
+
+
+class TokenBucket:
+
+    def __init__(self, rate):
+        self.__rate = rate
+        self.__capacity = max(1.0, rate)
+        self.__tokens = self.__capacity
+        self.__last_update = time.monotonic()
+        self.__mutex = Lock()
+
+    def take(self):
+        with self.__mutex:
+            now = time.monotonic()
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last_update) * self.__rate)
+            self.__last_update = now
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return True
+            return False
+
+
+class StandInStats:
+
+    def __init__(self):
+        self.__mutex = Lock()
+        self.requests = {}
+        self.status = {}
+        self.book_bytes = 0
+
+    def count_request(self, host, status):
+        with self.__mutex:
+            self.requests[host] = self.requests.get(host, 0) + 1
+            self.status[status] = self.status.get(status, 0) + 1
+
+    def count_book_bytes(self, num_bytes):
+        with self.__mutex:
+            self.book_bytes += num_bytes
+
+    def to_str(self):
+        with self.__mutex:
+            requests = ', '.join(f'{host}: {count}' for host, count in sorted(self.requests.items()))
+            status = ', '.join(f'{code}: {count}' for code, count in sorted(self.status.items()))
+            return f'Requests by host: {requests}\nResponses by status: {status}\nBook bytes sent: {self.book_bytes}'
+
+
+def rs_search_page(books, query, last_page):
+    rows = ''.join(
+        f'<tr valign=top bgcolor="#C6DEFF"><td>{idx}</td><td><a href="search.php?req=author">Author {idx}</a></td>'
+        f'<td width=500><a href="book/index.php?md5={book.md5}" title="" id={idx}>{book.title}</a></td>'
+        f'<td>Stand-in Press</td><td nowrap>2020</td><td>300</td><td>English</td><td nowrap>1 Mb</td>'
+        f'<td nowrap>{book.extension}</td><td><a href="http://library.lol/main/{book.md5}">[1]</a></td>'
+        f'<td><a href="http://libgen.li/ads.php?md5={book.md5}">[2]</a></td></tr>\n'
+        for idx, book in enumerate(books))
+    return (f'<html><head><title>Library Genesis</title>'
+            f'<script type="text/javascript" src="paginator3000.js"></script></head><body>\n'
+            f'<table><tr><td><a href="/">Library Genesis</a></td></tr></table>\n'
+            f'<table><tr><td>{len(books)} files found</td><td></td>'
+            f'<td><a href="fiction/?q={quote(query)}">fiction</a></td></tr></table>\n'
+            f'<table class=c><tr valign=top bgcolor=#C0C0C0><td>ID</td><td>Author(s)</td><td>Title</td>'
+            f'<td>Publisher</td><td>Year</td><td>Pages</td><td>Language</td><td>Size</td><td>Extension</td>'
+            f'<td colspan=2>Mirrors</td></tr>\n{rows}</table>\n'
+            f'<script type="text/javascript">\npaginator_example_top = new Paginator(\n"paginator_example_top",\n'
+            f'    {last_page}, // total pages\n    25, // pages to show\n    1, // current page\n'
+            f'    "search.php?req={quote(query)}&page=" // url\n);</script></body></html>')
+
+
+def rs_fiction_page():
+    return ('<html><body><table class="catalog"><thead><tr><td>Author(s)</td><td>Series</td><td>Title</td>'
+            '<td>Language</td><td>File</td><td>Mirrors</td></tr></thead><tbody></tbody></table></body></html>')
+
+
+def rs_md5_page(book):
+    rows = ''.join(f'<tr><td>Field {idx}</td><td>Value {idx}</td></tr>\n' for idx in range(16))
+    return (f'<html><body><table rules=cols width=100% border=1>\n<tr><td colspan=2>{book.title}</td></tr>\n'
+            f'{rows}<tr><td><a href="http://library.lol/main/{book.md5}">Gen.lib.rus.ec</a> '
+            f'<a href="http://libgen.li/ads.php?md5={book.md5}">Libgen.li</a></td></tr>\n</table></body></html>')
+
+
+def library_lol_page(book):
+    return (f'<html><body><div id="download"><h2><a href="http://library.lol/get.php?md5={book.md5}">GET</a></h2>'
+            f'<ul><li><a href="http://cloudflare-ipfs.com/ipfs/{book.md5}">Cloudflare</a></li></ul></div>'
+            f'<div id="info"><h1>{book.title}</h1></div></body></html>')
+
+
+def li_search_page(catalog, books, last_page):
+    rows = ''.join(
+        f'<tr><td><a href="edition.php?id={catalog.get_book_id(book.md5)}">{book.title}</a></td>'
+        f'<td>Author {idx}</td><td>Stand-in Press</td><td>2020</td><td>English</td><td>300</td>'
+        f'<td><a href="file.php?id={idx}">1 Mb</a></td><td>{book.extension}</td>'
+        f'<td><a href="ads.php?md5={book.md5}">[1]</a></td></tr>\n'
+        for idx, book in enumerate(books))
+    return (f'<html><head><script>$(function(){{ new Paginator("paginator_example_top", {last_page}, 10, 1, '
+            f'"index.php?req=title&page="); }});</script></head><body>\n'
+            f'<table id="tablelibgen"><thead><tr><th>Title</th><th>Author(s)</th><th>Publisher</th><th>Year</th>'
+            f'<th>Language</th><th>Pages</th><th>Size</th><th>Ext.</th><th>Mirrors</th></tr></thead><tbody>\n'
+            f'{rows}</tbody></table></body></html>')
+
+
+def li_edition_page(book):
+    return (f'<html><body><table id="tablelibgen"><tbody><tr><td>'
+            f'<a href="ads.php?md5={book.md5}">Libgen</a></td></tr><tr><td>'
+            f'<a href="http://library.lol/main/{book.md5}">Library.lol</a></td></tr></tbody></table></body></html>')
+
+
+def li_ads_page(book):
+    return (f'<html><body><table id="main"><tr><td>{book.title}</td>'
+            f'<td><a href="http://libgen.li/get.php?md5={book.md5}&key=STANDIN">GET</a></td></tr></table>'
+            f'</body></html>')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):
+        url_parts = urlsplit(self.path)
+        host = (url_parts.hostname or self.headers.get('Host', '')).split(':')[0]
+        path = url_parts.path
+        query = {key: values[0] for key, values in parse_qs(url_parts.query).items()}
+        config = self.server.config
+        if config.latency:
+            time.sleep(config.latency * random.uniform(0.5, 1.5))
+        bucket = self.server.get_bucket(host)
+        if bucket and not bucket.take():
+            self.send_page(429, 'Too many requests', host,
+                           {'Retry-After': str(max(1, math.ceil(1 / config.throttle_rate)))})
+            return
+        if random.random() < config.error_rate:
+            self.send_page(503, 'Service unavailable', host)
+            return
+        if path.endswith('/get.php'):
+            self.send_book(host, self.server.catalog.get_book(query.get('md5', '')))
+            return
+        page = self.build_page(host, path, query)
+        if page is None:
+            self.send_page(404, 'Not found', host)
+        else:
+            self.send_page(200, page, host)
+
+    def build_page(self, host, path, query):
+        server = self.server
+        if host == HUMBLE_HOST:
+            bundle_name = path.rstrip('/').split('/')[-1] or 'bundle'
+            bundle_json = json.dumps(build_bundle_json(bundle_name, server.config.items_per_bundle))
+            return (f'<html><body><script id="webpack-bundle-page-data" type="application/json">{bundle_json}'
+                    f'</script></body></html>')
+        if host == LIBGEN_RS_HOST:
+            if path.endswith('/search.php'):
+                page = int(query.get('page', 1))
+                books = server.catalog.search(query.get('req', ''), page)
+                return rs_search_page(books, query.get('req', ''), server.config.result_pages)
+            if path.startswith('/fiction'):
+                return rs_fiction_page()
+            book = server.catalog.get_book(query.get('md5', ''))
+            return rs_md5_page(book) if book else None
+        if host == LIBGEN_LI_HOST:
+            if path.endswith('/index.php'):
+                page = int(query.get('page', 1))
+                books = server.catalog.search(query.get('req', ''), page)
+                return li_search_page(server.catalog, books, server.config.result_pages)
+            if path.endswith('/edition.php'):
+                book = server.catalog.get_book_by_id(int(query.get('id', -1)))
+                return li_edition_page(book) if book else None
+            book = server.catalog.get_book(query.get('md5', ''))
+            return li_ads_page(book) if book else None
+        if host == LIBRARY_LOL_HOST:
+            book = server.catalog.get_book(path.split('/')[-1])
+            return library_lol_page(book) if book else None
+        return None
+
+    def send_page(self, status, text, host, headers=None):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats.count_request(host, status)
+
+    def get_range(self, book):
+        """
+        :return: (first byte, last byte) of the Range header, or None to send the whole book
+        """
+        range_header = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range', '')
+        if (not range_header.startswith('bytes=')) or (if_range and if_range != f'"{book.md5}"'):
+            return None
+        start, _, end = range_header[len('bytes='):].partition('-')
+        return int(start), min(int(end), book.size - 1) if end else book.size - 1
+
+    def send_book(self, host, book):
+        if not book:
+            self.send_page(404, 'Not found', host)
+            return
+        byte_range = self.get_range(book)
+        if byte_range and byte_range[0] >= book.size:
+            self.send_page(416, 'Range not satisfiable', host, {'Content-Range': f'bytes */{book.size}'})
+            return
+        start, end = byte_range if byte_range else (0, book.size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Disposition', f'attachment; filename="{book.md5.lower()}.{book.extension}"')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{book.md5}"')
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{book.size}')
+        self.end_headers()
+        bandwidth = self.server.config.get_bandwidth(host)
+        chunk_size = min(SEND_CHUNK_SIZE, bandwidth) if bandwidth else SEND_CHUNK_SIZE
+        sending_start = time.monotonic()
+        bytes_sent = 0
+        try:
+            for position in range(start, end + 1, chunk_size):
+                chunk = book.content(position, min(position + chunk_size, end + 1) - 1)
+                self.wfile.write(chunk)
+                bytes_sent += len(chunk)
+                if bandwidth:
+                    delay = bytes_sent / bandwidth - (time.monotonic() - sending_start)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (ConnectionError, OSError):
+            # the client has closed the connection
+            self.close_connection = True
+        finally:
+            self.server.stats.count_book_bytes(bytes_sent)
+            self.server.stats.count_request(host, 206 if byte_range else 200)
+
+
+class MirrorStandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config=None, port=0):
+        super().__init__(('127.0.0.1', port), StandInHandler)
+        self.config = config if config else StandInConfig()
+        self.catalog = StandInCatalog(self.config)
+        self.stats = StandInStats()
+        self.__buckets = {}
+        self.__buckets_mutex = Lock()
+        self.__thread = None
+
+    def handle_error(self, request, client_address):
+        # the clients close the keep-alive connections whenever they want
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def proxy_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def get_bucket(self, host):
+        if not self.config.throttle_rate:
+            return None
+        with self.__buckets_mutex:
+            if host not in self.__buckets:
+                self.__buckets[host] = TokenBucket(self.config.throttle_rate)
+            return self.__buckets[host]
+
+    def start(self):
+        self.__thread = Thread(target=self.serve_forever, name='MirrorStandInServer', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.__thread:
+            self.__thread.join()
+
+
+if __name__ == '__main__':
+    stand_in = MirrorStandInServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
+    print(f'Stand-in mirrors listening on {stand_in.proxy_url}, use it as HTTP proxy')
+    try:
+        stand_in.serve_forever()
+    except KeyboardInterrupt:
+        stand_in.server_close()
@@ -1,21 +1,37 @@
 """
-    Contains the class that wraps a selenium driver
+    Contains the class that wraps a selenium driver and a pool of those drivers
+
+    Each driver in the pool has its own preferences folder and its own download folder, so several
+    browsers can load pages and download books at the same time without stepping on each other
+
+    selenium is imported when the first browser is started
+
+    A page loaded in a browser and the click on its download link must happen with the browser checked
+    out (driver_in_use), current_driver raises DriverNotInUse instead of lending a browser that another
+    thread may be using
 """
 import datetime
 import os
 import shutil
 import sys
+import threading
 import time
+from contextlib import contextmanager
+from queue import Queue, Empty
+from threading import Lock
 
-from selenium import webdriver
-from selenium.webdriver.opera.options import Options
-
-import json
+from JsonCodec import read_json_file, write_json_file
 from utils import run_parameters, move_file_download_folder
 
+# the built-in VPN takes a while to connect after the browser starts
+OPERA_VPN_STARTUP_WAIT = 15
 OPERA_PREFERENCES_FOLDER = 'C:\\Users\\Héctor\\Desktop\\compartido_msedge\\PyCharmProjects\\HumbleJson\\opera_prefs\\'
 
 
+class DriverNotInUse(Exception):
+    pass
+
+
 class OperaDriver:
     """
         Encapsulates a Selenium Opera driver
@@ -28,28 +44,63 @@ class OperaDriver:
         A new preferences folder is created in each run to start the browser from scratch, avoiding
         caches, browser history, etc
 
+        instance_id is used to give each driver of a pool its own preferences and download folders,
+        download_folder to reuse the folder of a browser that has crashed
+
     """
 
-    def __init__(self):
+    def __init__(self, instance_id=0, download_folder=None):
+        self.__instance_id = instance_id
         self.__driver = None
-        self.__download_folder = None
+        self.__download_folder = download_folder
         self.__use_opera_vpn = False
         self.__opera_temp_prefs = None
         self.__opera_org_prefs = None
         self.__destination_path = None
+        self.__closed = False
+        # a driver has a single tab, only one page can be loaded at a time
+        self.mutex = Lock()
 
     def __del__(self):
-        print('close driver')
+        self.close()
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        print(f'close driver {self.__instance_id}')
         if self.__driver:
             try:
                 self.__driver.quit()
                 time.sleep(1)
             except Exception as err:
                 print(err)
-        self._empty_downloads_folder()
-        shutil.rmtree(self.__download_folder, ignore_errors=True)
-        shutil.rmtree(self.__opera_temp_prefs, ignore_errors=True)
-        print('driver closed')
+            self.__driver = None
+        if self.__download_folder:
+            self._empty_downloads_folder()
+            shutil.rmtree(self.__download_folder, ignore_errors=True)
+        if self.__opera_temp_prefs:
+            shutil.rmtree(self.__opera_temp_prefs, ignore_errors=True)
+        print(f'driver {self.__instance_id} closed')
+
+    @property
+    def instance_id(self):
+        return self.__instance_id
+
+    def is_alive(self):
+        """
+            A driver that hasn't been started yet is considered healthy, it will be created on first use
+        """
+        if self.__closed:
+            return False
+        if not self.__driver:
+            return True
+        try:
+            _ = self.__driver.current_url
+            return True
+        except Exception as err:
+            print(f'Driver {self.__instance_id} is not responding: {err}', file=sys.stderr)
+            return False
 
     def get_driver_opera(self,
                          # opera_exe_location=r'\opera_bin\102.0.4880.78\opera.exe',
@@ -57,6 +108,8 @@ class OperaDriver:
                          opera_preferences_location=None):   # pylint: disable=unused-argument
         if not opera_preferences_location:
             opera_preferences_location = OPERA_PREFERENCES_FOLDER
+        from selenium import webdriver
+        from selenium.webdriver.opera.options import Options
         self.__opera_org_prefs = opera_preferences_location
         self.copy_preferences_file()
         self._set_vpn_in_prefs()
@@ -70,14 +123,14 @@ class OperaDriver:
                 self.__driver = webdriver.Opera(options=opera_options, executable_path=opera_exe_location)
             else:
                 self.__driver = webdriver.Opera(options=opera_options)
-            time.sleep(15)
+            time.sleep(OPERA_VPN_STARTUP_WAIT)
         except Exception as err:
             print(f'Error creating driver {err}', file=sys.stderr)
             self.__driver = None
         pass
 
     def copy_preferences_file(self):
-        self.__opera_temp_prefs = os.path.join(os.getcwd(), 'opera_prefs_temp')
+        self.__opera_temp_prefs = os.path.join(os.getcwd(), f'opera_prefs_temp_{self.__instance_id}')
         shutil.rmtree(self.__opera_temp_prefs, ignore_errors=True)
         os.mkdir(self.__opera_temp_prefs)
         shutil.copyfile(os.path.join(self.__opera_org_prefs, 'Preferences_custom.txt'),
@@ -89,6 +142,14 @@ class OperaDriver:
             self.set_download_folder()
         return self.__download_folder
 
+    def release_download_folder(self):
+        """
+            The download folder is left as it is when the driver is closed
+        :return: the download folder, None if it hasn't been created
+        """
+        download_folder, self.__download_folder = self.__download_folder, None
+        return download_folder
+
     @property
     def destination_path(self):
         return self.__destination_path
@@ -111,15 +172,15 @@ class OperaDriver:
         return self.__driver
 
     def set_download_folder(self):
-        time_str = datetime.datetime.now().strftime('%Y%m%d_%H%M')
-        self.__download_folder = os.path.join(run_parameters['output_dir'], time_str)
+        if not self.__download_folder:
+            time_str = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+            self.__download_folder = os.path.join(run_parameters['output_dir'], f'{time_str}_{self.__instance_id}')
         os.makedirs(self.__download_folder, exist_ok=True)
-        with open(os.path.join(self.__opera_temp_prefs, 'Preferences'), 'r', encoding='utf-8') as file_org:
-            prefs_dict = json.load(file_org)
-            prefs_dict['download']['default_directory'] = self.__download_folder
+        prefs_file = os.path.join(self.__opera_temp_prefs, 'Preferences')
+        prefs_dict = read_json_file(prefs_file)
+        prefs_dict['download']['default_directory'] = self.__download_folder
         if prefs_dict:
-            with open(os.path.join(self.__opera_temp_prefs, 'Preferences'), 'w', encoding='utf-8') as file_dst:
-                json.dump(prefs_dict, file_dst)
+            write_json_file(prefs_file, prefs_dict)
 
     def _set_vpn_in_prefs(self):
         """
@@ -140,24 +201,124 @@ class OperaDriver:
                 "always_open_pdf_externally": true
             },
         """
-        with open(os.path.join(self.__opera_temp_prefs, 'Preferences'), 'r', encoding='utf-8') as file_org:
-            prefs_dict = json.load(file_org)
-            prefs_dict['freedom'] = dict(proxy_switcher={
-                'automatic_connection': True,
-                'enabled': True,
-                'forbidden': False,
-                'local_searches': False,
-            })
-            prefs_dict['plugins'] = {
-                'always_open_pdf_externally': True
-            }
+        prefs_file = os.path.join(self.__opera_temp_prefs, 'Preferences')
+        prefs_dict = read_json_file(prefs_file)
+        prefs_dict['freedom'] = dict(proxy_switcher={
+            'automatic_connection': True,
+            'enabled': True,
+            'forbidden': False,
+            'local_searches': False,
+        })
+        prefs_dict['plugins'] = {
+            'always_open_pdf_externally': True
+        }
         if prefs_dict:
-            with open(os.path.join(self.__opera_temp_prefs, 'Preferences'), 'w', encoding='utf-8') as file_dst:
-                json.dump(prefs_dict, file_dst)
+            write_json_file(prefs_file, prefs_dict)
 
     def _empty_downloads_folder(self):
+        if (not os.path.isdir(self.__download_folder)) or (not self.__destination_path):
+            return
         pending_files = os.listdir(self.__download_folder)
         for item in pending_files:
             _, file_downloading_extension = os.path.splitext(item)
             if file_downloading_extension != '.opdownload':
-                move_file_download_folder(self.__download_folder, self.__destination_path, item)
\ No newline at end of file
+                move_file_download_folder(self.__download_folder, self.__destination_path, item)
+
+
+class OperaDriverPool:
+    """
+        A pool of OperaDriver instances with checkout/checkin semantics
+
+        Drivers are created on demand, up to run_parameters['selenium_drivers'] instances. Every time a
+        driver is checked out it's health-checked and, if the browser has crashed, it's replaced by a
+        new instance with the same id (and so the same folders)
+
+        driver_in_use binds the checked-out driver to the current thread, so all the Connections
+        functions called inside the block (page load, click on the download link...) use the same browser
+    """
+
+    def __init__(self, size=None):
+        self.__size = size
+        self.__idle_drivers = Queue()
+        self.__all_drivers = {}
+        self.__pool_mutex = Lock()
+        self.__thread_data = threading.local()
+
+    def __del__(self):
+        self.close_all()
+
+    @property
+    def size(self):
+        if not self.__size:
+            self.__size = max(1, run_parameters.get('selenium_drivers', 1))
+        return self.__size
+
+    def checkout(self, timeout=None):
+        """
+            Gets an idle driver, creating a new one if the pool isn't full yet,
+            or waits for another thread to return one
+        """
+        try:
+            opera_driver = self.__idle_drivers.get_nowait()
+        except Empty:
+            opera_driver = None
+            with self.__pool_mutex:
+                if len(self.__all_drivers) < self.size:
+                    opera_driver = OperaDriver(instance_id=len(self.__all_drivers))
+                    self.__all_drivers[opera_driver.instance_id] = opera_driver
+            if not opera_driver:
+                opera_driver = self.__idle_drivers.get(timeout=timeout)
+        if not opera_driver.is_alive():
+            opera_driver = self.recycle(opera_driver)
+        return opera_driver
+
+    def checkin(self, opera_driver):
+        self.__idle_drivers.put(opera_driver)
+
+    def recycle(self, opera_driver):
+        """
+            The new driver downloads into the same folder: the downloads already finished there are still
+            waited for by the download pool
+        """
+        print(f'Recycling driver {opera_driver.instance_id}', file=sys.stderr)
+        new_driver = OperaDriver(instance_id=opera_driver.instance_id,
+                                 download_folder=opera_driver.release_download_folder())
+        if opera_driver.destination_path:
+            new_driver.destination_path = opera_driver.destination_path
+        opera_driver.close()
+        with self.__pool_mutex:
+            self.__all_drivers[new_driver.instance_id] = new_driver
+        return new_driver
+
+    def current_driver(self):
+        """
+            The driver bound to this thread by driver_in_use
+        :raise DriverNotInUse: if this thread hasn't checked out a driver
+        """
+        opera_driver = getattr(self.__thread_data, 'driver', None)
+        if not opera_driver:
+            raise DriverNotInUse('The browser must be used inside driver_in_use')
+        return opera_driver
+
+    @contextmanager
+    def driver_in_use(self):
+        """
+            Re-entrant: if this thread already holds a driver the same one is used
+        """
+        opera_driver = getattr(self.__thread_data, 'driver', None)
+        if opera_driver:
+            yield opera_driver
+            return
+        opera_driver = self.checkout()
+        self.__thread_data.driver = opera_driver
+        try:
+            yield opera_driver
+        finally:
+            self.__thread_data.driver = None
+            self.checkin(opera_driver)
+
+    def close_all(self):
+        with self.__pool_mutex:
+            for opera_driver in self.__all_drivers.values():
+                opera_driver.close()
+            self.__all_drivers = {}
@@ -0,0 +1,137 @@
+"""
+    Offline benchmark of the result page parsers
+
+    Every parser runs over the fixtures of BenchmarkFixtures (search, fiction and md5 pages of each
+    mirror layout, in small, 100 and pathological sizes) without touching the network. For each case
+    it reports:
+     - the median and best time of building the soup and parsing it
+     - the peak memory allocated while parsing (tracemalloc)
+     - rows (books or mirror links) found and rows per second
+
+    The medians are compared with a baseline (BenchmarkBaseline), the differences under half a
+    millisecond of the small pages are ignored
+
+    Usage: python ParserBenchmark.py [-r repeats] [-t threshold] [-b baseline_file] [-s]
+
+"""
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from BenchmarkBaseline import BaselineComparison, benchmark_main, DEFAULT_REPEATS, DEFAULT_THRESHOLD
+from BenchmarkFixtures import FIXTURE_SIZES, load_fixture
+from LibGenDownload import get_mirror_list_from_soup
+from MirrorParser import LibGenParserRs, LibGenParserLi, AnnasArchivesParser, get_paginator_last_page, \
+    get_paginator_last_page_one_line
+from utils import run_parameters, HTML_PARSER, libgen_search_libgen_rs, libgen_search_libgen_li, \
+    annas_archive_search
+
+BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+MD5 = '0' * 32
+
+
+class BenchmarkCase:
+    """
+        A fixture page, the mirror it comes from and the function that parses it
+
+        parse receives the soup and returns the number of rows found
+    """
+
+    def __init__(self, name, page, base_url, parse, strainer=None):
+        self.name = name
+        self.page = page
+        self.base_url = base_url
+        self.parse = parse
+        self.strainer = strainer
+
+
+def build_cases():
+    rs_parser, li_parser, annas_parser = LibGenParserRs(), LibGenParserLi(), AnnasArchivesParser()
+    rs_base, li_base = libgen_search_libgen_rs['base_url'], libgen_search_libgen_li['base_url']
+    return [
+        BenchmarkCase('rs_non_fiction', 'libgen_rs_search', rs_base,
+                      lambda soup: len(rs_parser.get_non_fiction(soup)), rs_parser.results_strainer),
+        BenchmarkCase('rs_fiction', 'libgen_rs_fiction', rs_base,
+                      lambda soup: len(rs_parser.get_fiction(soup)), rs_parser.fiction_results_strainer),
+        BenchmarkCase('rs_paginator', 'libgen_rs_search', rs_base,
+                      get_paginator_last_page, rs_parser.results_strainer),
+        BenchmarkCase('li_non_fiction', 'libgen_li_search', li_base,
+                      lambda soup: len(li_parser.get_non_fiction(soup)), li_parser.results_strainer),
+        BenchmarkCase('li_paginator', 'libgen_li_search', li_base,
+                      get_paginator_last_page_one_line, li_parser.results_strainer),
+        BenchmarkCase('annas_non_fiction', 'annas_archive_search', annas_archive_search['base_url'],
+                      lambda soup: len(annas_parser.get_non_fiction(soup)), annas_parser.results_strainer),
+        BenchmarkCase('rs_mirror_list', 'libgen_rs_md5', rs_base,
+                      lambda soup: len(get_mirror_list_from_soup(soup, f'{rs_base}book/index.php?md5={MD5}'))),
+        BenchmarkCase('rs_fiction_mirror_list', 'libgen_rs_fiction_md5', rs_base,
+                      lambda soup: len(get_mirror_list_from_soup(soup, f'{rs_base}fiction/{MD5}'))),
+        BenchmarkCase('li_mirror_list', 'libgen_li_md5', li_base,
+                      lambda soup: len(get_mirror_list_from_soup(soup, f'{li_base}ads.php?md5={MD5}'))),
+    ]
+
+
+def parse_page(case, html):
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=case.strainer) if case.strainer \
+        else BeautifulSoup(html, HTML_PARSER)
+    return case.parse(soup)
+
+
+def run_case(case, size, repeats):
+    html = load_fixture(case.page, size)
+    run_parameters['libgen_base'] = case.base_url
+    timings = []
+    rows = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = parse_page(case, html)
+        timings.append(time.perf_counter() - start)
+    # memory is measured in a separate run, tracemalloc slows down the parsing
+    tracemalloc.start()
+    try:
+        parse_page(case, html)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    median = statistics.median(timings)
+    return {
+        'median': median,
+        'best': min(timings),
+        'peak_memory': peak_memory,
+        'rows': rows,
+        'rows_per_second': (rows / median) if median else 0,
+    }
+
+
+def run_benchmark(repeats=DEFAULT_REPEATS, threshold=DEFAULT_THRESHOLD, baseline_file=BASELINE_FILENAME,
+                  update_baseline=False):
+    """
+    :return: True if no case is slower than the baseline by more than threshold percent
+    """
+    comparison = BaselineComparison(baseline_file, threshold)
+    original_base = run_parameters['libgen_base']
+    print(f'Parser: {HTML_PARSER}, {repeats} repeats')
+    print(f'{"case":<40}{"median ms":>11}{"best ms":>10}{"peak KB":>10}{"rows":>7}{"rows/s":>11}{"change":>9}')
+    try:
+        for case in build_cases():
+            for size in FIXTURE_SIZES:
+                name = f'{case.name}_{size}'
+                result = run_case(case, size, repeats)
+                change = comparison.compare(name, result['median'])
+                print(f'{name:<40}{1000 * result["median"]:>11.2f}{1000 * result["best"]:>10.2f}'
+                      f'{result["peak_memory"] / 1024:>10.0f}{result["rows"]:>7}'
+                      f'{result["rows_per_second"]:>11.0f}{change:>9}')
+    finally:
+        run_parameters['libgen_base'] = original_base
+    return comparison.finish(update_baseline)
+
+
+def main():
+    return benchmark_main('Parser benchmark', run_benchmark, BASELINE_FILENAME)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,130 +9,40 @@
 
     The process of downloading is done sequentially:
      - get_book_selenium (Connections) navigates to the download page and clicks on the download link
-     - add_selenium_download starts the waiting thread
+     - add_selenium_download gets a future from the DownloadWatcher of the download folder and starts
+       the waiting thread, that moves the file to its destination when the future is resolved and checks
+       its MD5 (a wrong file is quarantined and the book stays pending)
 
     To start a download we need that the driver clicks on the download link
 
-    There are two mutexes:
-     - bundle_dict_access_mutex protects the bundle data from concurrent write operations
-     - pool_running_mutex protects the webdriver to be closed before all the downloads have ended
-
 """
-import os
 import sys
-import time
 from multiprocessing.pool import ThreadPool
-from threading import Lock, Semaphore
-from time import sleep
+from threading import Semaphore, Lock
 
+from ContentIndex import verify_file, get_content_index
+from DownloadWatcher import get_download_watcher, stop_all_watchers
 from utils import move_file_download_folder
 
-wait_for_download_files = set()
 # limit the amount of simultaneous downloads
 MAX_SIMULTANEOUS_DOWNLOADS = 2
+# the DownloadWatcher fails a stalled download, this is the limit if the watcher itself doesn't answer
+DOWNLOAD_RESULT_TIMEOUT = 4 * 3600
 
 
-thread_id = 0
-
-
-def get_thread_sequential_id():
-    global thread_id
-    with LibgenDownloadPool.thread_id_mutex:
-        thread_id += 1
-        return thread_id
-
-
-def wait_and_retry(retries):
-    sleep(3)
-    if retries == 0:
-        raise TimeoutError('Max number of retries downloading - Download not started')
-    return retries - 1
-
-
-def check_for_new_file(folder):
-    time.sleep(3)
-    with LibgenDownloadPool.pending_files_mutex:
-        retries = 10
-        with LibgenDownloadPool.download_folder_mutex:
-            while (len(os.listdir(folder)) == len(wait_for_download_files)) and (retries >= 0):
-                retries = wait_and_retry(retries)
-            retries = 10
-            while retries > 0:
-                # the download starts with a mangled filename with tmp extension before renaming to final name
-                # opdownload is only used in files bigger than some threshold, small files are downloaded with
-                # their own name
-                non_pending_files = [x for x in os.listdir(folder) if x not in wait_for_download_files]
-                print('Files in download folder not in list: ' + '\n'.join(non_pending_files))
-                print('Files in pending list: ' + '\n'.join(wait_for_download_files))
-                if not non_pending_files:
-                    wait_and_retry(retries)
-                else:
-                    for pending_file in non_pending_files:
-                        # if the file doesn't end with opdownload it might be a just finished download
-                        if pending_file.endswith('.opdownload') or (
-                                (not pending_file.endswith('.opdownload')) and (
-                                not (pending_file + '.opdownload') in wait_for_download_files)):
-                            wait_for_download_files.add(pending_file)
-                            print(f'Waiting for file: {pending_file}')
-                            return pending_file
-                retries -= 1
-    return None
-
-
-def remove_file_from_waiting_list_and_move(file_downloading, file_downloading_base, folder, path):
-    with LibgenDownloadPool.pending_files_mutex:
-        wait_for_download_files.remove(file_downloading)
-        move_file_download_folder(folder, path, file_downloading_base)
-
-
-def wait_for_file_download_complete(folder, path):
-    wait_thread_id = get_thread_sequential_id()
-    print(f'wait_for_file_download_complete - Starting thread {wait_thread_id}')
-    download_complete = False
-    last_size = -1
-    file_exists_retries = 10
-    size_change_retries = 200
-    file_downloading = check_for_new_file(folder)
-    print(f'wait_for_file_download_complete - {wait_thread_id} Wait for {file_downloading}')
-    if not file_downloading:
-        return False
-    # remove the .opdownload to get the final filename
-    file_downloading_base, file_downloading_extension = os.path.splitext(file_downloading)
-    if file_downloading_extension != '.opdownload':
-        # not temporary file (?)
-        file_downloading_base = file_downloading
-    current_size = -1
-    while not download_complete:
-        print(f'wait_for_file_download_complete - {wait_thread_id} loop {size_change_retries} - {file_exists_retries}')
-        time.sleep(3)
-        if os.path.isfile(os.path.join(folder, file_downloading)):
-            current_size = os.path.getsize(os.path.join(folder, file_downloading))
-        else:
-            file_exists_retries -= 1
-        is_file = os.path.isfile(os.path.join(folder, file_downloading_base))
-        size_not_changed = last_size == current_size
-        download_complete = is_file and size_not_changed
-        if last_size == current_size:
-            size_change_retries -= 1
-        else:
-            size_change_retries = 200
-        last_size = current_size
-        if (not download_complete) and ((size_change_retries < 0) or (file_exists_retries < 0)):
-            break
-    if (not download_complete) and ((size_change_retries < 0) or (file_exists_retries < 0)):
-        raise TimeoutError(f'Max number of retries downloading {file_downloading_base}')
-    remove_file_from_waiting_list_and_move(file_downloading, file_downloading_base, folder, path)
-    print(f'wait_for_file_download_complete - {wait_thread_id} file moved {file_downloading} -> {folder}')
-    return True
-
-
-def thread_file_download(download_folder, path, bundle_dict, bundle_item, md5):
+def thread_file_download(download_folder, path, bundle_dict, bundle_item, md5, download_future):
     try:
-        if wait_for_file_download_complete(download_folder, path):
+        # the future is resolved by the DownloadWatcher when the browser renames the file to its final name
+        downloaded_file = download_future.result(timeout=DOWNLOAD_RESULT_TIMEOUT)
+        book_file = move_file_download_folder(download_folder, path, downloaded_file)
+        print(f'File moved {downloaded_file} -> {path}')
+        # the browser gives no way to hash the file while it's downloaded
+        if verify_file(book_file, md5):
             bundle_dict.set_book_downloaded(bundle_item, md5)
+            content_index = get_content_index()
+            if content_index:
+                content_index.add(md5, book_file)
             print(f'Download finished {bundle_item} - {md5}')
-        else:
-            print(f'Unable to download {bundle_item} - {md5}')
     except Exception as err:
         print(f'Error downloading {bundle_item} - {md5} - {err}', file=sys.stderr)
     print(f'Releasing semaphore {LibgenDownloadPool.max_download_limit}')
@@ -147,41 +57,48 @@ class LibgenDownloadPool:
         book found.
     """
 
-    thread_id_mutex = Lock()
-    download_folder_mutex = Lock()
-    pending_files_mutex = Lock()
     max_download_limit = Semaphore(MAX_SIMULTANEOUS_DOWNLOADS)
 
     def __init__(self):
-        self.__pool = ThreadPool(processes=4)
-        self.__bundle_dict = None
+        # the threads are started with the first download
+        self.__pool = None
+        self.__pool_mutex = Lock()
         self.__pending_results = {}
 
     def __del__(self):
+        if not self.__pool:
+            return
         print('close pool')
         # wait for threads to end
         self.__pool.close()
         self.__pool.join()
+        stop_all_watchers()
         print('pool closed')
 
     @property
-    def bundle_dict(self):
-        return self.__bundle_dict
-
-    @bundle_dict.setter
-    def bundle_dict(self, bundle_dict):
-        self.__bundle_dict = bundle_dict
-
-    def add_selenium_download(self, bundle_item, md5, download_folder, path):
-        async_res = self.__pool.apply_async(thread_file_download,
-                                            args=(download_folder, path, self.__bundle_dict, bundle_item, md5))
-        if bundle_item not in self.__pending_results:
-            self.__pending_results[bundle_item] = {}
-        self.__pending_results[bundle_item][md5] = async_res
+    def thread_pool(self):
+        with self.__pool_mutex:
+            if not self.__pool:
+                self.__pool = ThreadPool(processes=4)
+            return self.__pool
+
+    def add_selenium_download(self, bundle_item, md5, download_folder, path, bundle_dict):
+        """
+            The pool is shared by the bundles processed at the same time, bundle_dict is the one the book
+            belongs to
+        """
+        download_future = get_download_watcher(download_folder).expect_download()
+        async_res = self.thread_pool.apply_async(thread_file_download,
+                                                 args=(download_folder, path, bundle_dict, bundle_item, md5,
+                                                       download_future))
+        pending_key = (bundle_dict.get('machine_name', ''), bundle_item)
+        if pending_key not in self.__pending_results:
+            self.__pending_results[pending_key] = {}
+        self.__pending_results[pending_key][md5] = async_res
 
     def wait_for_all_threads(self):
         print('wait_for_all_threads')
-        for bundle_item, threads_waiting in self.__pending_results.items():
-            for md5_wait in threads_waiting:
+        for pending_key, threads_waiting in list(self.__pending_results.items()):
+            for md5_wait in list(threads_waiting):
                 print(f'waiting for {md5_wait}')
-                self.__pending_results[bundle_item][md5_wait].wait()
+                threads_waiting[md5_wait].wait()
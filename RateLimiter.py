@@ -0,0 +1,168 @@
+"""
+    Per-host rate limiter shared by all the fetches in Connections
+
+    Each host has a token bucket: run_parameters['rate_limits'][host] (or the 'default' entry) sets the
+    requests per second, the burst allowed after a quiet period and the limits of the adaptive rate:
+     - a 429 or 503 answer halves the rate (never below min_rate, and only once for the answers received
+       in the same request interval), and a Retry-After header pauses the host until the time it asks for
+     - every RATE_INCREASE_AFTER successful requests in a row the rate grows RATE_INCREASE_STEP requests
+       per second, up to max_rate
+
+    The requests are never dropped: each call to acquire reserves the next free slot of the host (the
+    reservations are served in order, whatever the thread) and waits for it
+
+"""
+import time
+from threading import Lock
+
+from utils import run_parameters
+
+THROTTLE_STATUS = (429, 503)
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_STEP = 0.25
+RATE_INCREASE_AFTER = 10
+DEFAULT_RATE_LIMIT = {'rate': 2.0, 'burst': 4, 'min_rate': 0.1, 'max_rate': 8.0}
+
+
+def parse_retry_after(retry_after):
+    """
+    :return: the seconds to wait, Retry-After is a number of seconds or an HTTP date
+    """
+    if not retry_after:
+        return 0
+    import email.utils
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return int(retry_after)
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return 0
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+class HostRateLimiter:
+    """
+        Token bucket of one host, implemented with the time of the next free slot
+
+        The bucket is full when the next slot is burst intervals in the past
+    """
+
+    def __init__(self, host, rate, burst, min_rate, max_rate):
+        self.__host = host
+        self.__rate = rate
+        self.__burst = max(1, burst)
+        self.__min_rate = min_rate
+        self.__max_rate = max(rate, max_rate)
+        self.__mutex = Lock()
+        self.__next_slot = time.monotonic()
+        self.__paused_until = 0
+        self.__last_decrease = 0
+        self.__successes = 0
+        self.__stats = {'requests': 0, 'throttled': 0, 'wait_time': 0.0}
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    @property
+    def stats(self):
+        return dict(self.__stats, rate=self.__rate)
+
+    def reserve(self):
+        """
+        :return: the seconds to wait until the reserved slot
+        """
+        with self.__mutex:
+            now = time.monotonic()
+            interval = 1 / self.__rate
+            slot = max(self.__next_slot, now - (self.__burst - 1) * interval, self.__paused_until)
+            self.__next_slot = slot + interval
+            self.__stats['requests'] += 1
+            return max(0.0, slot - now)
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            wait = self.reserve()
+            if wait > 0:
+                time.sleep(wait)
+                waited += wait
+            with self.__mutex:
+                # the host may have been paused while this thread was waiting
+                paused = self.__paused_until > time.monotonic()
+                if not paused:
+                    self.__stats['wait_time'] += waited
+                    return
+                self.__stats['requests'] -= 1
+
+    def response_received(self, status_code, retry_after=None):
+        with self.__mutex:
+            if status_code in THROTTLE_STATUS:
+                self.__stats['throttled'] += 1
+                self.__successes = 0
+                now = time.monotonic()
+                # the requests sent at the same time fail together, that's only one reason to slow down
+                if now - self.__last_decrease > 1 / self.__rate:
+                    self.__rate = max(self.__min_rate, self.__rate * RATE_DECREASE_FACTOR)
+                    self.__last_decrease = now
+                pause = parse_retry_after(retry_after)
+                if pause:
+                    self.__paused_until = max(self.__paused_until, now + pause)
+                # the slots already given belong to the old rate, the queue starts again from now
+                self.__next_slot = max(now, self.__paused_until) + 1 / self.__rate
+                print(f'{self.__host} is throttling (HTTP {status_code}), {self.__rate:.2f} requests/s'
+                      f'{f", paused {pause:.0f}s" if pause else ""}')
+            elif status_code < 500:
+                self.__successes += 1
+                if self.__successes >= RATE_INCREASE_AFTER:
+                    self.__successes = 0
+                    self.__rate = min(self.__max_rate, self.__rate + RATE_INCREASE_STEP)
+
+
+class RateLimiter:
+    """
+        The HostRateLimiter of each host, created on first use
+    """
+
+    def __init__(self, rate_limits=None):
+        self.__rate_limits = rate_limits if rate_limits else {}
+        self.__hosts = {}
+        self.__mutex = Lock()
+
+    def get_host(self, host):
+        with self.__mutex:
+            if host not in self.__hosts:
+                host_limits = dict(DEFAULT_RATE_LIMIT)
+                host_limits.update(self.__rate_limits.get('default', {}))
+                host_limits.update(self.__rate_limits.get(host, {}))
+                self.__hosts[host] = HostRateLimiter(host, **host_limits)
+            return self.__hosts[host]
+
+    def acquire(self, host):
+        self.get_host(host).acquire()
+
+    def response_received(self, host, status_code, retry_after=None):
+        self.get_host(host).response_received(status_code, retry_after)
+
+    def stats_to_str(self):
+        with self.__mutex:
+            hosts = dict(self.__hosts)
+        lines = []
+        for host, host_limiter in sorted(hosts.items()):
+            stats = host_limiter.stats
+            lines.append(f'Rate limiter {host}: {stats["requests"]} requests, {stats["throttled"]} throttled, '
+                         f'{stats["wait_time"]:.1f}s waiting, {stats["rate"]:.2f} requests/s')
+        return '\n'.join(lines)
+
+
+rate_limiter_mutex = Lock()
+rate_limiter = None
+
+
+def get_rate_limiter():
+    global rate_limiter
+    with rate_limiter_mutex:
+        if not rate_limiter:
+            rate_limiter = RateLimiter(run_parameters.get('rate_limits', {}))
+        return rate_limiter
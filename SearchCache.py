@@ -0,0 +1,145 @@
+"""
+    Persistent cache for the LibGen search results
+
+    Each result page is stored once parsed, using (search mirror, query, page) as key, in a SQLite
+    file so the cache survives between runs.
+
+     - Entries expire after run_parameters['search_cache_ttl'] seconds
+     - Empty results are also cached (negative caching), but with a shorter TTL,
+       run_parameters['search_cache_negative_ttl']
+     - When there are more than run_parameters['search_cache_max_entries'] entries the least
+       recently used ones are deleted. The entries are counted every EVICTION_INTERVAL puts (or a tenth
+       of the maximum, if it's smaller), so the cache can be over the maximum by that many entries
+
+    Failed page loads are never cached
+
+"""
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+from utils import run_parameters
+
+SEARCH_CACHE_FILENAME = 'search_cache.sqlite'
+EVICTION_INTERVAL = 100
+
+
+class SearchCache:
+    """
+        Key-value store over a SQLite table
+
+        The connection is shared between threads and protected by a mutex
+    """
+
+    def __init__(self, cache_file, ttl, negative_ttl, max_entries):
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__max_entries = max_entries
+        self.__eviction_interval = max(1, min(EVICTION_INTERVAL, max_entries // 10))
+        self.__puts_since_eviction = 0
+        self.__mutex = Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'expired': 0, 'negative_hits': 0, 'evictions': 0}
+        self.__connection = sqlite3.connect(cache_file, check_same_thread=False)
+        with self.__connection:
+            self.__connection.execute('CREATE TABLE IF NOT EXISTS search_results ('
+                                      'mirror TEXT, query TEXT, page INTEGER, results TEXT, empty INTEGER, '
+                                      'created REAL, last_access REAL, '
+                                      'PRIMARY KEY (mirror, query, page))')
+            self.__connection.execute('CREATE INDEX IF NOT EXISTS search_results_last_access '
+                                      'ON search_results (last_access)')
+
+    def close(self):
+        with self.__mutex:
+            self.__connection.close()
+
+    @property
+    def stats(self):
+        return dict(self.__stats)
+
+    def get(self, mirror, query, page):
+        """
+        :return: the cached value or None if it's not in the cache or has expired
+        """
+        now = time.time()
+        with self.__mutex:
+            row = self.__connection.execute('SELECT results, empty, created FROM search_results '
+                                            'WHERE mirror=? AND query=? AND page=?',
+                                            (mirror, query, page)).fetchone()
+            if not row:
+                self.__stats['misses'] += 1
+                return None
+            results, empty, created = row
+            ttl = self.__negative_ttl if empty else self.__ttl
+            if now - created > ttl:
+                self.__stats['expired'] += 1
+                self.__stats['misses'] += 1
+                with self.__connection:
+                    self.__connection.execute('DELETE FROM search_results WHERE mirror=? AND query=? AND page=?',
+                                              (mirror, query, page))
+                return None
+            with self.__connection:
+                self.__connection.execute('UPDATE search_results SET last_access=? '
+                                          'WHERE mirror=? AND query=? AND page=?',
+                                          (now, mirror, query, page))
+            self.__stats['hits'] += 1
+            if empty:
+                self.__stats['negative_hits'] += 1
+        return json.loads(results)
+
+    def put(self, mirror, query, page, value, empty=False):
+        now = time.time()
+        with self.__mutex:
+            with self.__connection:
+                self.__connection.execute('INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                          (mirror, query, page, json.dumps(value), int(empty), now, now))
+                self.__puts_since_eviction += 1
+                if self.__puts_since_eviction >= self.__eviction_interval:
+                    self._evict()
+
+    def _evict(self):
+        """
+            Deletes the least recently used entries above max_entries. Must be called with the mutex held
+        """
+        self.__puts_since_eviction = 0
+        num_entries = self.__connection.execute('SELECT COUNT(*) FROM search_results').fetchone()[0]
+        extra_entries = num_entries - self.__max_entries
+        if extra_entries > 0:
+            self.__connection.execute('DELETE FROM search_results WHERE rowid IN ('
+                                      'SELECT rowid FROM search_results ORDER BY last_access LIMIT ?)',
+                                      (extra_entries,))
+            self.__stats['evictions'] += extra_entries
+
+    def stats_to_str(self):
+        stats = self.stats
+        total = stats['hits'] + stats['misses']
+        hit_rate = (100 * stats['hits'] / total) if total else 0
+        return (f'Search cache: {stats["hits"]} hits ({stats["negative_hits"]} empty results), '
+                f'{stats["misses"]} misses ({stats["expired"]} expired), {stats["evictions"]} evictions, '
+                f'hit rate {hit_rate:.1f}%')
+
+
+search_cache_mutex = Lock()
+search_cache = None
+
+
+def get_search_cache():
+    """
+        The cache is created on first use, once parse_arguments has set the output dir
+
+    :return: the SearchCache or None if the cache is disabled
+    """
+    global search_cache
+    if not run_parameters.get('search_cache', True):
+        return None
+    with search_cache_mutex:
+        if not search_cache:
+            cache_file = run_parameters.get('search_cache_file', '')
+            if not cache_file:
+                cache_file = os.path.join(run_parameters['output_dir'], SEARCH_CACHE_FILENAME)
+            search_cache = SearchCache(cache_file,
+                                       ttl=run_parameters.get('search_cache_ttl', 30 * 24 * 3600),
+                                       negative_ttl=run_parameters.get('search_cache_negative_ttl', 24 * 3600),
+                                       max_entries=run_parameters.get('search_cache_max_entries', 20000))
+        return search_cache
@@ -2,25 +2,50 @@
 
     This is used to search without using a Humble Bundle json
 
+    Batch mode: a reading list with thousands of title/author pairs is read as a stream from a CSV file
+    (columns title and author, with or without header) or a JSONL file (one {"title": ..., "author": ...}
+    per line) and split in shards of run_parameters['batch_shard_size'] items. Each shard is a mock
+    bundle with its own backup (input_name_shard_00000.json...), searched with
+    run_parameters['search_workers'] threads and downloaded like any other bundle. The items of a shard
+    with the same title share one search, and its results are filtered for all of them in one pass
+    (BatchMatcher.filter_many)
+
+    The progress is saved in a checkpoint (input_name.checkpoint.json, in output_dir): an interrupted
+    run skips the shards already finished and, inside the shard it was processing, the backup keeps the
+    items already searched. The shard size of the first run is kept in the checkpoint, so the shards of
+    the next runs are the same
+
+        python SearchNoBundle.py -i reading_list.csv|jsonl [-o output_dir] [-n shard_size] [-w search_workers]
+                                 [-d download_workers]
+
 """
+import csv
 import datetime
-import json
+import getopt
 import os.path
+import sys
+import time
 
 from slugify import slugify
 
-from BundleInfo import BundleInfo
-from FilterSearchResults import filter_search_results
-from HumbleJson import iterate_tiers, search_books_to_bundle_item, \
-    download_books_from_bundle_item
+from BundleInfo import BundleInfo, backup_exists
+from BundleScheduler import with_current_output
+from FilterSearchResults import BatchMatcher, filter_search_results
+from HumbleJson import search_and_download_bundle
+from JsonCodec import loads, read_json_file, write_json_file, json_file_exists
 from LibGen import search_libgen_by_title
 from resources import humble_resources
-from utils import run_parameters
+from SingleFlight import single_flight_stats_to_str
+from utils import run_parameters, get_backup_folder
 
+CHECKPOINT_EXTENSION = '.checkpoint.json'
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
 
-def create_bundle_dict_mockup():
-    time_str = datetime.datetime.now().strftime('%Y%m%d_%H%M')
-    bundle_name = f'Not a bundle - {time_str}'
+
+def create_bundle_dict_mockup(bundle_name=None):
+    if not bundle_name:
+        time_str = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+        bundle_name = f'Not a bundle - {time_str}'
     return {
         'name': bundle_name,
         'machine_name': slugify(bundle_name),
@@ -35,10 +60,16 @@ def create_bundle_dict_mockup():
     }
 
 
-def search_without_bundle(search_items):
-    bundle_mockup = create_bundle_dict_mockup()
+def build_search_bundle(search_items, bundle_name=None):
+    """
+        Writes the mock bundle of search_items to its backup and reads it back as a BundleInfo
+    """
+    bundle_mockup = create_bundle_dict_mockup(bundle_name)
     for search in search_items:
         item_machine_name = slugify(f'{search["title"]}_{search["author"]}')
+        if item_machine_name in bundle_mockup['tier_item_data']:
+            # the same book twice in the list
+            continue
         bundle_mockup['tier_display_data']['all']['tier_item_machine_names'].append(item_machine_name)
         bundle_mockup['tier_item_data'][item_machine_name] = {
             'name': search["title"],
@@ -50,15 +81,17 @@ def search_without_bundle(search_items):
         }
     # save to file so it can be reprocessed another time
     backup_file = os.path.join(run_parameters['output_dir'], f'{bundle_mockup["machine_name"]}.json')
+    backup_file = write_json_file(backup_file, bundle_mockup, compression=run_parameters.get('backup_compression', ''))
     print(f'search results saved to {backup_file}')
-    with open(backup_file, 'w', encoding='utf-8') as file:
-        json.dump(bundle_mockup, file)
     # we recover the file into a BundleInfo object
-    bundle_object = BundleInfo.from_file(backup_file)
-    iterate_tiers(bundle_object, functor=search_books_to_bundle_item)
-    iterate_tiers(bundle_object, functor=download_books_from_bundle_item)
+    return BundleInfo.from_file(backup_file)
+
+
+def search_without_bundle(search_items):
+    bundle_object = build_search_bundle(search_items)
+    search_and_download_bundle(bundle_object)
     bundle_object.save_to_file()
-    humble_resources.pool.wait_for_all_threads()
+    humble_resources.wait_for_all_threads()
 
 
 def search_in_libgen(title, author):
@@ -72,10 +105,229 @@ def search_in_libgen(title, author):
     return item
 
 
+def read_csv_items(input_file):
+    with open(input_file, 'r', encoding='utf-8', newline='') as csv_file:
+        title_column, author_column = 0, 1
+        for line_number, row in enumerate(csv.reader(csv_file), start=1):
+            cells = [cell.strip() for cell in row]
+            if (line_number == 1) and ('title' in [cell.lower() for cell in cells]):
+                header = [cell.lower() for cell in cells]
+                title_column = header.index('title')
+                author_column = header.index('author') if 'author' in header else -1
+                continue
+            if (not cells) or (len(cells) <= title_column) or (not cells[title_column]):
+                continue
+            author = cells[author_column] if 0 <= author_column < len(cells) else ''
+            yield {'title': cells[title_column], 'author': author}
+
+
+def read_jsonl_items(input_file):
+    with open(input_file, 'rb') as jsonl_file:
+        for line_number, line in enumerate(jsonl_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                search = loads(line)
+            except ValueError as err:
+                print(f'{input_file}:{line_number} is not valid JSON - {err}', file=sys.stderr)
+                continue
+            title = search.get('title', '') or search.get('name', '') if isinstance(search, dict) else ''
+            if not title:
+                print(f'{input_file}:{line_number} has no title', file=sys.stderr)
+                continue
+            yield {'title': title, 'author': search.get('author', '') or ''}
+
+
+def read_search_items(input_file):
+    """
+        Reads the file line by line, the whole list is never in memory
+    """
+    if input_file.lower().endswith(JSONL_EXTENSIONS):
+        return read_jsonl_items(input_file)
+    return read_csv_items(input_file)
+
+
+def shard_search_items(search_items, shard_size):
+    shard = []
+    for search in search_items:
+        shard.append(search)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+class BatchCheckpoint:
+    """
+        The shards of an input file already searched and downloaded
+    """
+
+    def __init__(self, checkpoint_file, input_file, shard_size):
+        self.__checkpoint_file = checkpoint_file
+        input_stat = os.stat(input_file)
+        self.__state = {
+            'input_file': os.path.abspath(input_file),
+            'input_size': input_stat.st_size,
+            'input_mtime': input_stat.st_mtime,
+            'shard_size': shard_size,
+            'finished_shards': [],
+            'items_done': 0,
+        }
+        if json_file_exists(checkpoint_file):
+            saved_state = read_json_file(checkpoint_file)
+            if (saved_state['input_size'] != input_stat.st_size) or (saved_state['input_mtime'] != input_stat.st_mtime):
+                print(f'{input_file} has changed since the last run, the shards already finished are kept',
+                      file=sys.stderr)
+            if saved_state['shard_size'] != shard_size:
+                print(f'Resuming with the shard size of the last run: {saved_state["shard_size"]}')
+            self.__state.update(finished_shards=saved_state['finished_shards'],
+                                items_done=saved_state['items_done'], shard_size=saved_state['shard_size'])
+        self.__finished_shards = set(self.__state['finished_shards'])
+
+    @property
+    def shard_size(self):
+        return self.__state['shard_size']
+
+    @property
+    def items_done(self):
+        return self.__state['items_done']
+
+    def is_finished(self, shard_index):
+        return shard_index in self.__finished_shards
+
+    def shard_finished(self, shard_index, num_items):
+        self.__finished_shards.add(shard_index)
+        self.__state['finished_shards'] = sorted(self.__finished_shards)
+        self.__state['items_done'] += num_items
+        write_json_file(self.__checkpoint_file, self.__state, durable=True)
+
+
+def search_title(bundle_object, title, items):
+    """
+        One search for all the items with this title
+    """
+    try:
+        books_found = search_libgen_by_title(title)
+        for key, filtered_books in BatchMatcher(books_found).filter_many(items).items():
+            bundle_object.set_books_found(key, dict(filtered_books))
+            if not filtered_books:
+                bundle_object.set_all_books_downloaded(key)
+    except Exception as err:
+        print(f'Error searching book: {title} - {err}', file=sys.stderr)
+
+
+def search_shard(bundle_object):
+    """
+        Searches the items of the shard grouped by title. search_and_download_bundle skips the items
+        with books found and only downloads them
+    """
+    items_by_title = {}
+    for key, item in bundle_object['tier_item_data'].items():
+        if item.get('skip', False) or item.get('downloaded', False) or item.get('books_found', {}):
+            continue
+        items_by_title.setdefault(item['name'], {})[key] = item
+    search_workers = max(1, run_parameters.get('search_workers', 1))
+    if (search_workers == 1) or (len(items_by_title) <= 1):
+        for title, items in items_by_title.items():
+            search_title(bundle_object, title, items)
+        return
+    from multiprocessing.pool import ThreadPool
+    with ThreadPool(processes=search_workers) as search_pool:
+        search_pool.starmap(with_current_output(search_title),
+                            [(bundle_object, title, items) for title, items in items_by_title.items()])
+
+
+def get_batch_name(input_file):
+    return slugify(os.path.splitext(os.path.basename(input_file))[0])
+
+
+def get_shard_bundle(batch_name, shard_index, shard):
+    """
+        The BundleInfo of the shard, from its backup if a previous run had started it
+    """
+    bundle_name = f'{batch_name}_shard_{shard_index:05d}'
+    backup_file = os.path.join(run_parameters['output_dir'], f'{slugify(bundle_name)}.json')
+    if backup_exists(backup_file):
+        print(f'Resuming {backup_file}')
+        return BundleInfo.from_file(backup_file)
+    return build_search_bundle(shard, bundle_name=bundle_name)
+
+
+def search_batch(input_file, shard_size=None):
+    """
+        Searches and downloads every title of input_file, shard by shard
+    """
+    batch_folder = get_backup_folder()
+    os.makedirs(batch_folder, exist_ok=True)
+    batch_name = get_batch_name(input_file)
+    checkpoint = BatchCheckpoint(os.path.join(batch_folder, f'{batch_name}{CHECKPOINT_EXTENSION}'),
+                                 input_file, shard_size or run_parameters.get('batch_shard_size', 100))
+    if checkpoint.items_done:
+        print(f'{checkpoint.items_done} items of {input_file} already done')
+    start = time.time()
+    items_done = 0
+    for shard_index, shard in enumerate(shard_search_items(read_search_items(input_file), checkpoint.shard_size)):
+        if checkpoint.is_finished(shard_index):
+            continue
+        first_item = shard_index * checkpoint.shard_size + 1
+        print(f'\n\nShard {shard_index}: items {first_item}-{first_item + len(shard) - 1} of {input_file}')
+        bundle_object = get_shard_bundle(batch_name, shard_index, shard)
+        search_shard(bundle_object)
+        search_and_download_bundle(bundle_object)
+        # the downloads of the browser go on in the pool, the shard isn't finished until they end
+        humble_resources.wait_for_all_threads()
+        bundle_object.save_to_file()
+        checkpoint.shard_finished(shard_index, len(shard))
+        items_done += len(shard)
+        print(f'{checkpoint.items_done} items done, {60 * items_done / (time.time() - start):.1f} items/min')
+    humble_resources.wait_for_all_threads()
+    single_flight_stats = single_flight_stats_to_str()
+    if single_flight_stats:
+        print(single_flight_stats)
+
+
+def display_help():
+    print('Search without bundle\n'
+          '\tParameters: -h | -i "input file" | -o "output_dir" | -n "shard size" | -w "search workers" | '
+          '-d "download workers"\n'
+          '-i CSV (title, author) or JSONL ({"title": ..., "author": ...}) file with the books to search\n'
+          '-o Output dir for the backups of the shards, their checkpoint and the books\n'
+          '-n Items of each shard, run_parameters["batch_shard_size"]\n'
+          '-w run_parameters["search_workers"]\n'
+          '-d run_parameters["download_workers"]')
+
+
+def main():
+    input_file, shard_size = '', None
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], 'hi:o:n:w:d:')
+        for current_argument, current_value in arguments:
+            if current_argument == '-h':
+                display_help()
+                return
+            elif current_argument == '-i':
+                input_file = current_value
+            elif current_argument == '-o':
+                run_parameters['output_dir'] = current_value
+            elif current_argument == '-n':
+                shard_size = max(1, int(current_value))
+            elif current_argument == '-w':
+                run_parameters['search_workers'] = max(1, int(current_value))
+            elif current_argument == '-d':
+                run_parameters['download_workers'] = max(1, int(current_value))
+    except getopt.error as err:
+        print(str(err))
+        return
+    except ValueError:
+        print(f'{current_argument} must be a number: {current_value}')
+        return
+    if not input_file:
+        display_help()
+        return
+    search_batch(input_file, shard_size=shard_size)
+
+
 # Lanzamos la función principal
 if __name__ == '__main__':
-    run_parameters['output_dir'] = r'F:\bkp\libros\bundles'
-    list_of_searches = [
-        {'title': 'Castle of Days', 'author': 'Wolfe'}
-    ]
-    search_without_bundle(search_items=list_of_searches)
+    main()
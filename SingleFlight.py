@@ -0,0 +1,126 @@
+"""
+    Single-flight calls: concurrent calls with the same key share one execution
+
+    When several bundles, or the items of a batch of SearchNoBundle, search the same title at the same
+    time, or look for the mirrors of the same book, only the first call goes to the mirror. The calls
+    that arrive while it's running wait for it and get a copy of its result (or its exception). A call
+    made after it has finished runs again: the results are stored by the SearchCache, not here.
+
+    There is a group for each kind of call:
+     - 'search': search_libgen_by_title, the key is (search mirror, title)
+     - 'mirrors': get_mirror_list, the key is the URL of the book in LibGen
+
+    Each group counts the calls, the executions and the calls that shared another one (the requests
+    saved). run_parameters['single_flight'] = False runs every call
+
+"""
+import copy
+from threading import Event, Lock
+
+from utils import run_parameters
+
+
+class InFlightCall:
+    """
+        The execution of a call, the callers with the same key wait for done
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+
+    def __init__(self, name):
+        self.__name = name
+        self.__mutex = Lock()
+        self.__calls = {}
+        self.__stats = {'calls': 0, 'executions': 0, 'shared': 0, 'errors': 0, 'max_waiters': 0}
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def stats(self):
+        with self.__mutex:
+            return dict(self.__stats)
+
+    def do(self, key, function, *args, **kwargs):
+        """
+            Runs function(*args, **kwargs), unless a call with the same key is running: then waits for it
+        :return: the result of the function, a copy of it for the callers that shared the execution
+        :raise: the exception of the function, to every caller
+        """
+        with self.__mutex:
+            self.__stats['calls'] += 1
+            call = self.__calls.get(key, None)
+            in_flight = call is not None
+            if in_flight:
+                call.waiters += 1
+                self.__stats['shared'] += 1
+                self.__stats['max_waiters'] = max(self.__stats['max_waiters'], call.waiters)
+            else:
+                call = self.__calls[key] = InFlightCall()
+                self.__stats['executions'] += 1
+        if in_flight:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            # call.result is a copy nobody modifies, each waiter gets its own
+            return copy.deepcopy(call.result)
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        except Exception as err:
+            call.error = err
+            with self.__mutex:
+                self.__stats['errors'] += 1
+            raise
+        finally:
+            with self.__mutex:
+                del self.__calls[key]
+                waiters = call.waiters
+            if waiters and (call.error is None):
+                # copied before this caller gets the result and can modify it
+                call.result = copy.deepcopy(result)
+            call.done.set()
+
+    def stats_to_str(self):
+        stats = self.stats
+        return (f'Single flight {self.__name}: {stats["calls"]} calls, {stats["executions"]} executions, '
+                f'{stats["shared"]} requests saved (up to {stats["max_waiters"]} callers waiting for one), '
+                f'{stats["errors"]} errors')
+
+
+single_flight_mutex = Lock()
+single_flight_groups = {}
+
+
+def get_single_flight(name):
+    """
+    :return: the SingleFlight of the group, None if run_parameters['single_flight'] is False
+    """
+    if not run_parameters.get('single_flight', True):
+        return None
+    with single_flight_mutex:
+        if name not in single_flight_groups:
+            single_flight_groups[name] = SingleFlight(name)
+        return single_flight_groups[name]
+
+
+def single_flight(name, key, function, *args, **kwargs):
+    group = get_single_flight(name)
+    if not group:
+        return function(*args, **kwargs)
+    return group.do(key, function, *args, **kwargs)
+
+
+def single_flight_stats_to_str():
+    with single_flight_mutex:
+        groups = list(single_flight_groups.values())
+    return '\n'.join(group.stats_to_str() for group in groups)
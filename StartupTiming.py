@@ -0,0 +1,150 @@
+"""
+    Startup time of HumbleJson
+
+    Each case runs a new interpreter with -X importtime and reports:
+     - the median and best wall time of the whole process
+     - the time spent importing modules (the sum of the self time of every import)
+     - the slowest imports of the case
+     - the heavy modules (HEAVY_MODULES) it has imported: a case that imports any of them, or that
+       exits with an error, fails
+
+    The cases are the runs that don't need the network: importing HumbleJson, the help and parsing a
+    backup file (-f ... -p). None of them should load the browser, the HTTP stack or the HTML parser.
+
+    The medians are compared with a baseline (BenchmarkBaseline)
+
+    Usage: python StartupTiming.py [-r repeats] [-t threshold] [-b baseline_file] [-s] [-n slowest]
+
+"""
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from BenchmarkBaseline import BaselineComparison, BenchmarkOption, benchmark_main, DEFAULT_REPEATS
+
+DEFAULT_THRESHOLD = 30
+DEFAULT_SLOWEST = 5
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILENAME = os.path.join(REPO_FOLDER, 'startup_baseline.json')
+HEAVY_MODULES = ('selenium', 'waybackpy', 'requests', 'bs4', 'tqdm', 'slugify', 'multiprocessing.pool')
+
+BACKUP_FIXTURE = {
+    'name': 'Startup timing bundle',
+    'machine_name': 'startuptiming_bookbundle',
+    'tier_item_data': {
+        f'startup_item_{idx}': {
+            'name': f'Startup Book {idx}', 'author': 'Author', 'author_url': '', 'publisher': '',
+            'publisher_url': '', 'description': ''
+        } for idx in range(20)
+    },
+    'tier_order': ['all'],
+    'tier_display_data': {'all': {'tier_item_machine_names': [f'startup_item_{idx}' for idx in range(20)]}},
+}
+
+
+class StartupCase:
+    """
+        The arguments of the interpreter for one case
+    """
+
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments
+
+
+def build_cases(work_folder):
+    backup_file = os.path.join(work_folder, 'startup-timing-bundle')
+    with open(backup_file, 'w', encoding='utf-8') as backup:
+        json.dump(BACKUP_FIXTURE, backup)
+    humble_json = os.path.join(REPO_FOLDER, 'HumbleJson.py')
+    return [
+        StartupCase('import_humblejson', ['-c', 'import HumbleJson']),
+        StartupCase('cli_help', [humble_json, '-h', '-o', work_folder]),
+        StartupCase('cli_parse_backup', [humble_json, '-f', backup_file, '-p', '-o', work_folder]),
+    ]
+
+
+def parse_importtime(output):
+    """
+    :return: a dictionary module -> (self time, cumulative time) in seconds
+    """
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if (len(fields) != 3) or (not fields[0].strip().isdigit()):
+            # the header of the table
+            continue
+        imports[fields[2].strip()] = (int(fields[0]) / 1e6, int(fields[1]) / 1e6)
+    return imports
+
+
+def run_case(case, repeats):
+    timings = []
+    imports = {}
+    failed = False
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime'] + case.arguments, cwd=REPO_FOLDER,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False)
+        timings.append(time.perf_counter() - start)
+        imports = parse_importtime(process.stderr)
+        failed = failed or (process.returncode != 0)
+    median = statistics.median(timings)
+    heavy_modules = sorted(module for module in imports
+                           if (module.split('.')[0] in HEAVY_MODULES) or (module in HEAVY_MODULES))
+    return {
+        'median': median,
+        'best': min(timings),
+        'import_time': sum(self_time for self_time, _ in imports.values()),
+        'modules': len(imports),
+        'slowest': sorted(imports.items(), key=lambda module: module[1][0], reverse=True),
+        'heavy_modules': heavy_modules,
+        'failed': failed,
+    }
+
+
+def run_timing(repeats=DEFAULT_REPEATS, threshold=DEFAULT_THRESHOLD, baseline_file=BASELINE_FILENAME,
+               update_baseline=False, slowest=DEFAULT_SLOWEST):
+    """
+    :return: True if no case imports a heavy module or is slower than the baseline by more than threshold percent
+    """
+    comparison = BaselineComparison(baseline_file, threshold)
+    work_folder = tempfile.mkdtemp(prefix='humble_startup_')
+    print(f'{sys.executable}, {repeats} repeats')
+    print(f'{"case":<25}{"median ms":>11}{"best ms":>10}{"imports ms":>12}{"modules":>9}{"change":>9}')
+    try:
+        for case in build_cases(work_folder):
+            result = run_case(case, repeats)
+            change = comparison.compare(case.name, result['median'])
+            print(f'{case.name:<25}{1000 * result["median"]:>11.1f}{1000 * result["best"]:>10.1f}'
+                  f'{1000 * result["import_time"]:>12.1f}{result["modules"]:>9}{change:>9}')
+            for module, (self_time, cumulative_time) in result['slowest'][:slowest]:
+                print(f'    {module:<36}{1000 * self_time:>8.1f} ms self{1000 * cumulative_time:>9.1f} ms total')
+            if result['failed']:
+                print(f'    {case.name} exited with an error', file=sys.stderr)
+                comparison.add_failure(case.name)
+            if result['heavy_modules']:
+                print(f'    heavy modules imported: {", ".join(result["heavy_modules"])}', file=sys.stderr)
+                comparison.add_failure(case.name)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return comparison.finish(update_baseline,
+                             problem='failing, slower than the baseline or importing heavy modules')
+
+
+def main():
+    return benchmark_main('Startup timing', run_timing, BASELINE_FILENAME, threshold=DEFAULT_THRESHOLD,
+                          extra_options=[BenchmarkOption('n', 'slowest', 'slowest',
+                                                         'Number of slowest imports listed for each case',
+                                                         default=DEFAULT_SLOWEST, convert=int)])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+    Runs HumbleJson.main against the local stand-in mirrors (MirrorStandIn) and measures its throughput
+
+    Nothing leaves the machine: every page and book is fetched with requests through the stand-in
+    server, the only transport allowed (run_parameters['transports']), and the mirrors use plain http,
+    so the real URLs can be served locally. The search cache is disabled and everything is written to a
+    temporary folder, unless one is given with -o
+
+    The report has:
+     - items per minute: Humble items fully downloaded divided by the wall time
+     - bytes per second of books received
+     - the time spent in each stage of the pipeline (bundle page, search, filter, mirror list and
+       download), added up in all the threads, and its share of the wall time
+
+    Usage: python ThroughputHarness.py [options], python ThroughputHarness.py -h to list them
+
+"""
+import getopt
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from threading import Lock
+
+import HumbleJson
+from BundleInfo import BundleInfo, backup_exists
+from MirrorStandIn import MirrorStandInServer, StandInConfig, HUMBLE_HOST
+from utils import run_parameters, update_run_parameters, get_backup_file, libgen_search_libgen_rs, \
+    libgen_search_libgen_is, libgen_search_libgen_li, libgen_search_libgen_rc
+
+# HumbleJson imports the functions of each stage when it calls them, so they are replaced in their modules
+STAGES = {
+    'bundle page': ('HumbleJson', 'extract_humble_dict_from_page'),
+    'search': ('LibGen', 'search_libgen_by_title'),
+    'filter': ('FilterSearchResults', 'filter_search_results'),
+    'mirror list': ('LibGenDownload', 'get_mirror_list'),
+    'download': ('LibGenDownload', 'get_file_from_url'),
+}
+
+
+class StageTimer:
+    """
+        Replaces the functions of each stage with a wrapper that adds up their time
+    """
+
+    def __init__(self):
+        self.__mutex = Lock()
+        self.times = {stage: 0.0 for stage in STAGES}
+        self.calls = {stage: 0 for stage in STAGES}
+
+    def install(self):
+        for stage, (module_name, function_name) in STAGES.items():
+            module = importlib.import_module(module_name)
+            setattr(module, function_name, self.timed(stage, getattr(module, function_name)))
+
+    def timed(self, stage, function):
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.__mutex:
+                    self.times[stage] += time.perf_counter() - start
+                    self.calls[stage] += 1
+        return timed_function
+
+
+def use_plain_http_mirrors():
+    """
+        The stand-in only speaks http, the mirrors are compared by their base url so all of them change
+    """
+    for search_mirror in (libgen_search_libgen_rs, libgen_search_libgen_is, libgen_search_libgen_li,
+                          libgen_search_libgen_rc):
+        search_mirror['base_url'] = search_mirror['base_url'].replace('https://', 'http://')
+
+
+def count_downloaded_items(bundle_urls):
+    downloaded, total = 0, 0
+    for bundle_url in bundle_urls:
+        backup_file = get_backup_file(bundle_url)
+        if not backup_exists(backup_file):
+            continue
+        items = BundleInfo.from_file(backup_file)['tier_item_data']
+        total += len(items)
+        downloaded += sum(1 for item in items.values() if item.get('books_downloaded', None))
+    return downloaded, total
+
+
+def print_report(stand_in, timer, wall_time, downloaded, total):
+    print('\n\nThroughput harness results')
+    print(f'Wall time: {wall_time:.2f}s')
+    print(f'Items downloaded: {downloaded}/{total}, {60 * downloaded / wall_time:.1f} items/min')
+    print(f'Books received: {stand_in.stats.book_bytes} bytes, {stand_in.stats.book_bytes / wall_time:.0f} bytes/s')
+    print(f'{"stage":<15}{"calls":>8}{"time s":>10}{"of wall":>10}')
+    for stage in STAGES:
+        print(f'{stage:<15}{timer.calls[stage]:>8}{timer.times[stage]:>10.2f}'
+              f'{100 * timer.times[stage] / wall_time:>9.1f}%')
+    print(stand_in.stats.to_str())
+
+
+def run_harness(config, num_bundles=1, mirror='rs', output_dir='', parameters=None):
+    stand_in = MirrorStandInServer(config)
+    stand_in.start()
+    keep_output = bool(output_dir)
+    if not output_dir:
+        output_dir = tempfile.mkdtemp(prefix='humble_harness_')
+    os.makedirs(output_dir, exist_ok=True)
+    use_plain_http_mirrors()
+    update_run_parameters(libgen_search_libgen_li if mirror == 'li' else libgen_search_libgen_rs)
+    bundle_urls = [f'http://{HUMBLE_HOST}/books/standin-bundle-{idx}' for idx in range(num_bundles)]
+    run_parameters.update({
+        'bundles': bundle_urls,
+        'files': [],
+        'output_dir': output_dir,
+        'use_browser': False,
+        'transports': ['proxy'],
+        'http_proxy': stand_in.proxy_url,
+        'search_cache': False,
+        'archive': False,
+        'parse_only': False,
+    })
+    run_parameters.update(parameters or {})
+    timer = StageTimer()
+    timer.install()
+    # main reads the command line, the harness options must not be taken as HumbleJson options
+    harness_argv, sys.argv = sys.argv, sys.argv[:1]
+    start = time.perf_counter()
+    try:
+        HumbleJson.main()
+    finally:
+        sys.argv = harness_argv
+        wall_time = time.perf_counter() - start
+        stand_in.stop()
+    downloaded, total = count_downloaded_items(bundle_urls)
+    print_report(stand_in, timer, wall_time, downloaded, total)
+    if not keep_output:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def display_help():
+    print('Throughput harness\n'
+          '\tParameters: -h | -i "items" | -u "bundles" | -m "rs|li" | -l "latency" | -b "bandwidth" | '
+          '-e "error rate" | -t "throttle" | -s "book size" | -d "download workers" | -p "page workers" | '
+          '-j "bundle workers" | -g "segments" | -o "output_dir" | -r "rate" | -k "host=bandwidth,..."\n'
+          '-i Items in each bundle\n'
+          '-u Number of bundles\n'
+          '-m Search mirror, rs (libgen.rs) or li (libgen.li)\n'
+          '-l Latency of each response, in seconds\n'
+          '-b Bandwidth of each connection sending a book, in bytes/s (0 = unlimited)\n'
+          '-e Probability of a 503 error in each request\n'
+          '-t Requests per second allowed for each host before answering 429 (0 = no limit)\n'
+          '-s Size of each book, in bytes\n'
+          '-d run_parameters["download_workers"]\n'
+          '-p run_parameters["search_page_workers"]\n'
+          '-j run_parameters["bundle_workers"]\n'
+          '-g run_parameters["download_segments"]\n'
+          '-o Output dir, by default a temporary folder that is deleted at the end\n'
+          '-r Initial requests per second of the RateLimiter for each host\n'
+          '-k Bandwidth of some hosts, e.g. library.lol=20000')
+
+
+def main():
+    options = 'hi:u:m:l:b:e:t:s:d:p:j:g:o:r:k:'
+    config = StandInConfig()
+    num_bundles, mirror, output_dir = 1, 'rs', ''
+    parameters = {}
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], options)
+        for current_argument, current_value in arguments:
+            if current_argument == '-h':
+                display_help()
+                return
+            elif current_argument == '-i':
+                config.items_per_bundle = int(current_value)
+            elif current_argument == '-u':
+                num_bundles = int(current_value)
+            elif current_argument == '-m':
+                mirror = current_value
+            elif current_argument == '-l':
+                config.latency = float(current_value)
+            elif current_argument == '-b':
+                config.bandwidth = int(current_value)
+            elif current_argument == '-e':
+                config.error_rate = float(current_value)
+            elif current_argument == '-t':
+                config.throttle_rate = float(current_value)
+            elif current_argument == '-s':
+                config.book_size = int(current_value)
+            elif current_argument == '-d':
+                parameters['download_workers'] = int(current_value)
+            elif current_argument == '-p':
+                parameters['search_page_workers'] = int(current_value)
+            elif current_argument == '-j':
+                parameters['bundle_workers'] = int(current_value)
+            elif current_argument == '-g':
+                parameters['download_segments'] = int(current_value)
+            elif current_argument == '-o':
+                output_dir = current_value
+            elif current_argument == '-k':
+                for host_bandwidth in current_value.split(','):
+                    host, _, bandwidth = host_bandwidth.partition('=')
+                    config.host_bandwidth[host] = int(bandwidth)
+            elif current_argument == '-r':
+                parameters['rate_limits'] = {'default': dict(run_parameters['rate_limits']['default'],
+                                                             rate=float(current_value))}
+    except getopt.error as err:
+        print(str(err))
+        return
+    run_harness(config, num_bundles=num_bundles, mirror=mirror, output_dir=output_dir, parameters=parameters)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""
+    The ways of getting a page, from the cheapest to the most expensive:
+     - http: requests, connecting directly to the host
+     - proxy: requests through run_parameters['http_proxy']
+     - browser: the Opera driver and its built-in VPN (see OperaDriver), slow to start and one page at a time
+
+    run_parameters['transports'] lists the ones that can be used, in the order they are tried. proxy is
+    skipped if there is no http_proxy and browser if run_parameters['use_browser'] is False
+
+    The first page of a host is tried with each transport until one gets it. An HTTP 403/451 means the host
+    is blocked for that transport, and a Cloudflare or DDoS-Guard page means it asks for a browser
+    challenge. The transport that works is remembered for the host and used for the next pages, so the
+    browser is only started for the hosts that need it. After run_parameters['transport_recheck_after']
+    seconds the cheaper transports are tried again
+
+    A connection error or a timeout can be a blip of the network: the page is tried with the next
+    transport, but that transport is only remembered for the host after UNREACHABLE_FAILURES errors in a
+    row of the cheaper one
+
+    The transports of each host are stored in a JSON file (run_parameters['transports_file'], by default
+    in output_dir) so they survive between runs. They are listed, or some URLs are checked, with:
+
+        python Transports.py [-o output_dir] [url ...]
+
+"""
+import getopt
+import os
+import sys
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+from JsonCodec import read_json_state, write_json_state
+from utils import run_parameters
+
+TRANSPORTS_FILENAME = 'transports.json'
+DEFAULT_TRANSPORTS = ('http', 'proxy', 'browser')
+PAGE_TIMEOUT = 30
+BROWSER_PAGE_LOAD_TIMEOUT = 3000
+BLOCKED = 'blocked'
+CHALLENGE = 'challenge'
+UNREACHABLE = 'unreachable'
+UNREACHABLE_FAILURES = 3
+BLOCKED_STATUS = (403, 451)
+# the challenge pages are small, their markers are at the beginning
+CHALLENGE_SCAN_SIZE = 32 * 1024
+CHALLENGE_MARKERS = (
+    b'<title>just a moment...</title>',
+    b'cf-browser-verification',
+    b'cf_chl_opt',
+    b'<title>ddos-guard</title>',
+    b'checking your browser before accessing',
+)
+
+
+def get_host(url):
+    return urlparse(url).hostname or url
+
+
+class TransportBlocked(Exception):
+    """
+        The transport can't get the pages of a host, reason is BLOCKED, CHALLENGE or UNREACHABLE
+    """
+
+    def __init__(self, reason, message=''):
+        super().__init__(f'{reason} {message}'.strip())
+        self.reason = reason
+
+
+def is_challenge_page(content):
+    head = content[:CHALLENGE_SCAN_SIZE]
+    if isinstance(head, str):
+        head = head.encode('utf-8', errors='ignore')
+    head = head.lower()
+    return any(marker in head for marker in CHALLENGE_MARKERS)
+
+
+class Transport:
+    name = ''
+
+    def is_available(self):
+        return True
+
+    def get_page(self, url):
+        """
+        :return: the content of the page (bytes or str), or None if the host answers without it (e.g. a 404)
+        :raise TransportBlocked: if the host can't be reached with this transport
+        """
+        raise NotImplementedError
+
+
+class HttpTransport(Transport):
+    name = 'http'
+    use_proxy = False
+
+    def get_page(self, url):
+        import requests
+        from Connections import get_http_session, CHALLENGE_HEADER
+        try:
+            response = get_http_session(use_proxy=self.use_proxy).get(url, timeout=PAGE_TIMEOUT)
+        except requests.RequestException as err:
+            raise TransportBlocked(UNREACHABLE, str(err))
+        with response:
+            content = response.content
+        if (response.headers.get(CHALLENGE_HEADER, '') == 'challenge') or is_challenge_page(content):
+            raise TransportBlocked(CHALLENGE, f'HTTP {response.status_code}')
+        if response.status_code in BLOCKED_STATUS:
+            raise TransportBlocked(BLOCKED, f'HTTP {response.status_code}')
+        if response.status_code != requests.codes.ok:
+            print(f'Unable to get {url} - HTTP {response.status_code}', file=sys.stderr)
+            return None
+        return content
+
+
+class ProxyTransport(HttpTransport):
+    name = 'proxy'
+    use_proxy = True
+
+    def is_available(self):
+        return bool(run_parameters.get('http_proxy', ''))
+
+
+class BrowserTransport(Transport):
+    """
+        The last resort: the browser doesn't give us the HTTP status, the page is taken as it is
+    """
+    name = 'browser'
+
+    def is_available(self):
+        return run_parameters.get('use_browser', True)
+
+    def get_page(self, url):
+        from Connections import wait_for_host, scroll_to_end
+        from resources import humble_resources
+        with humble_resources.drivers.driver_in_use() as opera_driver:
+            with opera_driver.mutex:
+                opera_driver.driver.set_page_load_timeout(BROWSER_PAGE_LOAD_TIMEOUT)
+                wait_for_host(url)
+                opera_driver.driver.get(url)
+                # FIXME anna's archive -> necesita scroll
+                scroll_to_end()
+                return opera_driver.driver.page_source
+
+
+class TransportSelector:
+    """
+        Chooses the transport of each host and remembers it
+    """
+
+    def __init__(self, transports_file=None):
+        self.__transports_file = transports_file
+        self.__mutex = Lock()
+        self.__transports = {transport.name: transport
+                             for transport in (HttpTransport(), ProxyTransport(), BrowserTransport())}
+        self.__hosts = read_json_state(self.__transports_file, 'TransportSelector')
+        # (host, transport) -> connection errors in a row, not stored
+        self.__unreachable = {}
+
+    @property
+    def hosts(self):
+        with self.__mutex:
+            return dict(self.__hosts)
+
+    def candidates(self, allow_browser=True):
+        """
+            The transports that can be used, in the order they are tried
+        """
+        candidates = []
+        for name in run_parameters.get('transports', DEFAULT_TRANSPORTS):
+            transport = self.__transports.get(name, None)
+            if (not transport) or (not transport.is_available()):
+                continue
+            if (name == 'browser') and (not allow_browser):
+                continue
+            candidates.append(transport)
+        return candidates
+
+    def transport_of(self, url):
+        """
+        :return: the name of the transport remembered for the host of url, or '' if it hasn't been checked
+        """
+        with self.__mutex:
+            return self.__hosts.get(get_host(url), {}).get('transport', '')
+
+    def _remembered(self, host):
+        """
+            The transport of the host, if it has been checked in the last transport_recheck_after seconds
+        """
+        with self.__mutex:
+            host_transport = self.__hosts.get(host, None)
+        if not host_transport:
+            return ''
+        recheck_after = run_parameters.get('transport_recheck_after', 0)
+        if recheck_after and (time.time() - host_transport['checked'] > recheck_after):
+            return ''
+        return host_transport['transport']
+
+    def _remember(self, host, transport_name, failures):
+        with self.__mutex:
+            self.__hosts[host] = {'transport': transport_name, 'checked': time.time(), 'failures': failures}
+            write_json_state(self.__transports_file, self.__hosts)
+
+    def _failed(self, host, transport_name, reason):
+        """
+        :return: the reason of the failure, UNREACHABLE until the transport has failed UNREACHABLE_FAILURES
+            times in a row, BLOCKED after that
+        """
+        if reason != UNREACHABLE:
+            return reason
+        with self.__mutex:
+            errors = self.__unreachable[(host, transport_name)] = self.__unreachable.get((host, transport_name), 0) + 1
+        return BLOCKED if errors >= UNREACHABLE_FAILURES else UNREACHABLE
+
+    def _succeeded(self, host, transport_name):
+        with self.__mutex:
+            self.__unreachable.pop((host, transport_name), None)
+
+    def get_page(self, url, allow_browser=True, recheck=False):
+        """
+            Gets the page with the transport of its host, checking them in order if it isn't known
+            or has stopped working
+        :param recheck: checks every transport again, even if the host has one
+        :return: the content of the page, or None if no transport could get it
+        """
+        host = get_host(url)
+        candidates = self.candidates(allow_browser=allow_browser)
+        remembered = '' if recheck else self._remembered(host)
+        failures = {}
+        for transport in candidates:
+            if transport.name == remembered:
+                try:
+                    content = transport.get_page(url)
+                    self._succeeded(host, transport.name)
+                    return content
+                except TransportBlocked as err:
+                    print(f'{host} is no longer reachable with {transport.name} - {err}', file=sys.stderr)
+                    failures[transport.name] = self._failed(host, transport.name, err.reason)
+        for transport in candidates:
+            if transport.name in failures:
+                continue
+            try:
+                content = transport.get_page(url)
+            except TransportBlocked as err:
+                print(f'{host} can\'t be reached with {transport.name} - {err}', file=sys.stderr)
+                failures[transport.name] = self._failed(host, transport.name, err.reason)
+                continue
+            self._succeeded(host, transport.name)
+            if UNREACHABLE in failures.values():
+                # a connection error may not happen again, the host keeps its transport
+                print(f'Using {transport.name} for this page of {host}')
+            else:
+                print(f'Using {transport.name} for {host}')
+                self._remember(host, transport.name, failures)
+            return content
+        print(f'Unable to get {url} with any of {[transport.name for transport in candidates]}', file=sys.stderr)
+        return None
+
+    def get_session(self, url):
+        """
+            The requests session of the transport of the host, for the downloads from a page already loaded
+        """
+        from Connections import get_http_session
+        transport_name = self.transport_of(url)
+        if transport_name in ('http', 'proxy'):
+            return get_http_session(use_proxy=(transport_name == 'proxy'))
+        return get_http_session()
+
+
+def needs_browser(url):
+    """
+        The download links of a page can only be clicked in the browser if the page was loaded there
+    """
+    return get_transport_selector().transport_of(url) == 'browser'
+
+
+def known_without_browser(url):
+    """
+        The pages of the host have been loaded with http or proxy, a thread without a browser can download from it
+    """
+    return get_transport_selector().transport_of(url) in ('http', 'proxy')
+
+
+transport_selector_mutex = Lock()
+transport_selector = None
+
+
+def get_transport_selector():
+    global transport_selector
+    with transport_selector_mutex:
+        if not transport_selector:
+            transports_file = run_parameters.get('transports_file', '')
+            if not transports_file:
+                transports_file = os.path.join(run_parameters['output_dir'], TRANSPORTS_FILENAME)
+            transport_selector = TransportSelector(transports_file)
+        return transport_selector
+
+
+def main():
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], 'ho:')
+        for current_argument, current_value in arguments:
+            if current_argument == '-h':
+                print('Transports\n'
+                      '\tParameters: -h | -o "output_dir" [url ...]\n'
+                      '-o Output dir of HumbleJson, whose transports are listed\n'
+                      'The hosts of the urls are checked again with every transport')
+                return
+            elif current_argument == '-o':
+                run_parameters['output_dir'] = current_value
+    except getopt.error as err:
+        print(str(err))
+        return
+    selector = get_transport_selector()
+    for url in values:
+        selector.get_page(url, recheck=True)
+    for host, host_transport in sorted(selector.hosts.items()):
+        failures = ', '.join(f'{name} {reason}' for name, reason in host_transport.get('failures', {}).items())
+        print(f'{host:<30}{host_transport["transport"]:<10}{failures}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,55 @@
 """
     This file is here to contain the several resources I need to keep under control
 
+    The download pool and the selenium driver pool are created the first time they are used, so a run
+    that only parses a bundle or reads a backup doesn't start threads or load selenium
 
 """
-from OperaDriver import OperaDriver
-from Pool import LibgenDownloadPool
+from threading import Lock
 
 
 class HumbleResources:
 
     def __init__(self):
-        self.__pool = LibgenDownloadPool()
-        self.__selenium_driver = OperaDriver()
+        self.__mutex = Lock()
+        self.__pool = None
+        self.__selenium_drivers = None
 
     def __del__(self):
-        self.__pool.wait_for_all_threads()
+        if self.__pool:
+            self.__pool.wait_for_all_threads()
+        if self.__selenium_drivers:
+            self.__selenium_drivers.close_all()
 
     @property
     def driver(self):
-        return self.__selenium_driver
+        """
+            The driver checked out by the current thread (see OperaDriverPool.driver_in_use)
+        """
+        return self.drivers.current_driver()
+
+    @property
+    def drivers(self):
+        with self.__mutex:
+            if not self.__selenium_drivers:
+                from OperaDriver import OperaDriverPool
+                self.__selenium_drivers = OperaDriverPool()
+            return self.__selenium_drivers
 
     @property
     def pool(self):
-        return self.__pool
+        with self.__mutex:
+            if not self.__pool:
+                from Pool import LibgenDownloadPool
+                self.__pool = LibgenDownloadPool()
+            return self.__pool
+
+    def wait_for_all_threads(self):
+        """
+            Waits for the downloads of the pool, if it has been used
+        """
+        if self.__pool:
+            self.__pool.wait_for_all_threads()
 
 
 humble_resources = HumbleResources()
@@ -7,7 +7,12 @@ import getopt
 import os
 import sys
 
-from slugify import slugify
+# lxml is much faster than the pure-Python html.parser, but it's optional
+try:
+    import lxml  # pylint: disable=unused-import
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
 
 libgen_search_libgen_rs = dict(base_url='https://libgen.rs/', search_path='search.php')
 libgen_search_libgen_is = dict(base_url='https://libgen.is/', search_path='search.php')
@@ -26,7 +31,70 @@ run_parameters = {
     # 'libgen_download': 'cloudflare',
     'output_dir': '',
     'archive': False,
-    'parse_only': False
+    'parse_only': False,
+    # number of threads used to fetch the result pages 2..N of a search
+    'search_page_workers': 4,
+    # number of browsers in the selenium driver pool
+    'selenium_drivers': 1,
+    # persistent cache of search results (see SearchCache), by default stored in output_dir
+    'search_cache': True,
+    'search_cache_file': '',
+    'search_cache_ttl': 30 * 24 * 3600,
+    'search_cache_negative_ttl': 24 * 3600,
+    'search_cache_max_entries': 20000,
+    # concurrent searches of the same title, or lookups of the mirrors of the same book, share one request
+    # (see SingleFlight)
+    'single_flight': True,
+    # number of bundles processed at the same time (see BundleScheduler)
+    'bundle_workers': 1,
+    # items found in the search wait in a queue of this size until a download worker takes them
+    'download_workers': 1,
+    'download_queue_size': 10,
+    # items of a bundle searched at the same time
+    'search_workers': 1,
+    # items of each mock bundle in the batch mode of SearchNoBundle
+    'batch_shard_size': 100,
+    # big books are downloaded in this number of segments, using parallel connections
+    'download_segments': 4,
+    'segmented_download_min_size': 16 * 1024 * 1024,
+    # transports tried for each host, cheapest first (see Transports): 'http', 'proxy' (http_proxy) and
+    # 'browser' (the Opera driver, never used if use_browser is False)
+    'transports': ['http', 'proxy', 'browser'],
+    'use_browser': True,
+    # proxy of the 'proxy' transport, e.g. 'http://127.0.0.1:8080'
+    'http_proxy': '',
+    # the transport that works for each host is remembered, by default in output_dir/transports.json,
+    # and the cheaper ones are tried again after this number of seconds (0 = never)
+    'transports_file': '',
+    'transport_recheck_after': 7 * 24 * 3600,
+    # failover: number of mirrors of a book tried before giving up, and minimum bytes/s of a download
+    # (see DownloadMonitor), a slower one is abandoned and the next mirror is tried
+    'max_mirror_attempts': 3,
+    'min_download_throughput': 16 * 1024,
+    # seconds before a second download of the same book starts from another mirror, 0 to disable it
+    # (only for the downloads done with requests)
+    'hedge_after': 0,
+    # check the MD5 of the books downloaded, the wrong ones go to quarantine_dir (see ContentIndex)
+    'verify_md5': True,
+    'quarantine_dir': '',
+    # index of the books downloaded by MD5, a book already downloaded in another bundle is hard linked
+    # ('link'), marked as downloaded without copying it ('skip') or downloaded again ('')
+    'content_index': True,
+    'content_index_file': '',
+    'duplicate_books': 'link',
+    # 'json': a backup file (and its journal) for each bundle, 'sqlite': all the bundles in the
+    # LibraryCatalog, by default output_dir/library.sqlite3
+    'bundle_storage': 'json',
+    # '' or the compression of the JSON backups (see JsonCodec): 'gz' or 'zst' (needs zstandard)
+    'backup_compression': '',
+    'library_catalog_file': '',
+    # stats of the download mirrors (see MirrorScoreboard), by default stored in output_dir
+    'mirror_scoreboard_file': '',
+    # requests per second to each host (see RateLimiter), the hosts without their own entry use 'default'
+    # e.g. 'libgen.rs': {'rate': 1, 'burst': 2, 'min_rate': 0.1, 'max_rate': 4}
+    'rate_limits': {
+        'default': {'rate': 2.0, 'burst': 4, 'min_rate': 0.1, 'max_rate': 8.0},
+    }
 }
 
 
@@ -48,17 +116,15 @@ def delete_all_files(folder):
 
 
 def move_file_download_folder(dl_folder, destination_folder, download_filename):
+    # slugify is slow to import, only the downloads done with the browser use it
+    from slugify import slugify
     # download_filename = os.listdir(dl_folder)[0]
     filename, file_extension = os.path.splitext(download_filename)
     valid_filename = f'{slugify(filename, max_length=100)}.{file_extension}'
-    os.rename(
-        os.path.join(dl_folder, download_filename),
-        os.path.join(dl_folder, valid_filename)
-    )
-    os.replace(
-        os.path.join(dl_folder, valid_filename),
-        os.path.join(destination_folder, valid_filename)
-    )
+    destination_file = os.path.join(destination_folder, valid_filename)
+    # moved in one step, so the download folder never sees the renamed file
+    os.replace(os.path.join(dl_folder, download_filename), destination_file)
+    return destination_file
 
 
 def generate_filename(path, filename, extension):
@@ -73,6 +139,20 @@ def generate_filename(path, filename, extension):
     return numbered_name
 
 
+def get_output_root():
+    out_dir = run_parameters['output_dir']
+    if not out_dir:
+        out_dir = os.path.join(os.path.expanduser('~'), 'HumbleJsonBooks')
+    return out_dir
+
+
+def get_backup_folder():
+    """
+        The folder of the bundle backups, the current folder if there is no output dir
+    """
+    return run_parameters['output_dir'] or '.'
+
+
 def get_backup_file(humble_url):
     url_path = humble_url.split('/')[-1]
     return os.path.join(run_parameters['output_dir'], url_path)
@@ -80,18 +160,19 @@ def get_backup_file(humble_url):
 
 def display_help():
     print('Humble Bundle Json Extracter\n'
-          '\tParamenters: -h | -u "urls to parse" | -a | -o "output_dir" | -l "url to libgen"\n'
-          '\tLong parameters: help | urls="" | archive | out="" | libgen=""\n'
+          '\tParamenters: -h | -u "urls to parse" | -a | -o "output_dir" | -l "url to libgen" | -j "bundles"\n'
+          '\tLong parameters: help | urls="" | archive | out="" | libgen="" | jobs=""\n'
           '-u Input URLs. It can be a single URL or a list of comma separated URLs\n'
           '-a Flag to archive the Humble Bundle page into the Wayback Machine\n'
           '-o Output dir for the files from Library Genesis\n'
-          '-l Base URL for the Libgen mirror\t')
+          '-l Base URL for the Libgen mirror\n'
+          '-j Number of bundles processed at the same time\t')
 
 
 def parse_arguments():
     argument_list = sys.argv[1:]
-    options = 'hu:f:ao:l:p'
-    long_options = ['help', 'urls=', 'files=', 'archive',  'out=', 'libgen=', 'file=', 'parse']
+    options = 'hu:f:ao:l:pj:'
+    long_options = ['help', 'urls=', 'files=', 'archive',  'out=', 'libgen=', 'file=', 'parse', 'jobs=']
     try:
         arguments, values = getopt.getopt(argument_list, options, long_options)
         for current_argument, current_value in arguments:
@@ -109,6 +190,10 @@ def parse_arguments():
                 run_parameters['libgen_base'] = current_value
             elif current_argument in ('-p', long_options[5]):
                 run_parameters['parse_only'] = True
+            elif current_argument in ('-j', '--jobs'):
+                run_parameters['bundle_workers'] = max(1, int(current_value))
     except getopt.error as err:
         # output error, and return with an error code
         print(str(err))
+    except ValueError:
+        print(f'{current_argument} must be a number: {current_value}')